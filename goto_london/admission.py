@@ -0,0 +1,103 @@
+# Bound the number of concurrent rankings, shedding load when overwhelmed.
+
+from contextlib import contextmanager
+import threading
+from typing import Any, Iterator, Optional
+
+
+DEFAULT_MAX_IN_FLIGHT = 8
+DEFAULT_MAX_QUEUED = 16
+DEFAULT_QUEUE_TIMEOUT_SECONDS = 1.0
+# How old a response we'll serve in place of rejecting an overloaded request
+STALE_RESPONSE_MAX_AGE_SECONDS = 300
+
+
+class AdmissionRejectedException(Exception):
+    pass
+
+
+class AdmissionController:
+    """Admit a bounded number of requests at once, with a short wait queue.
+
+    Requests beyond `max_in_flight` wait up to `queue_timeout_seconds` for a
+    slot, unless `max_queued` requests are already waiting, in which case they
+    are rejected immediately.
+    """
+
+    def __init__(
+        self,
+        max_in_flight: int = DEFAULT_MAX_IN_FLIGHT,
+        max_queued: int = DEFAULT_MAX_QUEUED,
+        queue_timeout_seconds: float = DEFAULT_QUEUE_TIMEOUT_SECONDS,
+    ):
+        self.max_in_flight = max_in_flight
+        self.max_queued = max_queued
+        self.queue_timeout_seconds = queue_timeout_seconds
+
+        self._slots = threading.BoundedSemaphore(max_in_flight)
+        self._lock = threading.Lock()
+        self.in_flight = 0
+        self.queued = 0
+        self.admitted = 0
+        self.rejected_queue_full = 0
+        self.rejected_timed_out = 0
+
+    def _acquire(self):
+        if self._slots.acquire(blocking=False):
+            return
+
+        with self._lock:
+            if self.queued >= self.max_queued:
+                self.rejected_queue_full += 1
+                raise AdmissionRejectedException("Admission queue is full")
+            self.queued += 1
+
+        acquired = self._slots.acquire(timeout=self.queue_timeout_seconds)
+
+        with self._lock:
+            self.queued -= 1
+            if not acquired:
+                self.rejected_timed_out += 1
+                raise AdmissionRejectedException("Timed out waiting for admission")
+
+    @contextmanager
+    def admit(self) -> Iterator[None]:
+        """Hold a slot for the duration of the block, or raise if we can't get one."""
+        self._acquire()
+        with self._lock:
+            self.in_flight += 1
+            self.admitted += 1
+
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+            self._slots.release()
+
+    def metrics(self) -> dict[str, Any]:
+        with self._lock:
+            return {
+                "max_in_flight": self.max_in_flight,
+                "max_queued": self.max_queued,
+                "in_flight": self.in_flight,
+                "queued": self.queued,
+                "admitted": self.admitted,
+                "rejected_queue_full": self.rejected_queue_full,
+                "rejected_timed_out": self.rejected_timed_out,
+            }
+
+
+def admission_controller_from_config(
+    admission_config: Optional[dict[str, Any]] = None
+) -> AdmissionController:
+    """Build a controller from the (optional) `admission` section of config."""
+    admission_config = admission_config or {}
+
+    return AdmissionController(
+        max_in_flight=admission_config.get("max_in_flight", DEFAULT_MAX_IN_FLIGHT),
+        max_queued=admission_config.get("max_queued", DEFAULT_MAX_QUEUED),
+        queue_timeout_seconds=admission_config.get(
+            "queue_timeout_seconds", DEFAULT_QUEUE_TIMEOUT_SECONDS
+        ),
+    )
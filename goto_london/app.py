@@ -1,11 +1,49 @@
-from flask import Flask, render_template
+from functools import lru_cache
+import json
+from typing import Any, Callable, Iterator, Optional, TYPE_CHECKING
 
-from .common import config_iterator, get_config, get_local_timestamp
-from .destination_ranker import rank_options_for_destination, RankedDestinationOptions
+from flask import Flask, jsonify, render_template, request, Response
+
+from .admission import (
+    admission_controller_from_config,
+    AdmissionController,
+    AdmissionRejectedException,
+    STALE_RESPONSE_MAX_AGE_SECONDS,
+)
+from .common import get_local_timestamp, ModalityOption, STOP_POINT_DATASET_NAME
+from .destination_ranker import (
+    get_loaded_config,
+    plan_departures_for_destination,
+    rank_options_for_destination_within_deadline,
+    RankedDestinationOptions,
+    stop_points_cache_is_warm,
+)
+from .live_cache import ARRIVALS_CACHE, TtlCache
+from .prediction_accuracy import PREDICTION_ACCURACY
+from .stop_point_dataset import get_stop_point_dataset, StopPointDataset
+from .subscriptions import (
+    DEFAULT_MAX_SUBSCRIBERS,
+    DEFAULT_REFRESH_SECONDS,
+    SubscriptionHub,
+    TooManySubscribersException,
+)
+from .tenants import TENANTS, TenantUnavailableException, UnknownTenantException
+from .vehicle_timeline import VEHICLE_TIMELINES
+
+if TYPE_CHECKING:
+    import arrow
 
 
 app = Flask(__name__)
 
+# The last page rendered for each destination, served if we're too busy to rank
+_STALE_RESPONSES = TtlCache(STALE_RESPONSE_MAX_AGE_SECONDS, max_entries=1_000)
+_LOAD_SHED_RETRY_AFTER_SECONDS = 1
+_TENANT_RETRY_AFTER_SECONDS = 30
+_SUBSCRIBE_RETRY_AFTER_SECONDS = 30
+_STOPS_DEFAULT_LIMIT = 10
+_STOPS_MAX_LIMIT = 100
+
 _TFL_OPTION_TEMPLATE_STR = (
     "The {modality} || Arriving @ {to_station} by {arrival_time} (in {arrival_mins} mins) "
     "// (walk to stop {time_from_mins}m) --> (wait for vehicle {vehicle} @ {from_station} for {wait_departure_mins}m) "
@@ -17,14 +55,17 @@ _WALKING_OPTION_TEMPLATE_STR = (
 )
 
 
-def _string_for_option(option: RankedDestinationOptions) -> str:
+def _string_for_option(
+    option: RankedDestinationOptions, leave_at: Optional["arrow.Arrow"] = None
+) -> str:
+    # Waits and journey times are counted from when we'd leave (by default, now)
+    leave_at = get_local_timestamp() if leave_at is None else leave_at
+
     if option.modality == "walk":
         return _WALKING_OPTION_TEMPLATE_STR.format(
             modality=option.modality.upper(),
             arrival_time=option.details.arrival_time.format("HH:mm"),
-            arrival_mins=int(
-                (option.details.arrival_time - get_local_timestamp()).seconds / 60
-            ),
+            arrival_mins=int((option.details.arrival_time - leave_at).seconds / 60),
         )
     else:
         return _TFL_OPTION_TEMPLATE_STR.format(
@@ -37,11 +78,7 @@ def _string_for_option(option: RankedDestinationOptions) -> str:
             wait_departure_mins=int(
                 (
                     option.details.departure_time
-                    - (
-                        get_local_timestamp().shift(
-                            minutes=option.details.modality_option.time_from
-                        )
-                    )
+                    - (leave_at.shift(minutes=option.details.modality_option.time_from))
                 ).seconds
                 / 60
             ),
@@ -50,34 +87,309 @@ def _string_for_option(option: RankedDestinationOptions) -> str:
                 / 60
             ),
             arrival_time=option.final_arrival_time.format("HH:mm"),
-            arrival_mins=int(
-                (option.final_arrival_time - get_local_timestamp()).seconds / 60
+            arrival_mins=int((option.final_arrival_time - leave_at).seconds / 60),
+        )
+
+
+@lru_cache(maxsize=1)
+def _get_admission_controller() -> AdmissionController:
+    return admission_controller_from_config(get_loaded_config().get("admission"))
+
+
+def _shed_load_or_render(
+    response_key: tuple[str, ...],
+    template_name: str,
+    get_context: Callable[[], dict[str, Any]],
+):
+    """Render a page if we have capacity, otherwise serve a stale one (or a 503).
+
+    Stale pages are re-rendered from the last context we rendered them with,
+    along with when that was. Keys start with the kind of page, as otherwise
+    e.g. a tenant's "horizon" destination could pass for a departure horizon.
+    """
+    try:
+        with _get_admission_controller().admit():
+            context = get_context()
+            response = render_template(template_name, **context)
+    except AdmissionRejectedException:
+        stale_response = _STALE_RESPONSES.get(response_key)
+        if stale_response is None:
+            return (
+                "Too busy, try again shortly",
+                503,
+                {"Retry-After": str(_LOAD_SHED_RETRY_AFTER_SECONDS)},
+            )
+
+        stale_template_name, stale_context, rendered_at = stale_response
+        return (
+            render_template(
+                stale_template_name, **stale_context, stale_since=rendered_at
             ),
+            200,
+            {"Warning": '110 - "Response is Stale"'},
         )
 
+    _STALE_RESPONSES.set(
+        response_key,
+        (template_name, context, get_local_timestamp().format("HH:mm")),
+    )
+    return response
+
 
 @app.route("/goto/<destination>")
 def get_destination_options(destination: str):
+    return _shed_load_or_render(
+        ("destination", destination),
+        "transit_options.html",
+        lambda: _destination_options_context(destination),
+    )
+
 
-    ranked_options = rank_options_for_destination(target_destination=destination)
-    best_option = _string_for_option(ranked_options[0])
+@app.route("/u/<tenant_name>/goto/<destination>")
+def get_tenant_destination_options(tenant_name: str, destination: str):
+    def get_context() -> dict[str, Any]:
+        # Loading a tenant can take a while, so counts towards admission too
+        tenant = TENANTS.get(tenant_name)
+        return _destination_options_context(
+            destination, tenant.config, tenant.stop_points
+        )
+
+    return _shed_load_or_render(
+        ("tenant", tenant_name, destination), "transit_options.html", get_context
+    )
+
+
+@app.errorhandler(UnknownTenantException)
+def handle_unknown_tenant(e: UnknownTenantException):
+    return str(e), 404
+
+
+@app.errorhandler(TenantUnavailableException)
+def handle_unavailable_tenant(e: TenantUnavailableException):
+    # Most likely TFL's having trouble, so it's worth trying again shortly
+    return str(e), 503, {"Retry-After": str(_TENANT_RETRY_AFTER_SECONDS)}
+
+
+def _destination_options_context(
+    destination: str,
+    config: Optional[dict[str, Any]] = None,
+    stop_points_cache: Optional[dict[str, Any]] = None,
+) -> dict[str, Any]:
+    ranked_options, missing_options = rank_options_for_destination_within_deadline(
+        target_destination=destination,
+        config=config,
+        stop_points_cache=stop_points_cache,
+    )
+    best_option = _string_for_option(ranked_options[0]) if ranked_options else None
     other_options = [
         _string_for_option(ranked_option) for ranked_option in ranked_options[1:]
     ]
 
-    return render_template(
-        "transit_options.html", best_option=best_option, other_options=other_options
+    return dict(
+        best_option=best_option,
+        other_options=other_options,
+        missing_options=_strings_for_missing_options(missing_options),
+    )
+
+
+def _strings_for_missing_options(missing_options: list[ModalityOption]) -> list[str]:
+    # Options we ran out of time to check live arrivals for
+    return [
+        f"The {option.modality.upper()} ({option.line}) from {option.from_stop}"
+        for option in missing_options
+    ]
+
+
+@app.route("/goto/<destination>/horizon")
+def get_destination_departures(destination: str):
+    """Show the best option for leaving now, and at intervals over the next while."""
+    return _shed_load_or_render(
+        ("horizon", destination),
+        "departure_horizon.html",
+        lambda: _destination_departures_context(destination),
+    )
+
+
+def _destination_departures_context(destination: str) -> dict[str, Any]:
+    departures, missing_options = plan_departures_for_destination(destination)
+
+    return dict(
+        departures=[
+            dict(
+                offset_minutes=departure.offset_minutes,
+                leave_at=departure.leave_at.format("HH:mm"),
+                best_option=_string_for_option(
+                    departure.ranked_options[0], departure.leave_at
+                )
+                if departure.ranked_options
+                else None,
+            )
+            for departure in departures
+        ],
+        missing_options=_strings_for_missing_options(missing_options),
+    )
+
+
+@lru_cache(maxsize=1)
+def _get_subscription_hub() -> SubscriptionHub:
+    config = get_loaded_config()
+    return SubscriptionHub(
+        config.get("subscription_refresh_seconds", DEFAULT_REFRESH_SECONDS),
+        max_subscribers=config.get("max_subscribers", DEFAULT_MAX_SUBSCRIBERS),
+    )
+
+
+def _event_stream(key: str, refresh: Callable[[], dict[str, Any]]) -> Response:
+    def refresh_when_admitted() -> dict[str, Any]:
+        # Background refreshes count towards the same limit as requests
+        with _get_admission_controller().admit():
+            return refresh()
+
+    try:
+        subscription = _get_subscription_hub().subscribe(key, refresh_when_admitted)
+    except TooManySubscribersException as e:
+        # Each subscriber holds a thread, so more would starve other requests
+        return str(e), 503, {"Retry-After": str(_SUBSCRIBE_RETRY_AFTER_SECONDS)}
+
+    def stream_events() -> Iterator[str]:
+        for event in subscription:
+            if event is None:
+                # Keeps the connection open, and lets us notice a disconnect
+                yield ": keep-alive\n\n"
+            else:
+                event_type, data = event
+                yield f"event: {event_type}\ndata: {json.dumps(data)}\n\n"
+
+    response = Response(
+        stream_events(),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+    # Whether or not the stream was ever started
+    response.call_on_close(subscription.close)
+    return response
+
+
+def _refuse_subscription(
+    destination: str, config: dict[str, Any]
+) -> Optional[tuple[str, int]]:
+    # Checked before subscribing, so we don't start refreshing a destination for
+    # a client we can't serve
+    if destination not in config["destinations"]:
+        return f"No destination {destination}", 404
+    if not request.environ.get("wsgi.multithread"):
+        # A subscriber holds its thread open, so would tie up a single-threaded
+        # worker until its timeout killed the stream
+        return (
+            "Subscriptions need a threaded server, e.g. `serve --threads 16`",
+            503,
+        )
+    return None
+
+
+@app.route("/goto/<destination>/subscribe")
+def subscribe_to_destination_options(destination: str):
+    """Stream (as server-sent events) the options, then changes to them."""
+    refusal = _refuse_subscription(destination, get_loaded_config())
+    if refusal is not None:
+        return refusal
+
+    return _event_stream(destination, lambda: _destination_options_context(destination))
+
+
+@app.route("/u/<tenant_name>/goto/<destination>/subscribe")
+def subscribe_to_tenant_destination_options(tenant_name: str, destination: str):
+    tenant = TENANTS.get(tenant_name)
+    refusal = _refuse_subscription(destination, tenant.config)
+    if refusal is not None:
+        return refusal
+
+    return _event_stream(
+        f"{tenant_name}/{destination}",
+        lambda: _destination_options_context(
+            destination, tenant.config, tenant.stop_points
+        ),
     )
 
 
 @app.route("/goto")
 def get_all_destinations():
-    destinations = set()
-    for destination, modality, modality_options in config_iterator(get_config()):
-        destinations.update([destination])
+    destinations = get_loaded_config()["destinations"].keys()
 
     return "Destinations: " + ", ".join(destinations)
 
 
+@app.route("/healthz")
+def get_health():
+    return jsonify(status="ok")
+
+
+@app.route("/readyz")
+def get_readiness():
+    """Report whether this worker is warm enough to serve ranking requests."""
+    stop_points_cache_warm = stop_points_cache_is_warm()
+
+    return jsonify(
+        ready=stop_points_cache_warm,
+        stop_points_cache_warm=stop_points_cache_warm,
+        arrivals_cache_entries=len(ARRIVALS_CACHE),
+    ), (200 if stop_points_cache_warm else 503)
+
+
+@app.route("/metrics")
+def get_metrics():
+    return jsonify(
+        admission=_get_admission_controller().metrics(),
+        arrivals_cache_entries=len(ARRIVALS_CACHE),
+        vehicle_timelines=len(VEHICLE_TIMELINES),
+        prediction_accuracy_stops=len(PREDICTION_ACCURACY),
+        prediction_accuracy_dropped_payloads=PREDICTION_ACCURACY.dropped_payloads,
+        stale_responses=len(_STALE_RESPONSES),
+        loaded_tenants=len(TENANTS),
+        subscribed_destinations=len(_get_subscription_hub()),
+        subscribers=_get_subscription_hub().subscriber_count(),
+        max_subscribers=_get_subscription_hub().max_subscribers,
+        shared_stop_points=len(TENANTS.stop_point_store),
+    )
+
+
+def _get_stop_point_dataset() -> Optional[StopPointDataset]:
+    return get_stop_point_dataset(
+        get_loaded_config().get("stop_point_dataset", STOP_POINT_DATASET_NAME)
+    )
+
+
+@app.route("/stops")
+def search_stops():
+    """Look up StopPoints by (fuzzy) name, to help with writing config."""
+    dataset = _get_stop_point_dataset()
+    if dataset is None:
+        return jsonify(error="No StopPoint dataset available"), 404
+
+    matches = dataset.fuzzy_search(
+        request.args.get("q", ""),
+        modality=request.args.get("mode"),
+        line=request.args.get("line"),
+        limit=min(
+            max(request.args.get("limit", _STOPS_DEFAULT_LIMIT, type=int), 1),
+            _STOPS_MAX_LIMIT,
+        ),
+    )
+
+    return jsonify(
+        [
+            {
+                "id": stop_point.id,
+                "name": stop_point.name,
+                "stop_code": stop_point.stop_code,
+                "modes": stop_point.modes,
+                "lines": stop_point.lines,
+                "score": round(score, 3),
+            }
+            for score, stop_point in matches
+        ]
+    )
+
+
 def main():
     app.run(debug=True)
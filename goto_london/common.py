@@ -1,23 +1,34 @@
 """Common settings and utility functions."""
 from dataclasses import dataclass
 import logging
-import sys
-from typing import Any, Iterator, Literal, Optional, Union
+import time
+from typing import Any, Iterator, Literal, Optional, TYPE_CHECKING, Union
 
-import arrow
 from dotenv import dotenv_values
-import yaml
 
-logging.basicConfig(stream=sys.stdout, level=logging.INFO)
-LOGGER = logging
+from .log import configure_logging, HOT_PATH_LOGGER_NAME, LOGGER_NAME
+
+if TYPE_CHECKING:
+    import arrow
+
+configure_logging()
+LOGGER = logging.getLogger(LOGGER_NAME)
+HOT_PATH_LOGGER = logging.getLogger(HOT_PATH_LOGGER_NAME)
 
 CONFIG_FILE_NAME = "config.yaml"
+COMPILED_CONFIG_NAME = "config.compiled"
 ENV_FILE_NAME = ".env"
 STOP_POINT_CACHE_NAME = "tfl_stop_points.cache"
+STOP_POINT_DATASET_NAME = "tfl_stop_points.json"
+SHARED_STOP_POINT_CACHE_NAME = "tfl_stop_points.shared.cache"
+TENANTS_DIR_NAME = "tenants"
 
 ENV_TFL_APP_ID = "TFL_API_APP_ID"
 ENV_TFL_APP_KEY = "TFL_API_APP_KEY"
 ENV_TIMEZONE = "TIMEZONE"
+ENV_LIVE_CACHE_PATH = "LIVE_CACHE_PATH"
+ENV_RECORDING_DIR = "RECORDING_DIR"
+ENV_WARM_START_PATH = "WARM_START_PATH"
 ENV = dotenv_values(ENV_FILE_NAME)
 
 TflModalitiesType = Literal["bus", "tube"]
@@ -37,10 +48,29 @@ class ModalityOption:
     time_to: Optional[int]
 
 
-def get_config() -> dict[str, Any]:
-    """Load YAML config from file."""
-    with open(CONFIG_FILE_NAME, "r") as file:
-        config = yaml.safe_load(file)
+class DeadlineExceededException(Exception):
+    pass
+
+
+class Deadline:
+    """A latency budget for a request, shared by everything done on its behalf."""
+
+    def __init__(self, budget_seconds: float):
+        self.expires_at = time.monotonic() + budget_seconds
+
+    def remaining(self) -> float:
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def expired(self) -> bool:
+        return self.remaining() == 0.0
+
+
+def parse_config(raw_config: Union[str, bytes]) -> dict[str, Any]:
+    """Parse YAML config."""
+    # PyYAML is slow to import, and only needed when config has changed
+    import yaml
+
+    config = yaml.safe_load(raw_config)
 
     if not config:
         raise FileNotFoundError(
@@ -49,12 +79,22 @@ def get_config() -> dict[str, Any]:
     return config
 
 
+def get_config() -> dict[str, Any]:
+    """Load YAML config from file."""
+    with open(CONFIG_FILE_NAME, "r") as file:
+        return parse_config(file.read())
+
+
 def config_iterator(
     config: dict[str, Any]
 ) -> Iterator[tuple[str, AllModalitiesType, ModalityOption]]:
     """Iterate over destination-modality pairs (returning ModalityOptions)."""
     for destination, destination_config in config["destinations"].items():
         for modality, modality_config in destination_config.items():
+            # Options near given coordinates are discovered when ranking
+            if modality == "nearby":
+                continue
+
             if modality == "bus":
                 modality_option = ModalityOption(
                     modality,
@@ -84,8 +124,11 @@ def config_iterator(
             yield destination, modality, modality_option
 
 
-def get_local_timestamp(timestamp: Optional[str] = None) -> arrow.Arrow:
+def get_local_timestamp(timestamp: Optional[str] = None) -> "arrow.Arrow":
     """Localise a target timestamp, or the current time."""
+    # arrow is slow to import, and not needed to load config or StopPoints
+    import arrow
+
     target_tz = ENV[ENV_TIMEZONE]
 
     if timestamp:
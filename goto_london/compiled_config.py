@@ -0,0 +1,137 @@
+# Compile config.yaml (and its resolved StopPoints) into a fast-loading snapshot.
+
+import argparse
+from dataclasses import dataclass
+import hashlib
+import os
+import pickle
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Any, Optional
+
+from .common import (
+    AllModalitiesType,
+    COMPILED_CONFIG_NAME,
+    CONFIG_FILE_NAME,
+    config_iterator,
+    LOGGER,
+    ModalityOption,
+    parse_config,
+)
+
+
+# Bump whenever the shape of CompiledConfig changes, to invalidate old snapshots
+_COMPILED_CONFIG_VERSION = 1
+
+
+@dataclass
+class CompiledConfig:
+    """Validated config, ready to use without re-parsing YAML."""
+
+    version: int
+    source_hash: str
+    config: dict[str, Any]
+    modality_options: list[tuple[str, AllModalitiesType, ModalityOption]]
+    # StopPoints cache contents for this config, once they've been resolved
+    stop_points: Optional[dict[str, Any]] = None
+
+
+def _compile(raw_config: bytes, source_hash: str) -> CompiledConfig:
+    config = parse_config(raw_config)
+
+    return CompiledConfig(
+        version=_COMPILED_CONFIG_VERSION,
+        source_hash=source_hash,
+        config=config,
+        # Unpacking every option up front also validates the config
+        modality_options=list(config_iterator(config)),
+    )
+
+
+def save_compiled_config(
+    compiled_config: CompiledConfig,
+    compiled_path: os.PathLike = COMPILED_CONFIG_NAME,
+):
+    # Swap into place so concurrently starting processes never read half a file
+    compiled_dir = os.path.dirname(os.path.abspath(compiled_path))
+    with tempfile.NamedTemporaryFile(
+        "wb", dir=compiled_dir, prefix=".config.", suffix=".tmp", delete=False
+    ) as f:
+        pickle.dump(compiled_config, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(f.name, compiled_path)
+
+
+def _load_snapshot(compiled_path: os.PathLike) -> Optional[CompiledConfig]:
+    try:
+        with open(compiled_path, "rb") as f:
+            compiled_config = pickle.load(f)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        # e.g. a snapshot pickled by other code, which we can just re-compile
+        LOGGER.warning("Ignoring unreadable %s: %r", compiled_path, e)
+        return None
+
+    if getattr(compiled_config, "version", None) != _COMPILED_CONFIG_VERSION:
+        return None
+    return compiled_config
+
+
+def load_compiled_config(
+    config_path: os.PathLike = CONFIG_FILE_NAME,
+    compiled_path: os.PathLike = COMPILED_CONFIG_NAME,
+) -> CompiledConfig:
+    """Load the compiled config, re-compiling it if the YAML has changed."""
+    with open(config_path, "rb") as f:
+        raw_config = f.read()
+    source_hash = hashlib.sha256(raw_config).hexdigest()
+
+    compiled_config = _load_snapshot(compiled_path)
+    if compiled_config is not None and compiled_config.source_hash == source_hash:
+        return compiled_config
+
+    LOGGER.info("Compiling %s to %s", config_path, compiled_path)
+    compiled_config = _compile(raw_config, source_hash)
+    save_compiled_config(compiled_config, compiled_path)
+    return compiled_config
+
+
+def _time_import(module: str) -> float:
+    start = time.perf_counter()
+    subprocess.run([sys.executable, "-c", f"import {module}"], check=True)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compile config and benchmark process startup."
+    )
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    with open(CONFIG_FILE_NAME, "rb") as f:
+        for _ in range(args.repeat):
+            f.seek(0)
+            parse_config(f.read())
+    print(f"Parse YAML config: {(time.perf_counter() - start) / args.repeat:.4f}s")
+
+    load_compiled_config()
+    start = time.perf_counter()
+    for _ in range(args.repeat):
+        load_compiled_config()
+    print(f"Load compiled config: {(time.perf_counter() - start) / args.repeat:.4f}s")
+
+    for module in (
+        "goto_london.stop_point_cacher",
+        "goto_london.destination_ranker",
+        "goto_london.app",
+    ):
+        durations = [_time_import(module) for _ in range(args.repeat)]
+        print(f"Start process & import {module}: {min(durations):.3f}s (best)")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,19 +1,34 @@
 # Calculate best routes using live TFL arrivals info.
-from dataclasses import dataclass
-from typing import Optional
-
-import arrow
+from dataclasses import dataclass, replace
+from typing import Any, Iterable, Optional, TYPE_CHECKING
 
 from .common import (
     config_iterator,
-    get_config,
+    Deadline,
     get_local_timestamp,
+    HOT_PATH_LOGGER,
     LOGGER,
     ModalityOption,
     AllModalitiesType,
+    STOP_POINT_DATASET_NAME,
+)
+from .compiled_config import load_compiled_config, save_compiled_config
+from .log import configure_logging
+from .nearby_options import discover_modality_options_for_config
+from .prediction_accuracy import (
+    DEFAULT_MARGIN_MIN_SAMPLES,
+    DEFAULT_MARGIN_QUANTILE,
+    PREDICTION_ACCURACY,
+    PredictionMargins,
 )
-from .stop_point_cacher import get_from_cache, load_or_generate_cache
-from .tfl_api import TflApi
+from .stop_point_cacher import get_from_cache, load_or_generate_cache, StopPointsInfo
+from .stop_point_dataset import get_stop_point_dataset
+from .vehicle_timeline import VEHICLE_TIMELINES
+
+if TYPE_CHECKING:
+    import arrow
+
+    from .tfl_api import LineStopPointLookup, TflApi
 
 
 @dataclass
@@ -23,8 +38,11 @@ class CalculatedDestinationModalityOption:
     destination: str
     modality_option: ModalityOption
     vehicle_id: Optional[str]
-    departure_time: arrow.Arrow
-    arrival_time: arrow.Arrow
+    departure_time: "arrow.Arrow"
+    arrival_time: "arrow.Arrow"
+    # How much earlier/later than predicted we allow for the vehicle being
+    departure_margin_seconds: float = 0.0
+    arrival_margin_seconds: float = 0.0
 
 
 @dataclass
@@ -33,112 +51,384 @@ class RankedDestinationOptions:
 
     destination: str
     modality: AllModalitiesType
-    final_arrival_time: arrow.Arrow
+    final_arrival_time: "arrow.Arrow"
     applied_bonus: int
     rank: int
     id: int
     details: CalculatedDestinationModalityOption
 
 
-STOP_POINTS_CACHE = load_or_generate_cache()
-CONFIG = get_config()
+@dataclass
+class DepartureOptions:
+    """Ranked options for leaving some minutes from now."""
 
+    offset_minutes: int
+    leave_at: "arrow.Arrow"
+    ranked_options: list[RankedDestinationOptions]
 
-def _get_modality_timings_for_destination(
+
+# Candidate vehicles per option to check go to the destination, per round of
+# (batched) vehicle arrivals calls. Planning later departures wants several
+# vehicles per option, so starts with more
+_CANDIDATES_PER_ROUND = 2
+_MAX_PLANNED_CANDIDATES = 6
+
+# An option, the lookup and destination stop for it, candidate vehicles and the
+# margins to allow for at the origin and destination stops
+_OptionCandidatesType = tuple[
+    ModalityOption,
+    "LineStopPointLookup",
+    str,
+    list[dict[str, Any]],
+    tuple[PredictionMargins, PredictionMargins],
+]
+
+DEFAULT_DEPARTURE_WINDOW_MINUTES = 30
+DEFAULT_DEPARTURE_STEP_MINUTES = 5
+
+# Loaded on first use (or up front by the server, before forking workers)
+STOP_POINTS_CACHE = None
+CONFIG = None
+
+
+def reload_config_and_cache():
+    """Re-read config and the StopPoint cache, e.g. on a graceful server reload."""
+    global STOP_POINTS_CACHE, CONFIG
+
+    compiled_config = load_compiled_config()
+    if compiled_config.stop_points is None:
+        compiled_config.stop_points = load_or_generate_cache(compiled_config.config)
+        save_compiled_config(compiled_config)
+
+    STOP_POINTS_CACHE = compiled_config.stop_points
+    CONFIG = compiled_config.config
+    configure_logging(CONFIG.get("logging"))
+    # Fail now, rather than on the first request for a departure horizon
+    get_departure_offsets(CONFIG)
+
+    # Load the StopPoint dataset (if there is one) now too, rather than on some
+    # unlucky request in each worker. It may have been replaced since last time
+    get_stop_point_dataset.cache_clear()
+    get_stop_point_dataset(CONFIG.get("stop_point_dataset", STOP_POINT_DATASET_NAME))
+
+
+def get_loaded_config() -> dict[str, Any]:
+    """Get the config used for ranking, loading it if we haven't yet."""
+    if CONFIG is None or STOP_POINTS_CACHE is None:
+        reload_config_and_cache()
+    return CONFIG
+
+
+def stop_points_cache_is_warm() -> bool:
+    """Check that every TFL option in config can be looked up in the cache."""
+    get_loaded_config()
+    try:
+        for _, modality, modality_option in config_iterator(CONFIG):
+            if modality != "walk":
+                get_from_cache(modality_option, cache=STOP_POINTS_CACHE)
+    except KeyError:
+        return False
+
+    return True
+
+
+def _get_modality_options_for_destination(
     target_destination: str,
-) -> list[CalculatedDestinationModalityOption]:
-    """Generate CalculatedDestinationModalityOptions for each destination modality in config."""
-    api = TflApi()
-    calculated_options: list[CalculatedDestinationModalityOption] = []
+    config: dict[str, Any],
+    stop_points_cache: dict[str, Any],
+) -> list[tuple[ModalityOption, Optional[StopPointsInfo]]]:
+    """Get the destination's options from config, and any discovered nearby."""
+    modality_options: list[tuple[ModalityOption, Optional[StopPointsInfo]]] = []
 
-    for destination, modality, modality_option in config_iterator(CONFIG):
+    for destination, modality, modality_option in config_iterator(config):
         # Skip non-target destination configs
         if destination != target_destination:
             continue
 
+        modality_options.append(
+            (
+                modality_option,
+                # Look up the specific StopPoint IDs for the given ModalityOption
+                # (needed for the TFL API)
+                None
+                if modality == "walk"
+                else get_from_cache(modality_option, cache=stop_points_cache),
+            )
+        )
+
+    destination_config = config["destinations"].get(target_destination) or {}
+    if "nearby" in destination_config:
+        dataset = get_stop_point_dataset(
+            config.get("stop_point_dataset", STOP_POINT_DATASET_NAME)
+        )
+        if dataset is None:
+            LOGGER.warning("Need a StopPoint dataset to discover nearby options")
+        else:
+            modality_options.extend(
+                discover_modality_options_for_config(
+                    dataset,
+                    destination_config["nearby"],
+                    include_walk="walk" not in destination_config,
+                )
+            )
+
+    return modality_options
+
+
+def _get_prediction_margins(
+    config: dict[str, Any], line: str, stop_point_id: str
+) -> PredictionMargins:
+    """How early or late to allow for vehicles being, per `prediction_margin` config."""
+    margin_config = config.get("prediction_margin")
+    if not margin_config:
+        return PredictionMargins()
+
+    return PREDICTION_ACCURACY.margins(
+        line,
+        stop_point_id,
+        margin_config.get("quantile", DEFAULT_MARGIN_QUANTILE),
+        margin_config.get("min_samples", DEFAULT_MARGIN_MIN_SAMPLES),
+    )
+
+
+def _get_vehicle_timings(
+    target_destination: str,
+    modality_option: ModalityOption,
+    lookup: "LineStopPointLookup",
+    to_stop_point: str,
+    next_vehicles: list[dict[str, Any]],
+    vehicles_arrivals: dict[str, list[dict[str, Any]]],
+    all_vehicles: bool,
+    margins: tuple[PredictionMargins, PredictionMargins],
+) -> Optional[list[CalculatedDestinationModalityOption]]:
+    """Get timings for the first (or every) vehicle that'll take us to destination.
+
+    Returns None if we ran out of time before finding one. `margins` are those
+    for the origin and destination stops.
+    """
+    origin_margins, destination_margins = margins
+    vehicle_timings: list[CalculatedDestinationModalityOption] = []
+
+    for next_vehicle in next_vehicles:
+        # Check that the vehicles departing our origin StopPoint will travel to our
+        # destination (needed where a certain line might branch on the way)
+        known, vehicle_destination_arrival = VEHICLE_TIMELINES.lookup(
+            next_vehicle["vehicleId"], lookup.line, to_stop_point
+        )
+
+        if not known:
+            if next_vehicle["vehicleId"] not in vehicles_arrivals:
+                # We ran out of time before finding a vehicle that works
+                return vehicle_timings or None
+
+            from .tfl_api import TflApi
+
+            # e.g. where arrivals came from a cache shared with other workers
+            vehicle_destination_arrival = (
+                TflApi.get_destination_arrival_from_vehicle_arrivals(
+                    vehicles_arrivals[next_vehicle["vehicleId"]],
+                    stop_point_id=to_stop_point,
+                    line=lookup.line,
+                )
+            )
+
+        if not vehicle_destination_arrival:
+            continue
+
+        # As soon as we find a vehicle that we know will travel to destination
+        # then we go with that option, as the vehicles are returned in order of arrival
+        # time (and we've already filtered out those arriving too soon to get to the stop).
+        # Unless we want every vehicle, e.g. to plan for leaving later
+        vehicle_timings.append(
+            CalculatedDestinationModalityOption(
+                destination=target_destination,
+                modality_option=modality_option,
+                vehicle_id=next_vehicle["vehicleId"],
+                # expectedArrival = when the next vehicle will arrive at origin stop
+                departure_time=get_local_timestamp(next_vehicle["expectedArrival"]),
+                arrival_time=get_local_timestamp(
+                    # expectedArrival = when the vehicle will arrive at its destination stop
+                    vehicle_destination_arrival["expectedArrival"]
+                ),
+                departure_margin_seconds=origin_margins.early_seconds,
+                arrival_margin_seconds=destination_margins.late_seconds,
+            )
+        )
+        if not all_vehicles:
+            break
+
+    return vehicle_timings
+
+
+def _get_timings_for_candidates(
+    target_destination: str,
+    api: "TflApi",
+    options_with_candidates: list[_OptionCandidatesType],
+    all_vehicles: bool,
+) -> tuple[list[CalculatedDestinationModalityOption], list[ModalityOption]]:
+    """Check which candidate vehicles go to the destination, a few at a time.
+
+    Each round fetches the onward arrivals of the next few candidates for every
+    option still without a vehicle, in one go, so we rarely fetch more than the
+    first candidate or two. Also returns the ModalityOptions we ran out of time for.
+    """
+    calculated_options: list[CalculatedDestinationModalityOption] = []
+    missing_options: list[ModalityOption] = []
+    vehicles_arrivals: dict[str, list[dict[str, Any]]] = {}
+    n_candidates = _MAX_PLANNED_CANDIDATES if all_vehicles else _CANDIDATES_PER_ROUND
+
+    while options_with_candidates:
+        # Bar those we already know the destination arrival of
+        vehicles_arrivals |= api.get_vehicles_arrivals(
+            next_vehicle["vehicleId"]
+            for _, lookup, to_stop_point, next_vehicles, _ in options_with_candidates
+            for next_vehicle in next_vehicles[:n_candidates]
+            if next_vehicle["vehicleId"] not in vehicles_arrivals
+            and not VEHICLE_TIMELINES.lookup(
+                next_vehicle["vehicleId"], lookup.line, to_stop_point
+            )[0]
+        )
+
+        unresolved_options = []
+        for option_candidates in options_with_candidates:
+            (
+                modality_option,
+                lookup,
+                to_stop_point,
+                next_vehicles,
+                margins,
+            ) = option_candidates
+            vehicle_timings = _get_vehicle_timings(
+                target_destination,
+                modality_option,
+                lookup,
+                to_stop_point,
+                next_vehicles[:n_candidates],
+                vehicles_arrivals,
+                all_vehicles,
+                margins,
+            )
+            if vehicle_timings is None:
+                missing_options.append(modality_option)
+            elif not vehicle_timings and len(next_vehicles) > n_candidates:
+                # None of these candidates go our way, so try the next few
+                unresolved_options.append(option_candidates)
+            else:
+                calculated_options.extend(vehicle_timings)
+
+        options_with_candidates = unresolved_options
+        n_candidates += _CANDIDATES_PER_ROUND
+
+    return calculated_options, missing_options
+
+
+def _get_modality_timings_for_destination(
+    target_destination: str,
+    deadline: Optional[Deadline] = None,
+    config: Optional[dict[str, Any]] = None,
+    stop_points_cache: Optional[dict[str, Any]] = None,
+    all_vehicles: bool = False,
+) -> tuple[list[CalculatedDestinationModalityOption], list[ModalityOption]]:
+    """Generate CalculatedDestinationModalityOptions for each destination modality in config.
+
+    Also returns the ModalityOptions we ran out of time to calculate. With
+    `all_vehicles`, TFL options get one entry per vehicle that'll take us to the
+    destination (in order of departure), rather than just the first.
+    """
+    # requests (and so TflApi) is slow to import, so leave it until we rank
+    from .tfl_api import LineStopPointLookup, TflApi
+
+    config = CONFIG if config is None else config
+    stop_points_cache = (
+        STOP_POINTS_CACHE if stop_points_cache is None else stop_points_cache
+    )
+    api = TflApi(deadline=deadline)
+    calculated_options: list[CalculatedDestinationModalityOption] = []
+    missing_options: list[ModalityOption] = []
+    tfl_modality_options: list[tuple[ModalityOption, LineStopPointLookup, str]] = []
+
+    for modality_option, stop_points_info in _get_modality_options_for_destination(
+        target_destination, config, stop_points_cache
+    ):
         # Cover non-TFL data calculated case
-        if modality == "walk":
+        if modality_option.modality == "walk":
             # Assume we just leave now for any walking case
             now = get_local_timestamp()
             calculated_options.append(
                 CalculatedDestinationModalityOption(
-                    destination=destination,
+                    destination=target_destination,
                     modality_option=modality_option,
                     vehicle_id=None,
                     departure_time=now,
                     arrival_time=now.shift(minutes=modality_option.time_from),
                 )
             )
-            break
+            continue
 
-        # Look up the specific StopPoint IDs for the given ModalityOption
-        # (needed for the TFL API)
-        from_stop_point, to_stop_point, line, direction = get_from_cache(
-            modality_option,
-            cache=STOP_POINTS_CACHE,
-        )
-        next_vehicles = api.get_next_vehicles_for_line_stop_point(
-            line=line, stop_point_id=from_stop_point, direction=direction
+        from_stop_point, to_stop_point, line, direction = stop_points_info
+        tfl_modality_options.append(
+            (
+                modality_option,
+                LineStopPointLookup(line, from_stop_point, direction),
+                to_stop_point,
+            )
         )
 
-        LOGGER.info("Found %d next vehicles", len(next_vehicles))
+    # Fetch the next vehicles for all of the destination's modalities up front,
+    # so that TflApi can batch lookups into as few calls as possible
+    next_vehicles_by_lookup = api.get_next_vehicles_for_line_stop_points(
+        lookup for _, lookup, _ in tfl_modality_options
+    )
+
+    options_with_candidates: list[_OptionCandidatesType] = []
+    for modality_option, lookup, to_stop_point in tfl_modality_options:
+        if lookup not in next_vehicles_by_lookup:
+            # We ran out of time before getting to this lookup
+            missing_options.append(modality_option)
+            continue
+
+        next_vehicles = next_vehicles_by_lookup[lookup]
 
+        HOT_PATH_LOGGER.info("Found %d next vehicles", len(next_vehicles))
+
+        margins = (
+            _get_prediction_margins(config, lookup.line, lookup.stop_point_id),
+            _get_prediction_margins(config, lookup.line, to_stop_point),
+        )
+        # Allow for vehicles getting to the stop before predicted, so we don't miss them
         next_vehicles = api.filter_vehicles_beyond_n_minutes_away(
-            next_vehicles, modality_option.time_from
+            next_vehicles, modality_option.time_from + margins[0].early_seconds / 60
         )
 
-        LOGGER.info(
+        HOT_PATH_LOGGER.info(
             "Filtered that down to %d vehicles enough in future", len(next_vehicles)
         )
+        options_with_candidates.append(
+            (modality_option, lookup, to_stop_point, next_vehicles, margins)
+        )
 
-        for next_vehicle in next_vehicles:
-            # Check that the vehicles departing our origin StopPoint will travel to our
-            # destination (needed where a certain line might branch on the way)
-            next_vehicle_arrivals = api.get_vehicle_arrivals(next_vehicle["vehicleId"])
-
-            vehicle_destination_arrival = (
-                api.get_destination_arrival_from_vehicle_arrivals(
-                    next_vehicle_arrivals, stop_point_id=to_stop_point, line=line
-                )
-            )
+    candidate_timings, candidate_missing_options = _get_timings_for_candidates(
+        target_destination, api, options_with_candidates, all_vehicles
+    )
+    calculated_options.extend(candidate_timings)
+    missing_options.extend(candidate_missing_options)
 
-            if not vehicle_destination_arrival:
-                continue
+    return calculated_options, missing_options
 
-            # As soon as we find a vehicle that we know will travel to destination
-            # then we go with that option, as the vehicles are returned in order of arrival
-            # time (and we've already filtered out those arriving too soon to get to the stop)
-            calculated_options.append(
-                CalculatedDestinationModalityOption(
-                    destination=destination,
-                    modality_option=modality_option,
-                    vehicle_id=next_vehicle["vehicleId"],
-                    # expectedArrival = when the next vehicle will arrive at origin stop
-                    departure_time=get_local_timestamp(next_vehicle["expectedArrival"]),
-                    arrival_time=get_local_timestamp(
-                        # expectedArrival = when the vehicle will arrive at its destination stop
-                        vehicle_destination_arrival["expectedArrival"]
-                    ),
-                )
-            )
-            break
-
-    return calculated_options
 
-
-def rank_options_for_destination(
+def _rank_modality_timings(
     target_destination: str,
+    modality_timings: list[CalculatedDestinationModalityOption],
+    config: Optional[dict[str, Any]] = None,
 ) -> list[RankedDestinationOptions]:
-    """Generate ranked travel options for a target destination."""
+    config = CONFIG if config is None else config
     ranked_destination_options: dict[int, RankedDestinationOptions] = {}
-
-    modality_timings = _get_modality_timings_for_destination(target_destination)
     adjusted_arrival_times: list[tuple[int, arrow.Arrow]] = []
 
     for m, modality_timing in enumerate(modality_timings):
         modality = modality_timing.modality_option.modality
         # Config describes time bonus in positive terms for so reverse the time shift
-        bonus_minutes = -1 * CONFIG[f"{modality}_time_bonus"]
+        bonus_minutes = -1 * config[f"{modality}_time_bonus"]
 
         # Add the final walking time from transit arrival to destination
         final_arrival_time = modality_timing.arrival_time.shift(
@@ -157,9 +447,16 @@ def rank_options_for_destination(
         )
 
         adjusted_arrival_times.append(
-            # Penalise/benefit mode based on config-level bonus minutes.
+            # Penalise/benefit mode based on config-level bonus minutes, and
+            # allow for the vehicle arriving later than predicted.
             # This list is just to facilitate final ranking of our options
-            (m, final_arrival_time.shift(minutes=bonus_minutes))
+            (
+                m,
+                final_arrival_time.shift(
+                    minutes=bonus_minutes,
+                    seconds=modality_timing.arrival_margin_seconds,
+                ),
+            )
         )
 
     # Sort list based on which option will get user there first,
@@ -177,9 +474,147 @@ def rank_options_for_destination(
     return ranked_destination_options_list
 
 
+def _with_defaults(
+    config: Optional[dict[str, Any]],
+    stop_points_cache: Optional[dict[str, Any]],
+    deadline: Optional[Deadline],
+) -> tuple[dict[str, Any], dict[str, Any], Optional[Deadline]]:
+    if config is None or stop_points_cache is None:
+        get_loaded_config()
+        config = CONFIG if config is None else config
+        stop_points_cache = (
+            STOP_POINTS_CACHE if stop_points_cache is None else stop_points_cache
+        )
+
+    if deadline is None and config.get("request_budget_seconds"):
+        deadline = Deadline(config["request_budget_seconds"])
+
+    return config, stop_points_cache, deadline
+
+
+def rank_options_for_destination_within_deadline(
+    target_destination: str,
+    deadline: Optional[Deadline] = None,
+    config: Optional[dict[str, Any]] = None,
+    stop_points_cache: Optional[dict[str, Any]] = None,
+) -> tuple[list[RankedDestinationOptions], list[ModalityOption]]:
+    """Generate the best ranked travel options we can before a deadline.
+
+    Also returns the ModalityOptions we ran out of time to calculate. Without an
+    explicit deadline, we use the `request_budget_seconds` from config (if set).
+    Config and StopPoints default to those loaded from `config.yaml`, but can be
+    given explicitly (e.g. for a tenant).
+    """
+    config, stop_points_cache, deadline = _with_defaults(
+        config, stop_points_cache, deadline
+    )
+
+    modality_timings, missing_options = _get_modality_timings_for_destination(
+        target_destination, deadline, config, stop_points_cache
+    )
+    return (
+        _rank_modality_timings(target_destination, modality_timings, config),
+        missing_options,
+    )
+
+
+def rank_options_for_destination(
+    target_destination: str,
+) -> list[RankedDestinationOptions]:
+    """Generate ranked travel options for a target destination."""
+    ranked_options, _ = rank_options_for_destination_within_deadline(target_destination)
+    return ranked_options
+
+
+def get_departure_offsets(config: dict[str, Any]) -> list[int]:
+    """Minutes from now to plan departures for, from the `departure_horizon` config."""
+    horizon_config = config.get("departure_horizon") or {}
+    window_minutes = horizon_config.get(
+        "window_minutes", DEFAULT_DEPARTURE_WINDOW_MINUTES
+    )
+    step_minutes = horizon_config.get("step_minutes", DEFAULT_DEPARTURE_STEP_MINUTES)
+
+    if not isinstance(window_minutes, int) or window_minutes < 0:
+        raise ValueError(
+            f"departure_horizon window_minutes must be a whole number of minutes, "
+            f"not {window_minutes!r}"
+        )
+    if not isinstance(step_minutes, int) or step_minutes < 1:
+        raise ValueError(
+            f"departure_horizon step_minutes must be at least 1, not {step_minutes!r}"
+        )
+    return list(range(0, window_minutes + 1, step_minutes))
+
+
+def plan_departures_for_destination(
+    target_destination: str,
+    offsets_minutes: Optional[Iterable[int]] = None,
+    deadline: Optional[Deadline] = None,
+    config: Optional[dict[str, Any]] = None,
+    stop_points_cache: Optional[dict[str, Any]] = None,
+) -> tuple[list[DepartureOptions], list[ModalityOption]]:
+    """Rank options for leaving now, or in each of several minutes' time.
+
+    Live arrivals are fetched once, and each departure picks the first vehicle
+    we'd still make from them. TFL only predicts so far ahead, so options can
+    drop out of later departures. Also returns the ModalityOptions we ran out
+    of time to calculate.
+    """
+    config, stop_points_cache, deadline = _with_defaults(
+        config, stop_points_cache, deadline
+    )
+    if offsets_minutes is None:
+        offsets_minutes = get_departure_offsets(config)
+
+    modality_timings, missing_options = _get_modality_timings_for_destination(
+        target_destination, deadline, config, stop_points_cache, all_vehicles=True
+    )
+    now = get_local_timestamp()
+
+    departures = []
+    for offset_minutes in offsets_minutes:
+        leave_at = now.shift(minutes=offset_minutes)
+        departure_timings = []
+        # Timings are in order of departure for each option, so take the first
+        # we'd make for each (keyed on identity, as options may look alike)
+        planned_options = set()
+
+        for modality_timing in modality_timings:
+            modality_option = modality_timing.modality_option
+            if id(modality_option) in planned_options:
+                continue
+
+            if modality_option.modality == "walk":
+                modality_timing = replace(
+                    modality_timing,
+                    departure_time=leave_at,
+                    arrival_time=leave_at.shift(minutes=modality_option.time_from),
+                )
+            elif modality_timing.departure_time < leave_at.shift(
+                minutes=modality_option.time_from,
+                seconds=modality_timing.departure_margin_seconds,
+            ):
+                continue
+
+            departure_timings.append(modality_timing)
+            planned_options.add(id(modality_option))
+
+        departures.append(
+            DepartureOptions(
+                offset_minutes=offset_minutes,
+                leave_at=leave_at,
+                ranked_options=_rank_modality_timings(
+                    target_destination, departure_timings, config
+                ),
+            )
+        )
+
+    return departures, missing_options
+
+
 def main():
     destinations = set()
-    for destination, modality, modality_options in config_iterator(CONFIG):
+    for destination, modality, modality_options in config_iterator(get_loaded_config()):
         destinations.update([destination])
 
     for destination in destinations:
@@ -0,0 +1,272 @@
+# Short-lived caches of live TFL responses (e.g. arrivals), in-process or shared.
+
+from collections import OrderedDict
+from contextlib import contextmanager
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Iterable, Iterator, Optional
+
+from .common import ENV, ENV_LIVE_CACHE_PATH, LOGGER
+
+
+# TFL refreshes arrivals predictions roughly every 30s
+ARRIVALS_CACHE_TTL_SECONDS = 20
+ARRIVALS_CACHE_MAX_ENTRIES = 10_000
+
+# How long a worker may hold the right to refresh a key, and how long others
+# will wait on it before giving up and querying TFL themselves
+_SINGLE_FLIGHT_LEASE_SECONDS = 10
+_SINGLE_FLIGHT_WAIT_SECONDS = 5
+_SINGLE_FLIGHT_POLL_SECONDS = 0.02
+
+
+class TtlCache:
+    """Thread-safe, size-bounded cache whose entries expire after a TTL."""
+
+    def __init__(self, ttl_seconds: float, max_entries: int):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._entries: OrderedDict[str, tuple[float, Any]] = OrderedDict()
+        self._lock = threading.Lock()
+        # Key -> its refresh lock, and how many callers hold or wait on it (so
+        # we only keep locks for keys being refreshed)
+        self._flight_locks: dict[str, tuple[threading.Lock, int]] = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key: str) -> Optional[Any]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                return None
+
+            return value
+
+    def set(self, key: str, value: Any):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl_seconds, value)
+            self._entries.move_to_end(key)
+            # Evict the oldest-written entries once we're over capacity
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    @contextmanager
+    def single_flight(
+        self, key: str, max_wait_seconds: Optional[float] = None
+    ) -> Iterator[None]:
+        """Hold the right to refresh a key, so concurrent misses don't all query.
+
+        Waiters get in once the holder is done (having refreshed the key, all
+        going well), or after at most `max_wait_seconds` if given, so callers
+        should check the cache again once inside.
+        """
+        with self._lock:
+            flight_lock, n_callers = self._flight_locks.get(key, (threading.Lock(), 0))
+            self._flight_locks[key] = (flight_lock, n_callers + 1)
+
+        try:
+            # The holder is querying TFL, which can take a while, so (like with
+            # SqliteTtlCache) we give up waiting in time to query ourselves
+            acquired = flight_lock.acquire(
+                timeout=-1 if max_wait_seconds is None else max(0.0, max_wait_seconds)
+            )
+            try:
+                yield
+            finally:
+                if acquired:
+                    flight_lock.release()
+        finally:
+            with self._lock:
+                _, n_callers = self._flight_locks[key]
+                if n_callers == 1:
+                    del self._flight_locks[key]
+                else:
+                    self._flight_locks[key] = (flight_lock, n_callers - 1)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def reset_after_fork(self):
+        self.clear()
+        # Any held by the parent's threads would never be released here
+        self._flight_locks = {}
+
+    def export_entries(self) -> list[tuple[str, float, Any]]:
+        """Get the unexpired entries, each with when it expires (since the epoch)."""
+        # Monotonic times are meaningless to other processes, so convert
+        to_wall_clock = time.time() - time.monotonic()
+        with self._lock:
+            now = time.monotonic()
+            return [
+                (key, expires_at + to_wall_clock, value)
+                for key, (expires_at, value) in self._entries.items()
+                if expires_at >= now
+            ]
+
+    def import_entries(self, entries: Iterable[tuple[str, float, Any]]):
+        """Add entries from export_entries, bar those expired or already newer."""
+        to_monotonic = time.monotonic() - time.time()
+        with self._lock:
+            now = time.monotonic()
+            for key, expires_at, value in entries:
+                expires_at += to_monotonic
+                current_entry = self._entries.get(key)
+                if expires_at < now or (
+                    current_entry is not None and current_entry[0] >= expires_at
+                ):
+                    continue
+                self._entries[key] = (expires_at, value)
+
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+class SqliteTtlCache:
+    """TTL cache shared between processes through a SQLite database in WAL mode.
+
+    Single-flight locks are leases held in the database itself, so only one
+    worker across the fleet refreshes a given key at a time.
+    """
+
+    def __init__(self, path: os.PathLike, ttl_seconds: float, max_entries: int):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._local = threading.local()
+
+        with self._connection() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS entries "
+                "(key TEXT PRIMARY KEY, expires_at REAL, value TEXT)"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS locks "
+                "(key TEXT PRIMARY KEY, expires_at REAL)"
+            )
+
+    def _connection(self) -> sqlite3.Connection:
+        # Connections can't be shared across threads, or safely across a fork
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=_SINGLE_FLIGHT_WAIT_SECONDS)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def __len__(self):
+        return (
+            self._connection()
+            .execute(
+                "SELECT COUNT(*) FROM entries WHERE expires_at >= ?", (time.time(),)
+            )
+            .fetchone()[0]
+        )
+
+    def get(self, key: str) -> Optional[Any]:
+        row = (
+            self._connection()
+            .execute(
+                "SELECT value FROM entries WHERE key = ? AND expires_at >= ?",
+                (key, time.time()),
+            )
+            .fetchone()
+        )
+        return json.loads(row[0]) if row else None
+
+    def set(self, key: str, value: Any):
+        now = time.time()
+        with self._connection() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO entries VALUES (?, ?, ?)",
+                (key, now + self.ttl_seconds, json.dumps(value)),
+            )
+            # Expired entries are cheap to leave around, so only tidy up once
+            # we're over capacity
+            if conn.execute("SELECT COUNT(*) FROM entries").fetchone()[0] > (
+                self.max_entries
+            ):
+                conn.execute("DELETE FROM entries WHERE expires_at < ?", (now,))
+
+    def _try_acquire(self, key: str) -> bool:
+        now = time.time()
+        try:
+            with self._connection() as conn:
+                conn.execute(
+                    "DELETE FROM locks WHERE key = ? AND expires_at < ?", (key, now)
+                )
+                conn.execute(
+                    "INSERT INTO locks VALUES (?, ?)",
+                    (key, now + _SINGLE_FLIGHT_LEASE_SECONDS),
+                )
+            return True
+        except sqlite3.IntegrityError:
+            return False
+
+    @contextmanager
+    def single_flight(
+        self, key: str, max_wait_seconds: Optional[float] = None
+    ) -> Iterator[None]:
+        """Hold the fleet-wide right to refresh a key.
+
+        Waiters return as soon as the holder has refreshed the key (or after a
+        timeout, at most `max_wait_seconds` if given), so callers should check
+        the cache again once inside.
+        """
+        acquired = self._try_acquire(key)
+        wait_seconds = _SINGLE_FLIGHT_WAIT_SECONDS
+        if max_wait_seconds is not None:
+            wait_seconds = min(wait_seconds, max_wait_seconds)
+        give_up_at = time.time() + wait_seconds
+
+        while not acquired and self.get(key) is None and time.time() < give_up_at:
+            time.sleep(_SINGLE_FLIGHT_POLL_SECONDS)
+            acquired = self._try_acquire(key)
+
+        try:
+            yield
+        finally:
+            if acquired:
+                with self._connection() as conn:
+                    conn.execute("DELETE FROM locks WHERE key = ?", (key,))
+
+    def clear(self):
+        with self._connection() as conn:
+            conn.execute("DELETE FROM entries")
+            conn.execute("DELETE FROM locks")
+
+    def reset_after_fork(self):
+        # The shared data should survive, we just need fresh connections
+        self._local = threading.local()
+
+    def export_entries(self) -> list[tuple[str, float, Any]]:
+        # Entries already outlive the process, in the database
+        return []
+
+    def import_entries(self, entries: Iterable[tuple[str, float, Any]]):
+        pass
+
+
+def _make_arrivals_cache():
+    live_cache_path = ENV.get(ENV_LIVE_CACHE_PATH)
+
+    if live_cache_path:
+        LOGGER.info("Sharing live arrivals cache via %s", live_cache_path)
+        return SqliteTtlCache(
+            live_cache_path, ARRIVALS_CACHE_TTL_SECONDS, ARRIVALS_CACHE_MAX_ENTRIES
+        )
+    return TtlCache(ARRIVALS_CACHE_TTL_SECONDS, ARRIVALS_CACHE_MAX_ENTRIES)
+
+
+ARRIVALS_CACHE = _make_arrivals_cache()
@@ -0,0 +1,146 @@
+# Non-blocking logging: records are queued and written by a background thread.
+
+import atexit
+import json
+import logging
+from logging.handlers import QueueHandler, QueueListener
+import queue
+import random
+import sys
+from typing import Any, Optional, TextIO
+
+
+LOGGER_NAME = "goto_london"
+# Per-vehicle/per-modality messages logged on every request, which get sampled
+HOT_PATH_LOGGER_NAME = f"{LOGGER_NAME}.hot_path"
+
+_DEFAULT_LEVEL = "INFO"
+_DEFAULT_HOT_PATH_SAMPLE_RATE = 1.0
+_PLAIN_FORMAT = "%(levelname)s:%(name)s:%(message)s"
+# Beyond this many queued records, new ones are dropped rather than blocking
+_MAX_QUEUED_RECORDS = 10_000
+
+_TRACEBACK_FORMATTER = logging.Formatter()
+
+_LISTENER: Optional[QueueListener] = None
+_LOGGING_CONFIG: dict[str, Any] = {}
+_STREAM: TextIO = sys.stdout
+# Loggers we've set levels for, from the `levels` in config
+_CONFIGURED_LEVELS: set[str] = set()
+
+
+class JsonFormatter(logging.Formatter):
+    """Format records as one JSON object per line."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        log_entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            log_entry["exception"] = record.exc_text
+        return json.dumps(log_entry)
+
+
+class SamplingFilter(logging.Filter):
+    """Let through only a random sample of records."""
+
+    def __init__(self, sample_rate: float):
+        super().__init__()
+        self.sample_rate = sample_rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        return self.sample_rate >= 1.0 or random.random() < self.sample_rate
+
+
+class _DroppingQueueHandler(QueueHandler):
+    """Enqueue records without ever blocking, dropping them if the queue is full."""
+
+    dropped_records = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Leave formatting (even of the message) to the background writer. Only
+        # tracebacks are rendered now, as they hold on to live stack frames
+        if record.exc_info:
+            record.exc_text = _TRACEBACK_FORMATTER.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            _DroppingQueueHandler.dropped_records += 1
+
+
+def stop_logging():
+    """Flush any queued records and stop the background writer."""
+    global _LISTENER
+
+    if _LISTENER is not None:
+        _LISTENER.stop()
+        _LISTENER = None
+
+
+def configure_logging(
+    logging_config: Optional[dict[str, Any]] = None, stream: Optional[TextIO] = None
+):
+    """(Re-)configure queue-based logging from the `logging` section of config.
+
+    Supported keys are `json` (bool), `levels` (logger name -> level) and
+    `hot_path_sample_rate` (the share of hot path messages to keep).
+    """
+    global _LISTENER, _LOGGING_CONFIG, _STREAM
+
+    _LOGGING_CONFIG = logging_config or {}
+    _STREAM = stream or _STREAM
+    stop_logging()
+
+    log_queue = queue.Queue(maxsize=_MAX_QUEUED_RECORDS)
+    stream_handler = logging.StreamHandler(_STREAM)
+    stream_handler.setFormatter(
+        JsonFormatter()
+        if _LOGGING_CONFIG.get("json")
+        else logging.Formatter(_PLAIN_FORMAT)
+    )
+    _LISTENER = QueueListener(log_queue, stream_handler)
+    _LISTENER.start()
+
+    logger = logging.getLogger(LOGGER_NAME)
+    logger.handlers = [_DroppingQueueHandler(log_queue)]
+    logger.propagate = False
+    logger.setLevel(_DEFAULT_LEVEL)
+
+    hot_path_logger = logging.getLogger(HOT_PATH_LOGGER_NAME)
+    hot_path_logger.filters = [
+        SamplingFilter(
+            _LOGGING_CONFIG.get("hot_path_sample_rate", _DEFAULT_HOT_PATH_SAMPLE_RATE)
+        )
+    ]
+
+    # Loggers whose level has since been dropped from config go back to default
+    for logger_name in _CONFIGURED_LEVELS - set(_LOGGING_CONFIG.get("levels", {})):
+        logging.getLogger(logger_name).setLevel(
+            _DEFAULT_LEVEL if logger_name == LOGGER_NAME else logging.NOTSET
+        )
+    _CONFIGURED_LEVELS.clear()
+
+    for logger_name, level in _LOGGING_CONFIG.get("levels", {}).items():
+        logging.getLogger(logger_name).setLevel(level)
+        _CONFIGURED_LEVELS.add(logger_name)
+
+
+def restart_logging_after_fork():
+    """Start a fresh writer thread, as threads don't survive a fork."""
+    global _LISTENER
+
+    # The parent's listener thread doesn't exist in this process, so don't stop it
+    _LISTENER = None
+    configure_logging(_LOGGING_CONFIG)
+
+
+atexit.register(stop_logging)
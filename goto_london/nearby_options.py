@@ -0,0 +1,135 @@
+# Discover ModalityOptions from the stops near a journey's origin and destination.
+
+import math
+from typing import Any, get_args, Optional
+
+from .common import ModalityOption, TflModalitiesType
+from .stop_point_cacher import StopPointsInfo
+from .stop_point_dataset import DatasetStopPoint, StopPointDataset
+from .stop_point_grid import distance_metres
+
+
+DEFAULT_MAX_WALKING_MINUTES = 10
+# Each option means live arrivals to look up, so however many lines are nearby
+# only those quickest to walk to and from are kept
+DEFAULT_MAX_OPTIONS = 20
+WALKING_METRES_PER_MINUTE = 80
+
+# Streets rarely run in a straight line to where we're going
+_WALKING_DETOUR_FACTOR = 1.3
+# Bus stops tend to come in pairs on either side of the road, only one of which
+# is going our way, so consider a couple of the nearest stops for each line
+_MAX_STOPS_PER_LINE = 2
+_TFL_MODALITIES = set(get_args(TflModalitiesType))
+
+
+def walking_minutes(distance: float) -> int:
+    """Estimate how long it takes to walk a straight-line distance (in metres)."""
+    return math.ceil(distance * _WALKING_DETOUR_FACTOR / WALKING_METRES_PER_MINUTE)
+
+
+def _nearest_stops_per_line(
+    dataset: StopPointDataset, lat: float, lon: float, max_walking_minutes: int
+) -> dict[tuple[str, str], list[tuple[int, DatasetStopPoint]]]:
+    radius_metres = (
+        max_walking_minutes * WALKING_METRES_PER_MINUTE / _WALKING_DETOUR_FACTOR
+    )
+    stops_per_line: dict[tuple[str, str], list[tuple[int, DatasetStopPoint]]] = {}
+
+    for distance, stop_point in dataset.nearby(lat, lon, radius_metres):
+        for modality in _TFL_MODALITIES.intersection(stop_point.modes):
+            for line in stop_point.lines:
+                stops = stops_per_line.setdefault((modality, line), [])
+                # Lines can be listed more than once for a stop
+                if len(stops) < _MAX_STOPS_PER_LINE and all(
+                    stop.id != stop_point.id for _, stop in stops
+                ):
+                    stops.append((walking_minutes(distance), stop_point))
+
+    return stops_per_line
+
+
+def discover_modality_options(
+    dataset: StopPointDataset,
+    origin: tuple[float, float],
+    destination: tuple[float, float],
+    max_walking_minutes: int = DEFAULT_MAX_WALKING_MINUTES,
+    include_walk: bool = True,
+    max_options: int = DEFAULT_MAX_OPTIONS,
+) -> list[tuple[ModalityOption, Optional[StopPointsInfo]]]:
+    """Generate options for lines serving stops near both origin and destination.
+
+    Origin and destination are (lat, lon) pairs. Each option comes with the
+    StopPointsInfo needed to look up live arrivals, leaving the direction unset:
+    only vehicles that go on to reach the destination stop get ranked anyway.
+    Of those, the `max_options` with the least walking are kept (plus walking).
+    Needs a dataset with line info (e.g. TFL's, rather than NaPTAN's).
+    """
+    origin_stops = _nearest_stops_per_line(dataset, *origin, max_walking_minutes)
+    destination_stops = _nearest_stops_per_line(
+        dataset, *destination, max_walking_minutes
+    )
+
+    options: list[tuple[ModalityOption, Optional[StopPointsInfo]]] = []
+    if include_walk:
+        options.append(
+            (
+                ModalityOption(
+                    "walk",
+                    None,
+                    None,
+                    None,
+                    walking_minutes(distance_metres(*origin, *destination)),
+                    None,
+                ),
+                None,
+            )
+        )
+
+    # (line, from stop, to stop) -> option, so a line shared between modes (or
+    # listed twice) is only checked once
+    line_options: dict[tuple[str, str, str], tuple[ModalityOption, StopPointsInfo]] = {}
+    for (modality, line), from_stops in origin_stops.items():
+        for time_from, from_stop in from_stops:
+            for time_to, to_stop in destination_stops.get((modality, line), []):
+                if from_stop.id == to_stop.id:
+                    continue
+
+                line_options.setdefault(
+                    (line, from_stop.id, to_stop.id),
+                    (
+                        ModalityOption(
+                            modality,
+                            from_stop.name,
+                            to_stop.name,
+                            line,
+                            time_from,
+                            time_to,
+                        ),
+                        StopPointsInfo(from_stop.id, to_stop.id, line, None),
+                    ),
+                )
+
+    options.extend(
+        sorted(
+            line_options.values(),
+            key=lambda option: option[0].time_from + option[0].time_to,
+        )[:max_options]
+    )
+    return options
+
+
+def discover_modality_options_for_config(
+    dataset: StopPointDataset,
+    nearby_config: dict[str, Any],
+    include_walk: bool = True,
+) -> list[tuple[ModalityOption, Optional[StopPointsInfo]]]:
+    """Discover options from a destination's `nearby` config section."""
+    return discover_modality_options(
+        dataset,
+        tuple(nearby_config["origin"]),
+        tuple(nearby_config["destination"]),
+        nearby_config.get("max_walking_time", DEFAULT_MAX_WALKING_MINUTES),
+        include_walk,
+        nearby_config.get("max_options", DEFAULT_MAX_OPTIONS),
+    )
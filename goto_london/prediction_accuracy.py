@@ -0,0 +1,311 @@
+# Learn how far off TFL's arrival predictions are, per line and stop.
+
+from collections import OrderedDict
+import copy
+from dataclasses import dataclass, field
+import queue
+import threading
+import time
+from typing import Any, Iterable, Optional
+
+from .common import LOGGER
+
+
+# Errors are counted in buckets of this many seconds, up to +/- the max error
+_BUCKET_SECONDS = 15
+_MAX_ERROR_SECONDS = 600
+_N_BUCKETS = 2 * _MAX_ERROR_SECONDS // _BUCKET_SECONDS + 1
+
+# Errors are kept for a rolling window, made up of this many sub-windows
+DEFAULT_WINDOW_SECONDS = 60 * 60
+_N_SUB_WINDOWS = 6
+
+DEFAULT_MAX_TRACKED_ARRIVALS = 20_000
+DEFAULT_MAX_TRACKED_STOPS = 2_000
+# We take the last prediction made within this long of an arrival to be when it
+# actually arrived, as TFL doesn't tell us
+_OBSERVED_WITHIN_SECONDS = 90
+# How long after its predicted arrival we wait for any revised prediction
+_ARRIVAL_GRACE_SECONDS = 120
+# Only the first prediction made in each band of minutes-ahead is compared
+_HORIZON_BAND_SECONDS = 5 * 60
+_MAX_HORIZON_BANDS = 6
+# How often we check for tracked vehicles that have since arrived
+_SWEEP_INTERVAL_SECONDS = 30
+# Beyond this many unprocessed payloads, new ones are dropped
+_MAX_QUEUED_PAYLOADS = 1_000
+
+DEFAULT_MARGIN_QUANTILE = 0.9
+DEFAULT_MARGIN_MIN_SAMPLES = 20
+
+
+class RollingErrorHistogram:
+    """Histogram of prediction errors over a rolling window, in fixed memory.
+
+    The window is split into sub-windows, and the oldest sub-window is dropped
+    wholesale as time moves on. Quantiles are accurate to a bucket's width.
+    """
+
+    def __init__(self, window_seconds: float = DEFAULT_WINDOW_SECONDS):
+        self.sub_window_seconds = window_seconds / _N_SUB_WINDOWS
+        # Sub-window number -> error bucket counts
+        self._sub_windows: dict[int, list[int]] = {}
+
+    def _expire(self, now: float) -> int:
+        current = int(now // self.sub_window_seconds)
+        for sub_window in list(self._sub_windows):
+            if sub_window <= current - _N_SUB_WINDOWS:
+                del self._sub_windows[sub_window]
+        return current
+
+    def add(self, error_seconds: float, now: float):
+        current = self._expire(now)
+        counts = self._sub_windows.get(current)
+        if counts is None:
+            counts = self._sub_windows[current] = [0] * _N_BUCKETS
+
+        clamped_error = max(-_MAX_ERROR_SECONDS, min(_MAX_ERROR_SECONDS, error_seconds))
+        counts[round((clamped_error + _MAX_ERROR_SECONDS) / _BUCKET_SECONDS)] += 1
+
+    def counts(self, now: float) -> list[int]:
+        self._expire(now)
+        return [
+            sum(bucket) for bucket in zip([0] * _N_BUCKETS, *self._sub_windows.values())
+        ]
+
+    def quantile(self, q: float, now: float) -> tuple[int, Optional[float]]:
+        """Get the number of errors in the window, and their q-th quantile (if any)."""
+        counts = self.counts(now)
+        n_errors = sum(counts)
+        if not n_errors:
+            return 0, None
+
+        seen = 0
+        for bucket, count in enumerate(counts):
+            seen += count
+            if seen >= q * n_errors:
+                break
+        return n_errors, bucket * _BUCKET_SECONDS - _MAX_ERROR_SECONDS
+
+
+@dataclass
+class _TrackedArrival:
+    # Horizon band -> the first arrival time predicted in it
+    predicted_arrivals: dict[int, float] = field(default_factory=dict)
+    # The latest prediction, and when it was made
+    latest_arrival: float = 0.0
+    latest_seen_at: float = 0.0
+
+
+# The arrivals being tracked, and the errors learnt per (line, stop)
+TrackerStateType = tuple[
+    dict[tuple[str, str, str], _TrackedArrival],
+    dict[tuple[str, str], RollingErrorHistogram],
+]
+
+
+@dataclass
+class PredictionMargins:
+    """How early or late vehicles might be, q of the time, in seconds."""
+
+    early_seconds: float = 0.0
+    late_seconds: float = 0.0
+
+
+class PredictionAccuracyTracker:
+    """Compares the arrivals TFL predicted to those it later observed.
+
+    Arrivals payloads are handed over with `submit` and processed by a
+    background thread, so tracking adds nothing to the request path. Both the
+    vehicles being tracked and the (line, stop)s with error histograms are
+    capped, dropping whichever was least recently updated.
+    """
+
+    def __init__(
+        self,
+        window_seconds: float = DEFAULT_WINDOW_SECONDS,
+        max_tracked_arrivals: int = DEFAULT_MAX_TRACKED_ARRIVALS,
+        max_tracked_stops: int = DEFAULT_MAX_TRACKED_STOPS,
+    ):
+        self.window_seconds = window_seconds
+        self.max_tracked_arrivals = max_tracked_arrivals
+        self.max_tracked_stops = max_tracked_stops
+        self.dropped_payloads = 0
+        # (vehicle id, line, naptan id) -> its predictions so far
+        self._arrivals: OrderedDict[
+            tuple[str, str, str], _TrackedArrival
+        ] = OrderedDict()
+        # (line, naptan id) -> errors (observed - predicted arrival) in seconds
+        self._errors: OrderedDict[
+            tuple[str, str], RollingErrorHistogram
+        ] = OrderedDict()
+        self._last_swept = 0.0
+        self._lock = threading.Lock()
+        self._queue: Optional[queue.Queue] = None
+        self._thread: Optional[threading.Thread] = None
+
+    def __len__(self):
+        return len(self._errors)
+
+    def submit(self, predictions: list[dict[str, Any]]):
+        """Queue an arrivals payload to be tracked, without blocking."""
+        if self._thread is None or not self._thread.is_alive():
+            self._start()
+
+        try:
+            self._queue.put_nowait(predictions)
+        except queue.Full:
+            self.dropped_payloads += 1
+
+    def _start(self):
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._queue = queue.Queue(maxsize=_MAX_QUEUED_PAYLOADS)
+            self._thread = threading.Thread(
+                target=self._run, name="prediction-accuracy", daemon=True
+            )
+            self._thread.start()
+
+    def reset_after_fork(self):
+        # The parent's thread doesn't exist in this process; start afresh on submit
+        self._thread = None
+
+    def _run(self):
+        while True:
+            predictions = self._queue.get()
+            try:
+                self.observe(predictions)
+            except Exception as e:
+                LOGGER.warning("Failed to track prediction accuracy: %s", e)
+
+    def observe(
+        self, predictions: Iterable[dict[str, Any]], now: Optional[float] = None
+    ):
+        """Track an arrivals payload, and record errors for vehicles since arrived."""
+        # Only needed once arrivals come in, so spare the import on startup
+        import arrow
+
+        now = time.time() if now is None else now
+
+        with self._lock:
+            for prediction in predictions:
+                key = (
+                    prediction.get("vehicleId"),
+                    prediction.get("lineName"),
+                    prediction.get("naptanId"),
+                )
+                if None in key or "expectedArrival" not in prediction:
+                    continue
+
+                predicted_arrival = arrow.get(prediction["expectedArrival"]).timestamp()
+                predicted_at = (
+                    arrow.get(prediction["timestamp"]).timestamp()
+                    if "timestamp" in prediction
+                    else now
+                )
+
+                tracked_arrival = self._arrivals.get(key)
+                if tracked_arrival is None:
+                    tracked_arrival = self._arrivals[key] = _TrackedArrival()
+                self._arrivals.move_to_end(key)
+
+                band = min(
+                    int(
+                        max(0.0, predicted_arrival - predicted_at)
+                        // _HORIZON_BAND_SECONDS
+                    ),
+                    _MAX_HORIZON_BANDS - 1,
+                )
+                tracked_arrival.predicted_arrivals.setdefault(band, predicted_arrival)
+                if predicted_at >= tracked_arrival.latest_seen_at:
+                    tracked_arrival.latest_arrival = predicted_arrival
+                    tracked_arrival.latest_seen_at = predicted_at
+
+            while len(self._arrivals) > self.max_tracked_arrivals:
+                self._arrivals.popitem(last=False)
+
+            if now - self._last_swept >= _SWEEP_INTERVAL_SECONDS:
+                self._record_arrived(now)
+                self._last_swept = now
+
+    def _record_arrived(self, now: float):
+        for key, tracked_arrival in list(self._arrivals.items()):
+            if tracked_arrival.latest_arrival + _ARRIVAL_GRACE_SECONDS > now:
+                continue
+            del self._arrivals[key]
+
+            # Unless we saw it shortly before it arrived, we don't know when it did
+            if (
+                tracked_arrival.latest_arrival - tracked_arrival.latest_seen_at
+                > _OBSERVED_WITHIN_SECONDS
+            ):
+                continue
+
+            _, line, stop_point_id = key
+            errors = self._errors.get((line, stop_point_id))
+            if errors is None:
+                errors = self._errors[(line, stop_point_id)] = RollingErrorHistogram(
+                    self.window_seconds
+                )
+            self._errors.move_to_end((line, stop_point_id))
+
+            for predicted_arrival in tracked_arrival.predicted_arrivals.values():
+                errors.add(tracked_arrival.latest_arrival - predicted_arrival, now)
+
+        while len(self._errors) > self.max_tracked_stops:
+            self._errors.popitem(last=False)
+
+    def export_state(self) -> TrackerStateType:
+        """Get a copy of the arrivals being tracked, and the errors learnt so far."""
+        with self._lock:
+            return copy.deepcopy((dict(self._arrivals), dict(self._errors)))
+
+    def import_state(self, state: TrackerStateType):
+        """Add arrivals and errors from export_state, bar any we already have.
+
+        So when importing several states, import the most recent first.
+        """
+        # Everything's timed since the epoch, so carries over between processes
+        arrivals, errors = state
+        with self._lock:
+            for key, tracked_arrival in arrivals.items():
+                self._arrivals.setdefault(key, tracked_arrival)
+            for key, histogram in errors.items():
+                self._errors.setdefault(key, histogram)
+
+            while len(self._arrivals) > self.max_tracked_arrivals:
+                self._arrivals.popitem(last=False)
+            while len(self._errors) > self.max_tracked_stops:
+                self._errors.popitem(last=False)
+
+    def margins(
+        self,
+        line: str,
+        stop_point_id: str,
+        quantile: float = DEFAULT_MARGIN_QUANTILE,
+        min_samples: int = DEFAULT_MARGIN_MIN_SAMPLES,
+        now: Optional[float] = None,
+    ) -> PredictionMargins:
+        """How much earlier or later than predicted vehicles reach a stop.
+
+        The margins cover `quantile` of arrivals there, and are both zero until
+        we've seen at least `min_samples` of them.
+        """
+        now = time.time() if now is None else now
+
+        with self._lock:
+            errors = self._errors.get((line, stop_point_id))
+            if errors is None:
+                return PredictionMargins()
+            n_errors, late_error = errors.quantile(quantile, now)
+            _, early_error = errors.quantile(1 - quantile, now)
+
+        if n_errors < min_samples:
+            return PredictionMargins()
+        return PredictionMargins(
+            early_seconds=max(0.0, -early_error), late_seconds=max(0.0, late_error)
+        )
+
+
+PREDICTION_ACCURACY = PredictionAccuracyTracker()
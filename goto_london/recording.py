@@ -0,0 +1,235 @@
+# Record upstream TFL responses to disk, for replaying later (see replay.py).
+
+import atexit
+from dataclasses import asdict, dataclass
+import json
+import os
+import queue
+import threading
+import time
+from typing import Any, Iterator, Optional
+import zlib
+
+from .common import ENV, ENV_RECORDING_DIR, LOGGER
+
+
+# Responses are compressed together in chunks of this many
+DEFAULT_CHUNK_SIZE = 256
+# Beyond this many full chunks waiting to be written, new ones are dropped
+_MAX_QUEUED_CHUNKS = 16
+
+_LOG_SUFFIX = ".log"
+_INDEX_SUFFIX = ".idx"
+
+
+@dataclass
+class RecordedResponse:
+    # Seconds since the epoch, when the response arrived
+    timestamp: float
+    endpoint: str
+    params: Optional[dict[str, Any]]
+    status_code: int
+    body: str
+    latency_seconds: float
+
+
+class ResponseRecorder:
+    """Append responses to a compressed, chunked log, with an index of its chunks.
+
+    Each process writes its own `<pid>.log` (the chunks) and `<pid>.idx` (one
+    JSON line per chunk, giving its offset, length and time span) in the
+    recording directory, so forked workers never interleave their writes. Full
+    chunks are compressed and written by a background thread, off the request
+    path.
+    """
+
+    def __init__(
+        self, recording_dir: os.PathLike, chunk_size: int = DEFAULT_CHUNK_SIZE
+    ):
+        self.recording_dir = recording_dir
+        self.chunk_size = chunk_size
+        self._buffer: list[RecordedResponse] = []
+        self.dropped_chunks = 0
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        # Held while writing, so the writer and flush never interleave chunks
+        self._write_lock = threading.Lock()
+        self._queue: Optional[queue.Queue] = None
+        self._thread: Optional[threading.Thread] = None
+        os.makedirs(recording_dir, exist_ok=True)
+
+    def record(
+        self,
+        endpoint: str,
+        params: Optional[dict[str, Any]],
+        status_code: int,
+        body: str,
+        latency_seconds: float,
+    ):
+        recorded_response = RecordedResponse(
+            time.time(), endpoint, params, status_code, body, latency_seconds
+        )
+
+        with self._lock:
+            if self._pid != os.getpid():
+                # Responses buffered before a fork belong to the parent, as does
+                # the writer thread
+                self._buffer = []
+                self._thread = None
+                self._pid = os.getpid()
+
+            self._buffer.append(recorded_response)
+            if len(self._buffer) < self.chunk_size:
+                return
+
+            recorded_responses, self._buffer = self._buffer, []
+            self._start()
+            try:
+                self._queue.put_nowait(recorded_responses)
+            except queue.Full:
+                self.dropped_chunks += 1
+
+    def _start(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._queue = queue.Queue(maxsize=_MAX_QUEUED_CHUNKS)
+        self._thread = threading.Thread(
+            target=self._run, name="response-recorder", daemon=True
+        )
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            recorded_responses = self._queue.get()
+            try:
+                self._write(recorded_responses)
+            except OSError as e:
+                LOGGER.warning("Failed to write recorded responses: %s", e)
+            finally:
+                self._queue.task_done()
+
+    def _write(self, recorded_responses: list[RecordedResponse]):
+        chunk = zlib.compress(
+            "\n".join(
+                json.dumps(asdict(recorded_response))
+                for recorded_response in recorded_responses
+            ).encode("utf-8")
+        )
+        log_path = os.path.join(self.recording_dir, f"{self._pid}{_LOG_SUFFIX}")
+
+        with self._write_lock:
+            with open(log_path, "ab") as f:
+                offset = f.tell()
+                f.write(chunk)
+            # The chunk is only indexed once it's fully written
+            with open(
+                os.path.join(self.recording_dir, f"{self._pid}{_INDEX_SUFFIX}"), "a"
+            ) as f:
+                f.write(
+                    json.dumps(
+                        {
+                            "offset": offset,
+                            "length": len(chunk),
+                            "count": len(recorded_responses),
+                            "first_timestamp": recorded_responses[0].timestamp,
+                            "last_timestamp": recorded_responses[-1].timestamp,
+                        }
+                    )
+                    + "\n"
+                )
+
+    def flush(self):
+        """Write out everything recorded so far, waiting until it's written."""
+        with self._lock:
+            if self._pid != os.getpid():
+                return
+            recorded_responses, self._buffer = self._buffer, []
+            writer_queue = (
+                self._queue
+                if self._thread is not None and self._thread.is_alive()
+                else None
+            )
+
+        # Written here rather than by the writer thread, which may not be around
+        # to do it (e.g. when exiting), but only after anything queued before it
+        if writer_queue is not None:
+            writer_queue.join()
+        if recorded_responses:
+            self._write(recorded_responses)
+
+
+def _overlaps(
+    first_timestamp: float,
+    last_timestamp: float,
+    start_timestamp: Optional[float],
+    end_timestamp: Optional[float],
+) -> bool:
+    return (start_timestamp is None or last_timestamp >= start_timestamp) and (
+        end_timestamp is None or first_timestamp <= end_timestamp
+    )
+
+
+def _read_log(
+    index_path: os.PathLike,
+    log_path: os.PathLike,
+    start_timestamp: Optional[float],
+    end_timestamp: Optional[float],
+) -> Iterator[RecordedResponse]:
+    with open(index_path, "r") as index_file, open(log_path, "rb") as log_file:
+        for line in index_file:
+            chunk = json.loads(line)
+            # Skip whole chunks outside the window without decompressing them
+            if not _overlaps(
+                chunk["first_timestamp"],
+                chunk["last_timestamp"],
+                start_timestamp,
+                end_timestamp,
+            ):
+                continue
+
+            log_file.seek(chunk["offset"])
+            raw_chunk = zlib.decompress(log_file.read(chunk["length"]))
+            for raw_response in raw_chunk.decode("utf-8").split("\n"):
+                recorded_response = RecordedResponse(**json.loads(raw_response))
+                if _overlaps(
+                    recorded_response.timestamp,
+                    recorded_response.timestamp,
+                    start_timestamp,
+                    end_timestamp,
+                ):
+                    yield recorded_response
+
+
+def read_recording(
+    recording_dir: os.PathLike,
+    start_timestamp: Optional[float] = None,
+    end_timestamp: Optional[float] = None,
+) -> Iterator[RecordedResponse]:
+    """Read back recorded responses, optionally within a time window.
+
+    Responses come in order for each recording process, not overall.
+    """
+    for file_name in sorted(os.listdir(recording_dir)):
+        if file_name.endswith(_INDEX_SUFFIX):
+            yield from _read_log(
+                os.path.join(recording_dir, file_name),
+                os.path.join(
+                    recording_dir, file_name[: -len(_INDEX_SUFFIX)] + _LOG_SUFFIX
+                ),
+                start_timestamp,
+                end_timestamp,
+            )
+
+
+def _make_recorder() -> Optional[ResponseRecorder]:
+    recording_dir = ENV.get(ENV_RECORDING_DIR)
+    if not recording_dir:
+        return None
+
+    LOGGER.info("Recording TFL responses to %s", recording_dir)
+    recorder = ResponseRecorder(recording_dir)
+    atexit.register(recorder.flush)
+    return recorder
+
+
+RECORDER = _make_recorder()
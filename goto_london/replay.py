@@ -0,0 +1,234 @@
+# Replay recorded TFL responses (see recording.py), e.g. to benchmark ranking.
+
+import argparse
+from bisect import bisect_right
+from concurrent.futures import ThreadPoolExecutor
+import json
+import threading
+import time
+from typing import Any, Iterable, Optional
+from urllib.parse import parse_qsl, unquote, urlencode, urlsplit
+
+import arrow
+import requests as rq
+from requests.adapters import HTTPAdapter
+
+from .recording import read_recording, RecordedResponse
+
+
+# Payload fields holding times, which we shift so predictions stay in the future
+_TIMESTAMP_KEYS = ("expectedArrival", "timestamp", "timeToLive")
+_CREDENTIAL_PARAMS = ("app_id", "app_key")
+
+
+def _request_key(endpoint: str, params: Optional[dict[str, Any]]) -> str:
+    params = {
+        key: value
+        for key, value in (params or {}).items()
+        if key not in _CREDENTIAL_PARAMS
+    }
+    return unquote(endpoint) + "?" + urlencode(sorted(params.items()))
+
+
+def _shift_timestamps(body: str, shift_seconds: float) -> str:
+    try:
+        payload = json.loads(body)
+    except ValueError:
+        return body
+    if not isinstance(payload, list):
+        return body
+
+    for item in payload:
+        for key in _TIMESTAMP_KEYS:
+            if isinstance(item, dict) and key in item:
+                item[key] = (
+                    arrow.get(item[key]).shift(seconds=shift_seconds).isoformat()
+                )
+
+    return json.dumps(payload)
+
+
+class ReplayAdapter(HTTPAdapter):
+    """Answers requests from a recording, rather than over the network.
+
+    Mount it on a session to replay at real (speed=1) or accelerated speed.
+    Each request gets the response recorded for it most recently as of the
+    replay clock, after the recorded latency (scaled by speed). Timestamps in
+    the payload are shifted to be relative to now, so predictions stay usable.
+    """
+
+    def __init__(
+        self,
+        recorded_responses: Iterable[RecordedResponse],
+        speed: float = 1,
+        simulate_latency: bool = True,
+    ):
+        super().__init__()
+        self.speed = speed
+        self.simulate_latency = simulate_latency
+        self.request_count = 0
+        self.miss_count = 0
+        self._lock = threading.Lock()
+
+        self._responses: dict[str, list[RecordedResponse]] = {}
+        for recorded_response in sorted(
+            recorded_responses, key=lambda response: response.timestamp
+        ):
+            self._responses.setdefault(
+                _request_key(recorded_response.endpoint, recorded_response.params), []
+            ).append(recorded_response)
+        self._timestamps = {
+            key: [response.timestamp for response in responses]
+            for key, responses in self._responses.items()
+        }
+
+        timestamps = [
+            timestamp
+            for key_timestamps in self._timestamps.values()
+            for timestamp in key_timestamps
+        ]
+        self.recording_start = min(timestamps, default=0)
+        # How long the recording takes to replay, at our speed
+        self.duration_seconds = (
+            max(timestamps, default=0) - self.recording_start
+        ) / speed
+        self.restart()
+
+    def restart(self):
+        """Start replaying from the beginning of the recording."""
+        self._replay_start = time.time()
+
+    def replay_clock(self) -> float:
+        """The time in the recording that we've replayed up to."""
+        return self.recording_start + (time.time() - self._replay_start) * self.speed
+
+    def _find(self, key: str) -> Optional[RecordedResponse]:
+        responses = self._responses.get(key)
+        if not responses:
+            return None
+
+        # Fall back to the first response if it was recorded later on
+        idx = bisect_right(self._timestamps[key], self.replay_clock()) - 1
+        return responses[max(idx, 0)]
+
+    def send(self, request: rq.PreparedRequest, **kwargs) -> rq.Response:
+        url = urlsplit(request.url)
+        recorded_response = self._find(
+            _request_key(url.path.lstrip("/"), dict(parse_qsl(url.query)))
+        )
+
+        response = rq.Response()
+        response.request = request
+        response.url = request.url
+
+        with self._lock:
+            self.request_count += 1
+            if recorded_response is None:
+                self.miss_count += 1
+
+        if recorded_response is None:
+            response.status_code = 404
+            response._content = b'{"message": "Not in recording"}'
+            return response
+
+        if self.simulate_latency:
+            time.sleep(recorded_response.latency_seconds / self.speed)
+
+        response.status_code = recorded_response.status_code
+        response._content = _shift_timestamps(
+            recorded_response.body,
+            # As if the response had been recorded just now
+            time.time() - recorded_response.timestamp,
+        ).encode("utf-8")
+        return response
+
+
+def _percentile(sorted_values: list[float], percentile: float) -> float:
+    if not sorted_values:
+        return 0.0
+    return sorted_values[
+        min(len(sorted_values) - 1, int(len(sorted_values) * percentile))
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark ranking against a recording of TFL responses."
+    )
+    parser.add_argument("recording_dir")
+    parser.add_argument(
+        "--speed", type=float, default=1, help="replay speed (default: real time)"
+    )
+    parser.add_argument(
+        "--concurrency", type=int, default=4, help="rankings to run at once"
+    )
+    parser.add_argument(
+        "--destination",
+        action="append",
+        help="destination to rank (repeatable, default: all in config)",
+    )
+    parser.add_argument(
+        "--no-latency",
+        action="store_true",
+        help="answer immediately, rather than after the recorded latency",
+    )
+    args = parser.parse_args()
+
+    # Import late, so that nothing is loaded before the replay is set up
+    from .destination_ranker import (
+        get_loaded_config,
+        rank_options_for_destination_within_deadline,
+    )
+    from .tfl_api import get_session
+
+    adapter = ReplayAdapter(
+        read_recording(args.recording_dir), args.speed, not args.no_latency
+    )
+    get_session().mount("https://", adapter)
+    destinations = args.destination or list(get_loaded_config()["destinations"])
+
+    latencies: list[float] = []
+    errors: list[Exception] = []
+    requests_before = adapter.request_count
+    adapter.restart()
+    stop_at = time.monotonic() + adapter.duration_seconds
+
+    def run_rankings():
+        # Always rank each destination at least once
+        while True:
+            for destination in destinations:
+                start = time.perf_counter()
+                try:
+                    rank_options_for_destination_within_deadline(destination)
+                except Exception as e:
+                    errors.append(e)
+                latencies.append(time.perf_counter() - start)
+
+            if time.monotonic() >= stop_at:
+                return
+
+    print(
+        f"Replaying {args.recording_dir} at {args.speed}x "
+        f"({adapter.duration_seconds:.0f}s) with {args.concurrency} concurrent rankings"
+    )
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        for _ in range(args.concurrency):
+            executor.submit(run_rankings)
+
+    latencies.sort()
+    upstream_requests = adapter.request_count - requests_before
+    print(f"Rankings: {len(latencies)} ({len(errors)} failed)")
+    for percentile in (0.5, 0.95, 0.99):
+        print(
+            f"p{percentile * 100:.0f} latency: "
+            f"{_percentile(latencies, percentile) * 1000:.1f}ms"
+        )
+    print(
+        f"Upstream requests: {upstream_requests} "
+        f"({upstream_requests / max(len(latencies), 1):.2f} per ranking, "
+        f"{adapter.miss_count} not in recording)"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,141 @@
+# Production (multi-worker, pre-forking) server for the webapp.
+
+import argparse
+import multiprocessing
+import os
+
+from gunicorn.app.base import BaseApplication
+
+from .common import LOGGER
+from .live_cache import ARRIVALS_CACHE
+from .log import restart_logging_after_fork
+from .prediction_accuracy import PREDICTION_ACCURACY
+from .tfl_api import reset_hedging, reset_session
+from .warm_start import (
+    get_warm_start_path,
+    load_snapshots,
+    merge_snapshots,
+    restore_snapshots,
+    save_snapshot,
+    WarmStartSnapshot,
+)
+
+
+ENV_WORKERS = "GOTO_WORKERS"
+ENV_BIND = "GOTO_BIND"
+ENV_THREADS = "GOTO_THREADS"
+DEFAULT_BIND = "0.0.0.0:8000"
+# Threaded workers serve several requests at once, so admission control has
+# something to queue (or shed), and subscriptions don't tie up a whole worker
+DEFAULT_THREADS = 16
+
+# Collected by the master before each fork, for the new worker to restore from
+_WARM_START_SNAPSHOTS: list[WarmStartSnapshot] = []
+
+
+def _default_workers() -> int:
+    return int(os.environ.get(ENV_WORKERS, multiprocessing.cpu_count() * 2 + 1))
+
+
+def _pre_fork(server, worker):
+    global _WARM_START_SNAPSHOTS
+
+    # Take in whatever's been saved since we last looked, including by workers
+    # that have exited since (e.g. after max_requests), so that new ones (at
+    # startup, replacing others, or after a HUP) restore the latest state.
+    # Saved files are removed as they're loaded, so they don't pile up
+    warm_start_path = get_warm_start_path()
+    if warm_start_path:
+        _WARM_START_SNAPSHOTS = merge_snapshots(
+            load_snapshots(warm_start_path), _WARM_START_SNAPSHOTS
+        )
+
+
+def _post_fork(server, worker):
+    # Anything holding sockets or live data mustn't be shared between workers
+    reset_session()
+    # Room for each of the worker's threads to have a call and its hedge in flight
+    reset_hedging(2 * server.cfg.threads)
+    ARRIVALS_CACHE.reset_after_fork()
+    PREDICTION_ACCURACY.reset_after_fork()
+    restart_logging_after_fork()
+    # Each worker takes what's still fresh from the snapshots collected for it
+    restore_snapshots(_WARM_START_SNAPSHOTS)
+    LOGGER.info("Worker %s ready", worker.pid)
+
+
+def _worker_exit(server, worker):
+    warm_start_path = get_warm_start_path()
+    if warm_start_path:
+        try:
+            save_snapshot(warm_start_path)
+        except OSError as e:
+            LOGGER.warning("Failed to save warm start snapshot: %s", e)
+
+
+def _on_reload(server):
+    # Re-read config and the StopPoint cache in the master so that new workers
+    # (forked after a HUP) pick them up
+    from .destination_ranker import reload_config_and_cache
+
+    reload_config_and_cache()
+    LOGGER.info("Reloaded config and StopPoint cache")
+
+
+class GotoLondonServer(BaseApplication):
+    """Gunicorn application that loads config and caches once, before forking.
+
+    Loading in the master means workers share those pages copy-on-write, and
+    come up warm. Send the master a HUP for a graceful reload.
+    """
+
+    def __init__(self, workers: int, bind: str, threads: int = DEFAULT_THREADS):
+        self.options = {
+            "workers": workers,
+            "worker_class": "gthread" if threads > 1 else "sync",
+            "threads": threads,
+            "bind": bind,
+            "preload_app": True,
+            "pre_fork": _pre_fork,
+            "post_fork": _post_fork,
+            "on_reload": _on_reload,
+            "worker_exit": _worker_exit,
+        }
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        # Defer importing the app until gunicorn is ready to (pre)load it
+        from .app import app
+        from .destination_ranker import reload_config_and_cache
+
+        # Warm up in the master, so that workers share it all copy-on-write
+        reload_config_and_cache()
+        return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve the GoTo London webapp.")
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=_default_workers(),
+        help=f"number of worker processes (default ${ENV_WORKERS} or 2 * CPUs + 1)",
+    )
+    parser.add_argument(
+        "--bind",
+        default=os.environ.get(ENV_BIND, DEFAULT_BIND),
+        help=f"address to listen on (default ${ENV_BIND} or {DEFAULT_BIND})",
+    )
+    parser.add_argument(
+        "--threads",
+        type=int,
+        default=int(os.environ.get(ENV_THREADS, DEFAULT_THREADS)),
+        help=f"threads per worker (default ${ENV_THREADS} or {DEFAULT_THREADS})",
+    )
+    args = parser.parse_args()
+
+    GotoLondonServer(workers=args.workers, bind=args.bind, threads=args.threads).run()
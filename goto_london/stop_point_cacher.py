@@ -1,23 +1,34 @@
 # Search and cache StopPoints from TFL based on the stop name.
 
+import argparse
 from collections import defaultdict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 import hashlib
 import json
 import os
-from typing import Any, Iterable, Literal, Union
+import sys
+import tempfile
+import threading
+import time
+from typing import Any, Iterable, Literal, Optional, TYPE_CHECKING, Union
 
 from mashumaro import DataClassDictMixin
-import requests as rq
 
 from .common import (
     config_iterator,
-    get_config,
+    LOGGER,
     ModalityOption,
+    SHARED_STOP_POINT_CACHE_NAME,
     STOP_POINT_CACHE_NAME,
+    STOP_POINT_DATASET_NAME,
     TflModalitiesType,
 )
-from .tfl_api import TflApi
+from .compiled_config import load_compiled_config, save_compiled_config
+from .stop_point_dataset import load_stop_point_dataset, StopPointDataset
+
+if TYPE_CHECKING:
+    from .tfl_api import TflApi
 
 
 # Needs to be hashable for set, so not a dataclass
@@ -41,11 +52,37 @@ _STOP_POINTS_CACHE_TYPE = dict[
 
 _CONFIG_TYPE = dict[str, Any]
 
+DEFAULT_WARM_UP_WORKERS = 8
+
+
+@dataclass
+class StopLinePairWarmUpResult:
+    """Outcome of resolving a single StopLinePair against the TFL API."""
+
+    modality: TflModalitiesType
+    stop_line_pair: StopLinePair
+    stop_points_info: Optional[StopPointsInfo]
+    error: Optional[Exception]
+    duration_seconds: float
+    api_calls: int
+
 
 class CacheException(Exception):
     pass
 
 
+class CacheWarmUpException(CacheException):
+    def __init__(self, failures: list[StopLinePairWarmUpResult]):
+        self.failures = failures
+        self.message = (
+            f"Failed to resolve {len(failures)} StopLinePair(s): "
+            + "; ".join(str(failure.error) for failure in failures)
+        )
+
+    def __str__(self):
+        return self.message
+
+
 class StopPointNotFoundException(Exception):
     def __init__(self, stop_point, modality, line):
         self.message = (
@@ -73,6 +110,10 @@ def _get_config_hash(config: _CONFIG_TYPE) -> str:
     return hashlib.md5(str(config).encode("utf-8")).hexdigest()
 
 
+def _get_cache_key(from_stop: str, to_stop: str, line: str) -> str:
+    return f"{from_stop} - {to_stop} - {line}"
+
+
 def _build_unique_stop_line_pairs(
     config_iterator: Iterable[tuple[str, TflModalitiesType, ModalityOption]]
 ) -> dict[TflModalitiesType, set[StopLinePair]]:
@@ -100,7 +141,7 @@ def _get_stop_point_id(
     get_detail: bool,
     modality: TflModalitiesType,
     stop_line_pair: StopLinePair,
-    api: TflApi,
+    api: "TflApi",
 ) -> str:
     if get_detail:
         search_response = api.get_stop_point_detail(search_term)
@@ -132,60 +173,153 @@ def _get_stop_point_id(
     return stop_point_id
 
 
-def _get_tfl_stop_points(
-    unique_stops: dict[TflModalitiesType, set[StopLinePair]]
-) -> dict[TflModalitiesType, dict[str, StopPointsInfo]]:
+def _get_stop_points_info_for_pair(
+    modality: TflModalitiesType,
+    stop_line_pair: StopLinePair,
+    api: "TflApi",
+    dataset: Optional[StopPointDataset] = None,
+) -> StopPointsInfo:
+    """Resolve the StopPoint IDs and direction of travel for one StopLinePair."""
+    # requests (and so TflApi) is slow to import, and isn't needed when the cache
+    # is already up to date, so is only imported where it's used
+    import requests as rq
+
+    stop_point_ids: list[str, str] = []
+    # Ordered from_dest, to_dest
+    for stop in (stop_line_pair.from_stop, stop_line_pair.to_stop):
+        # Prefer resolving stops offline, falling back to the live API when
+        # the stop isn't in our dataset
+        stop_point_id = (
+            dataset.find_stop_point_id(stop, modality, stop_line_pair.line)
+            if dataset is not None
+            else None
+        )
+        if stop_point_id:
+            stop_point_ids.append(stop_point_id)
+            continue
+
+        stop_point_id = _get_stop_point_id(
+            search_term=stop,
+            get_detail=False,
+            modality=modality,
+            stop_line_pair=stop_line_pair,
+            api=api,
+        )
+
+        # If the modality is 'bus' then we can be confident that we have the right ID.
+        # That's because the stop IDs are direction-specific
+        if modality == "bus":
+            stop_point_ids.append(stop_point_id)
+        # Otherwise (for tube) we need to get one more level of detail
+        # to confirm the modality-specific id
+        else:
+            stop_point_id = _get_stop_point_id(
+                search_term=stop_point_id,
+                get_detail=True,
+                modality=modality,
+                stop_line_pair=stop_line_pair,
+                api=api,
+            )
+            stop_point_ids.append(stop_point_id)
+
+    # Get the canonical direction of travel between the stop points
+    try:
+        direction = api.get_direction_between_stop_points(*stop_point_ids)
+    except rq.exceptions.HTTPError:
+        raise StopPointsDirectionNotFoundException(
+            stop_line_pair.from_stop, stop_line_pair.to_stop, *stop_point_ids
+        )
+
+    return StopPointsInfo(
+        stop_point_ids[0], stop_point_ids[1], stop_line_pair.line, direction
+    )
+
+
+def _warm_up_stop_line_pair(
+    modality: TflModalitiesType,
+    stop_line_pair: StopLinePair,
+    dataset: Optional[StopPointDataset] = None,
+) -> StopLinePairWarmUpResult:
+    import requests as rq
+
+    from .tfl_api import TflApi
+
+    # One client per pair so that call counts can be attributed to the pair
     api = TflApi()
-    tfl_stop_points: _STOP_POINTS_CACHE_TYPE = dict()
+    start = time.perf_counter()
 
-    for modality, stop_line_pairs in unique_stops.items():
+    try:
+        stop_points_info = _get_stop_points_info_for_pair(
+            modality, stop_line_pair, api, dataset
+        )
+        error = None
+    except (
+        StopPointNotFoundException,
+        StopPointsDirectionNotFoundException,
+        rq.exceptions.RequestException,
+    ) as e:
+        stop_points_info = None
+        error = e
+
+    return StopLinePairWarmUpResult(
+        modality=modality,
+        stop_line_pair=stop_line_pair,
+        stop_points_info=stop_points_info,
+        error=error,
+        duration_seconds=time.perf_counter() - start,
+        api_calls=api.call_count,
+    )
+
+
+def _warm_up_stop_line_pairs(
+    unique_stops: dict[TflModalitiesType, set[StopLinePair]],
+    max_workers: int = DEFAULT_WARM_UP_WORKERS,
+    dataset: Optional[StopPointDataset] = None,
+) -> list[StopLinePairWarmUpResult]:
+    """Resolve all StopLinePairs concurrently, collecting (not raising) failures."""
+    pairs_to_resolve = [
+        (modality, stop_line_pair)
+        for modality, stop_line_pairs in unique_stops.items()
         # Don't collect TFL data for walking option
-        if modality == "walk":
-            continue
+        if modality != "walk"
+        for stop_line_pair in stop_line_pairs
+    ]
 
-        tfl_stop_points[modality] = {}
-
-        for stop_line_pair in stop_line_pairs:
-            stop_point_ids: list[str, str] = []
-            # Ordered from_dest, to_dest
-            for stop in (stop_line_pair.from_stop, stop_line_pair.to_stop):
-                stop_point_id = _get_stop_point_id(
-                    search_term=stop,
-                    get_detail=False,
-                    modality=modality,
-                    stop_line_pair=stop_line_pair,
-                    api=api,
-                )
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(
+            executor.map(
+                lambda pair: _warm_up_stop_line_pair(*pair, dataset=dataset),
+                pairs_to_resolve,
+            )
+        )
 
-                # If the modality is 'bus' then we can be confident that we have the right ID.
-                # That's because the stop IDs are direction-specific
-                if modality == "bus":
-                    stop_point_ids.append(stop_point_id)
-                # Otherwise (for tube) we need to get one more level of detail
-                # to confirm the modality-specific id
-                else:
-                    stop_point_id = _get_stop_point_id(
-                        search_term=stop_point_id,
-                        get_detail=True,
-                        modality=modality,
-                        stop_line_pair=stop_line_pair,
-                        api=api,
-                    )
-                    stop_point_ids.append(stop_point_id)
-
-            # Get the canonical direction of travel between the stop points
-            try:
-                direction = api.get_direction_between_stop_points(*stop_point_ids)
-            except rq.exceptions.HTTPError:
-                raise StopPointsDirectionNotFoundException(
-                    stop_line_pair.from_stop, stop_line_pair.to_stop, *stop_point_ids
-                )
 
-            tfl_stop_points[modality][
-                f"{stop_line_pair.from_stop} - {stop_line_pair.to_stop} - {stop_line_pair.line}"
-            ] = StopPointsInfo(
-                stop_point_ids[0], stop_point_ids[1], stop_line_pair.line, direction
-            )
+def _get_tfl_stop_points(
+    unique_stops: dict[TflModalitiesType, set[StopLinePair]],
+    max_workers: int = DEFAULT_WARM_UP_WORKERS,
+    dataset: Optional[StopPointDataset] = None,
+) -> dict[TflModalitiesType, dict[str, StopPointsInfo]]:
+    warm_up_results = _warm_up_stop_line_pairs(unique_stops, max_workers, dataset)
+
+    failures = [result for result in warm_up_results if result.error]
+    if failures:
+        raise CacheWarmUpException(failures)
+
+    return _stop_points_from_warm_up_results(warm_up_results)
+
+
+def _stop_points_from_warm_up_results(
+    warm_up_results: list[StopLinePairWarmUpResult],
+) -> dict[TflModalitiesType, dict[str, StopPointsInfo]]:
+    tfl_stop_points: _STOP_POINTS_CACHE_TYPE = dict()
+
+    for result in warm_up_results:
+        if result.error:
+            continue
+
+        tfl_stop_points.setdefault(result.modality, {})[
+            _get_cache_key(*result.stop_line_pair)
+        ] = result.stop_points_info
 
     return tfl_stop_points
 
@@ -196,38 +330,90 @@ def _load_cache(
     with open(cache_path, "r") as f:
         raw_cache = json.loads(f.read())
 
-    cache = {}
     if raw_cache["hash"] == config_hash:
-        for cache_key in raw_cache:
-            if cache_key == "hash":
-                continue
-
-            # Re-load serialised items into StopPointsInfo objects
-            cache[cache_key] = {
-                k: StopPointsInfo.from_dict(v) for k, v in raw_cache[cache_key].items()
-            }
-
-        return cache
+        del raw_cache["hash"]
+        return _deserialise_stop_points(raw_cache)
     else:
         raise CacheException("Mis-match between cache and current config hash")
 
 
+def _deserialise_stop_points(
+    raw_stop_points: dict[str, dict[str, Any]]
+) -> _STOP_POINTS_CACHE_TYPE:
+    # Re-load serialised items into StopPointsInfo objects
+    return {
+        modality: {k: StopPointsInfo.from_dict(v) for k, v in stop_points.items()}
+        for modality, stop_points in raw_stop_points.items()
+    }
+
+
+def _serialise_stop_points(
+    tfl_stop_points: dict[TflModalitiesType, dict[str, StopPointsInfo]]
+) -> dict[str, dict[str, Any]]:
+    return {
+        modality: {k: v.to_dict() for k, v in stop_points.items()}
+        for modality, stop_points in tfl_stop_points.items()
+    }
+
+
+def _write_json_atomically(contents: dict[str, Any], path: os.PathLike):
+    # Write to a temporary file alongside the cache and swap it into place, so that
+    # readers never see a partially written cache
+    cache_dir = os.path.dirname(os.path.abspath(path))
+    with tempfile.NamedTemporaryFile(
+        "w", dir=cache_dir, prefix=".stop_points.", suffix=".tmp", delete=False
+    ) as f:
+        f.write(json.dumps(contents))
+    os.replace(f.name, path)
+
+
 def _write_cache(
     tfl_stop_points: dict[TflModalitiesType, dict[str, StopPointsInfo]],
     config_hash: str,
     cache_path: os.PathLike = STOP_POINT_CACHE_NAME,
 ):
-    prepped_cache = {}
-    for cache_key in tfl_stop_points:
-        prepped_cache[cache_key] = {
-            k: v.to_dict() for k, v in tfl_stop_points[cache_key].items()
-        }
+    _write_json_atomically(
+        {"hash": config_hash} | _serialise_stop_points(tfl_stop_points), cache_path
+    )
 
-    with open(cache_path, "w") as f:
-        f.write(json.dumps({"hash": config_hash} | prepped_cache))
 
+def _load_dataset_for_config(config: _CONFIG_TYPE) -> Optional[StopPointDataset]:
+    return load_stop_point_dataset(
+        config.get("stop_point_dataset", STOP_POINT_DATASET_NAME)
+    )
 
-def load_or_generate_cache() -> _STOP_POINTS_CACHE_TYPE:
+
+def download_stop_point_dataset(
+    modes: list[TflModalitiesType],
+    dataset_path: os.PathLike = STOP_POINT_DATASET_NAME,
+):
+    """Save TFL's bulk StopPoint listing for the given modes to disk."""
+    from .tfl_api import TflApi
+
+    api = TflApi()
+    stop_points = []
+
+    for modality in modes:
+        page = 1
+        while True:
+            # Bus stops are paged, so keep going until we run out of results
+            response = api.get_stop_points_by_mode([modality], page=page)
+            if not response["stopPoints"]:
+                break
+
+            stop_points.extend(response["stopPoints"])
+            if response.get("pageSize") is None:
+                break
+            page += 1
+
+    LOGGER.info("Downloaded %d StopPoints to %s", len(stop_points), dataset_path)
+    with open(dataset_path, "w") as f:
+        json.dump({"stopPoints": stop_points}, f)
+
+
+def load_or_generate_cache(
+    config: Optional[_CONFIG_TYPE] = None,
+) -> _STOP_POINTS_CACHE_TYPE:
     """Loads a StopPoint cache from memory or generates a new one.
 
     We:
@@ -236,12 +422,14 @@ def load_or_generate_cache() -> _STOP_POINTS_CACHE_TYPE:
         if the cache isn't found or is out of date (based its hash)
         - Return the saved cache, or generate a new one by:
             - Building a set of all unique stops listed in the config
-            - Polling the TFL API for the naptanIds of the StopPoints
-            - returned by our search
+            - Looking up the naptanIds of the StopPoints in our offline dataset
+            (if provided), otherwise polling the TFL API for the naptanIds of the
+            StopPoints returned by our search
             - Building unique route combinations to cache, containing:
                 origin_naptan_id, destination_naptan_id, line, direction
     """
-    config: _CONFIG_TYPE = get_config()
+    if config is None:
+        config = load_compiled_config().config
     config_hash: str = _get_config_hash(config)
 
     try:
@@ -251,19 +439,233 @@ def load_or_generate_cache() -> _STOP_POINTS_CACHE_TYPE:
 
     if not tfl_stop_points:
         unique_stop_points = _build_unique_stop_line_pairs(config_iterator(config))
-        tfl_stop_points = _get_tfl_stop_points(unique_stop_points)
+        tfl_stop_points = _get_tfl_stop_points(
+            unique_stop_points, dataset=_load_dataset_for_config(config)
+        )
         _write_cache(tfl_stop_points, config_hash)
 
     return tfl_stop_points
 
 
+class SharedStopPointStore:
+    """One StopPoint cache serving many configs (e.g. one per tenant).
+
+    Entries are keyed only on what was looked up (modality, stops and line), not
+    on which config asked for them. So configs sharing a route share its entry,
+    and it's only resolved against TFL once.
+    """
+
+    def __init__(
+        self,
+        cache_path: os.PathLike = SHARED_STOP_POINT_CACHE_NAME,
+        max_workers: int = DEFAULT_WARM_UP_WORKERS,
+    ):
+        self.cache_path = cache_path
+        self.max_workers = max_workers
+        self._lock = threading.Lock()
+        self._stop_points: Optional[_STOP_POINTS_CACHE_TYPE] = None
+        # (modality, cache key) -> set once whoever's resolving it is done
+        self._resolving: dict[tuple[TflModalitiesType, str], threading.Event] = {}
+
+    def _read(self) -> _STOP_POINTS_CACHE_TYPE:
+        try:
+            with open(self.cache_path, "r") as f:
+                return _deserialise_stop_points(json.loads(f.read()))
+        except FileNotFoundError:
+            return {}
+
+    def _find_missing(
+        self, unique_stop_points: dict[TflModalitiesType, set[StopLinePair]]
+    ) -> dict[TflModalitiesType, set[StopLinePair]]:
+        missing_stop_points = {}
+        for modality, stop_line_pairs in unique_stop_points.items():
+            # Walking has no StopPoints to resolve, so is never stored
+            if modality == "walk":
+                continue
+
+            cached_stop_points = self._stop_points.get(modality, {})
+            missing_pairs = {
+                stop_line_pair
+                for stop_line_pair in stop_line_pairs
+                if _get_cache_key(*stop_line_pair) not in cached_stop_points
+            }
+            if missing_pairs:
+                missing_stop_points[modality] = missing_pairs
+
+        return missing_stop_points
+
+    def __len__(self):
+        return sum(
+            len(stop_points) for stop_points in (self._stop_points or {}).values()
+        )
+
+    def _claim_missing(
+        self, unique_stop_points: dict[TflModalitiesType, set[StopLinePair]]
+    ) -> tuple[dict[TflModalitiesType, set[StopLinePair]], list[threading.Event]]:
+        # Split what's missing into what we're to resolve, and (events for) what
+        # other threads are already resolving
+        to_resolve = {}
+        being_resolved = []
+        for modality, stop_line_pairs in self._find_missing(unique_stop_points).items():
+            for stop_line_pair in stop_line_pairs:
+                key = (modality, _get_cache_key(*stop_line_pair))
+                resolved = self._resolving.get(key)
+                if resolved is None:
+                    self._resolving[key] = threading.Event()
+                    to_resolve.setdefault(modality, set()).add(stop_line_pair)
+                else:
+                    being_resolved.append(resolved)
+
+        return to_resolve, being_resolved
+
+    def _resolve(
+        self,
+        missing_stop_points: dict[TflModalitiesType, set[StopLinePair]],
+        config: _CONFIG_TYPE,
+    ):
+        try:
+            new_stop_points = _get_tfl_stop_points(
+                missing_stop_points,
+                self.max_workers,
+                _load_dataset_for_config(config),
+            )
+
+            with self._lock:
+                # Build a new store rather than updating it in place, as other
+                # threads may be ranking with the current one
+                stop_points = {
+                    modality: dict(cached_stop_points)
+                    for modality, cached_stop_points in self._stop_points.items()
+                }
+                for modality, resolved_stop_points in new_stop_points.items():
+                    stop_points.setdefault(modality, {}).update(resolved_stop_points)
+
+                _write_json_atomically(
+                    _serialise_stop_points(stop_points), self.cache_path
+                )
+                self._stop_points = stop_points
+        finally:
+            # Even if resolving failed, so that those waiting can try for themselves
+            with self._lock:
+                for modality, stop_line_pairs in missing_stop_points.items():
+                    for stop_line_pair in stop_line_pairs:
+                        self._resolving.pop(
+                            (modality, _get_cache_key(*stop_line_pair))
+                        ).set()
+
+    def stop_points_for_config(self, config: _CONFIG_TYPE) -> _STOP_POINTS_CACHE_TYPE:
+        """Get the store, having resolved any of config's StopPoints it's missing.
+
+        Each missing StopLinePair is resolved by one thread, which the others
+        asking for it wait on. Resolving happens outside the lock, so a config
+        that's slow to load doesn't hold up any others.
+        """
+        unique_stop_points = _build_unique_stop_line_pairs(config_iterator(config))
+
+        while True:
+            with self._lock:
+                if self._stop_points is None:
+                    self._stop_points = self._read()
+                if not self._find_missing(unique_stop_points):
+                    return self._stop_points
+
+                # Another process may have resolved them since we last looked
+                self._stop_points = self._read()
+                to_resolve, being_resolved = self._claim_missing(unique_stop_points)
+                if not to_resolve and not being_resolved:
+                    return self._stop_points
+
+            if to_resolve:
+                self._resolve(to_resolve, config)
+            for resolved in being_resolved:
+                resolved.wait()
+
+
 def get_from_cache(
     modality_option: ModalityOption, cache: _STOP_POINTS_CACHE_TYPE
 ) -> StopPointsInfo:
     return cache[modality_option.modality][
-        f"{modality_option.from_stop} - {modality_option.to_stop} - {modality_option.line}"
+        _get_cache_key(
+            modality_option.from_stop, modality_option.to_stop, modality_option.line
+        )
     ]
 
 
+def _print_warm_up_report(warm_up_results: list[StopLinePairWarmUpResult]):
+    for result in sorted(warm_up_results, key=lambda r: -r.duration_seconds):
+        status = "FAILED" if result.error else "ok"
+        print(
+            f"[{status:>6}] {result.modality:<4} "
+            f"{_get_cache_key(*result.stop_line_pair)} "
+            f"({result.duration_seconds * 1000:.0f}ms, {result.api_calls} calls)"
+        )
+        if result.error:
+            print(f"         {result.error}")
+
+    n_failed = sum(1 for result in warm_up_results if result.error)
+    print(
+        f"Resolved {len(warm_up_results) - n_failed}/{len(warm_up_results)} pairs "
+        f"using {sum(result.api_calls for result in warm_up_results)} API calls"
+    )
+
+
 def main():
-    print(load_or_generate_cache())
+    parser = argparse.ArgumentParser(description="Warm up the TFL StopPoint cache.")
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=DEFAULT_WARM_UP_WORKERS,
+        help="number of StopLinePairs to resolve concurrently",
+    )
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="resolve and report on all pairs without writing the cache",
+    )
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="rebuild the cache even if it matches the current config",
+    )
+    parser.add_argument(
+        "--download-dataset",
+        action="store_true",
+        help="save TFL's bulk StopPoint listing to disk for offline stop lookups",
+    )
+    args = parser.parse_args()
+
+    compiled_config = load_compiled_config()
+    config: _CONFIG_TYPE = compiled_config.config
+    config_hash: str = _get_config_hash(config)
+
+    if args.download_dataset:
+        download_stop_point_dataset(
+            ["bus", "tube"],
+            config.get("stop_point_dataset", STOP_POINT_DATASET_NAME),
+        )
+
+    if not (args.force or args.dry_run):
+        try:
+            print(_load_cache(config_hash))
+            return
+        except (FileNotFoundError, CacheException):
+            pass
+
+    start = time.perf_counter()
+    warm_up_results = _warm_up_stop_line_pairs(
+        _build_unique_stop_line_pairs(config_iterator(config)),
+        args.workers,
+        _load_dataset_for_config(config),
+    )
+    _print_warm_up_report(warm_up_results)
+    print(f"Took {time.perf_counter() - start:.2f}s")
+
+    if any(result.error for result in warm_up_results):
+        sys.exit(1)
+
+    if not args.dry_run:
+        tfl_stop_points = _stop_points_from_warm_up_results(warm_up_results)
+        _write_cache(tfl_stop_points, config_hash)
+        # Keep the compiled config's copy of the resolved StopPoints in sync
+        compiled_config.stop_points = tfl_stop_points
+        save_compiled_config(compiled_config)
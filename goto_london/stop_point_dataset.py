@@ -0,0 +1,315 @@
+# Load bulk StopPoint data from disk to resolve stops without TFL search calls.
+
+import csv
+from dataclasses import dataclass
+from functools import lru_cache
+import json
+import os
+import re
+from typing import Any, Iterable, Optional
+
+from .common import LOGGER, STOP_POINT_DATASET_NAME, TflModalitiesType
+from .stop_point_grid import GridIndex
+from .stop_point_index import TrigramIndex
+
+
+# NaPTAN StopTypes that identify on-street bus stops
+_NAPTAN_BUS_STOP_TYPES = {"BCT", "BCS", "BCQ", "BST"}
+# London Underground ATCO codes are all prefixed with this
+_NAPTAN_TUBE_ATCO_PREFIX = "940GZZLU"
+
+_NAME_SUFFIXES = ("underground station", "rail station", "station")
+
+# Minimum share of a search term's trigrams that a stop name must contain for us
+# to resolve the stop without asking TFL
+FUZZY_MATCH_MIN_SCORE = 0.85
+# ... and how far ahead of the next-best stop it must score, so that we never
+# pick between similarly named stops
+FUZZY_MATCH_MIN_LEAD = 0.1
+
+
+@dataclass
+class DatasetStopPoint:
+    """A single StopPoint as described by a bulk dataset."""
+
+    id: str
+    name: str
+    modes: tuple[str, ...]
+    # Empty where the dataset doesn't include line information (e.g. NaPTAN)
+    lines: tuple[str, ...]
+    stop_code: Optional[str]
+    parent_id: Optional[str]
+    lat: Optional[float]
+    lon: Optional[float]
+
+
+def normalise_stop_name(name: str) -> str:
+    """Reduce a stop name to a canonical form for matching."""
+    name = name.lower().replace("&", " and ")
+    name = re.sub(r"['’.]", "", name)
+    name = re.sub(r"[^a-z0-9]+", " ", name).strip()
+
+    for suffix in _NAME_SUFFIXES:
+        if name.endswith(" " + suffix):
+            name = name[: -len(suffix) - 1]
+            break
+
+    return name
+
+
+class StopPointDataset:
+    """Indexed lookup over a bulk set of StopPoints.
+
+    StopPoints can be found by name, mode, line, code and location.
+    """
+
+    def __init__(self, stop_points: Iterable[DatasetStopPoint]):
+        self.by_id: dict[str, DatasetStopPoint] = {}
+        self.by_name: dict[str, list[DatasetStopPoint]] = {}
+        self.by_code: dict[str, list[DatasetStopPoint]] = {}
+        self.by_mode_line: dict[tuple[str, str], list[DatasetStopPoint]] = {}
+        self.children: dict[str, list[DatasetStopPoint]] = {}
+        self.name_index: TrigramIndex[DatasetStopPoint] = TrigramIndex()
+        self.location_index: GridIndex[DatasetStopPoint] = GridIndex()
+
+        for stop_point in stop_points:
+            self._add(stop_point)
+
+    def __len__(self):
+        return len(self.by_id)
+
+    def _add(self, stop_point: DatasetStopPoint):
+        if stop_point.id in self.by_id:
+            return
+
+        self.by_id[stop_point.id] = stop_point
+        name = normalise_stop_name(stop_point.name)
+        self.by_name.setdefault(name, []).append(stop_point)
+        self.name_index.add(name, stop_point)
+        if stop_point.stop_code:
+            self.by_code.setdefault(stop_point.stop_code, []).append(stop_point)
+        for mode in stop_point.modes:
+            for line in stop_point.lines:
+                self.by_mode_line.setdefault((mode, line), []).append(stop_point)
+        if stop_point.parent_id:
+            self.children.setdefault(stop_point.parent_id, []).append(stop_point)
+        if stop_point.lat is not None and stop_point.lon is not None:
+            self.location_index.add(stop_point.lat, stop_point.lon, stop_point)
+
+    def search(self, search_term: str) -> list[DatasetStopPoint]:
+        """Find StopPoints matching a stop code, naptan id or stop name."""
+        if search_term in self.by_id:
+            return [self.by_id[search_term]]
+
+        return self.by_code.get(search_term) or self.by_name.get(
+            normalise_stop_name(search_term), []
+        )
+
+    def fuzzy_search(
+        self,
+        search_term: str,
+        modality: Optional[str] = None,
+        line: Optional[str] = None,
+        min_score: float = 0.5,
+        limit: int = 10,
+    ) -> list[tuple[float, DatasetStopPoint]]:
+        """Find StopPoints with names similar to the search term, best first."""
+        return self.name_index.search(
+            normalise_stop_name(search_term),
+            min_score,
+            limit=limit,
+            accept=(
+                (lambda stop_point: self._serves(stop_point, modality, line))
+                if modality or line
+                else None
+            ),
+        )
+
+    def nearby(
+        self,
+        lat: float,
+        lon: float,
+        radius_metres: float,
+        modality: Optional[str] = None,
+    ) -> list[tuple[float, DatasetStopPoint]]:
+        """Find StopPoints within a radius, nearest first.
+
+        Returns (distance in metres, StopPoint) pairs.
+        """
+        return [
+            (distance, stop_point)
+            for distance, stop_point in self.location_index.nearby(
+                lat, lon, radius_metres
+            )
+            if modality is None or modality in stop_point.modes
+        ]
+
+    @staticmethod
+    def _serves(
+        stop_point: DatasetStopPoint, modality: Optional[str], line: Optional[str]
+    ) -> bool:
+        if modality and modality not in stop_point.modes:
+            return False
+        # Datasets without line info can't rule a stop out on its line
+        return not (line and stop_point.lines) or line in stop_point.lines
+
+    def _find_serving_stop_point_id(
+        self,
+        stop_points: Iterable[DatasetStopPoint],
+        modality: TflModalitiesType,
+        line: str,
+    ) -> Optional[str]:
+        for stop_point in stop_points:
+            candidates = self.children.get(stop_point.id, []) + [stop_point]
+            for candidate in candidates:
+                if self._serves(candidate, modality, line):
+                    return candidate.id
+
+        return None
+
+    def find_stop_point_id(
+        self, search_term: str, modality: TflModalitiesType, line: str
+    ) -> Optional[str]:
+        """Find the modality and line-specific naptan id for a stop, if known.
+
+        Searches may match hub-level StopPoints (e.g. a station served by several
+        modes), so we also check their children for the specific StopPoint.
+        Where nothing matches exactly we fall back to a close fuzzy match on name,
+        but only if it's clearly the best; otherwise it's up to the caller (e.g.
+        to ask TFL).
+        """
+        stop_point_id = self._find_serving_stop_point_id(
+            self.search(search_term), modality, line
+        )
+        if stop_point_id:
+            return stop_point_id
+
+        return self._find_unambiguous_fuzzy_match(search_term, modality, line)
+
+    def _find_unambiguous_fuzzy_match(
+        self, search_term: str, modality: TflModalitiesType, line: str
+    ) -> Optional[str]:
+        # Best score for each distinct StopPoint we'd resolve to (hubs and their
+        # children often resolve to the same one)
+        scores: dict[str, float] = {}
+        for score, stop_point in self.name_index.search(
+            normalise_stop_name(search_term), FUZZY_MATCH_MIN_SCORE
+        ):
+            stop_point_id = self._find_serving_stop_point_id(
+                [stop_point], modality, line
+            )
+            if stop_point_id and stop_point_id not in scores:
+                scores[stop_point_id] = score
+
+        ranked_matches = sorted(scores.items(), key=lambda match: -match[1])
+        if not ranked_matches:
+            return None
+        if (
+            len(ranked_matches) > 1
+            and ranked_matches[0][1] - ranked_matches[1][1] < FUZZY_MATCH_MIN_LEAD
+        ):
+            LOGGER.warning(
+                "'%s' is ambiguous between %s, not resolving it offline",
+                search_term,
+                ", ".join(stop_point_id for stop_point_id, _ in ranked_matches[:3]),
+            )
+            return None
+
+        return ranked_matches[0][0]
+
+
+def _parse_float(value: Any) -> Optional[float]:
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _stop_points_from_tfl_json(
+    raw_stop_point: dict[str, Any], parent_id: Optional[str] = None
+) -> Iterable[DatasetStopPoint]:
+    yield DatasetStopPoint(
+        id=raw_stop_point["naptanId"],
+        name=raw_stop_point.get("commonName", ""),
+        modes=tuple(raw_stop_point.get("modes", [])),
+        lines=tuple(line["name"] for line in raw_stop_point.get("lines", [])),
+        stop_code=raw_stop_point.get("smsCode"),
+        parent_id=parent_id or raw_stop_point.get("hubNaptanCode"),
+        lat=_parse_float(raw_stop_point.get("lat")),
+        lon=_parse_float(raw_stop_point.get("lon")),
+    )
+
+    for child in raw_stop_point.get("children", []):
+        yield from _stop_points_from_tfl_json(child, raw_stop_point["naptanId"])
+
+
+def load_tfl_stop_points_json(path: os.PathLike) -> StopPointDataset:
+    """Load a saved TFL `StopPoint/Mode/{modes}` response (or list of them)."""
+    with open(path, "r") as f:
+        raw = json.load(f)
+
+    raw_stop_points = raw["stopPoints"] if isinstance(raw, dict) else raw
+
+    return StopPointDataset(
+        stop_point
+        for raw_stop_point in raw_stop_points
+        for stop_point in _stop_points_from_tfl_json(raw_stop_point)
+    )
+
+
+def _naptan_modes(row: dict[str, str]) -> tuple[str, ...]:
+    if row["StopType"] in _NAPTAN_BUS_STOP_TYPES:
+        return ("bus",)
+    if row["ATCOCode"].startswith(_NAPTAN_TUBE_ATCO_PREFIX):
+        return ("tube",)
+    return ()
+
+
+def load_naptan_csv(path: os.PathLike) -> StopPointDataset:
+    """Load a NaPTAN `Stops.csv` export, keeping the stops for supported modes."""
+    stop_points = []
+
+    with open(path, "r", newline="", encoding="utf-8-sig") as f:
+        for row in csv.DictReader(f):
+            modes = _naptan_modes(row)
+            if not modes:
+                continue
+
+            stop_points.append(
+                DatasetStopPoint(
+                    id=row["ATCOCode"],
+                    name=row["CommonName"],
+                    modes=modes,
+                    lines=(),
+                    stop_code=row.get("NaptanCode") or None,
+                    parent_id=None,
+                    lat=_parse_float(row.get("Latitude")),
+                    lon=_parse_float(row.get("Longitude")),
+                )
+            )
+
+    return StopPointDataset(stop_points)
+
+
+def load_stop_point_dataset(
+    dataset_path: os.PathLike = STOP_POINT_DATASET_NAME,
+) -> Optional[StopPointDataset]:
+    """Load a bulk StopPoint dataset from disk if one has been provided."""
+    if not os.path.exists(dataset_path):
+        return None
+
+    if str(dataset_path).endswith(".csv"):
+        dataset = load_naptan_csv(dataset_path)
+    else:
+        dataset = load_tfl_stop_points_json(dataset_path)
+
+    LOGGER.info("Loaded %d StopPoints from %s", len(dataset), dataset_path)
+    return dataset
+
+
+@lru_cache(maxsize=4)
+def get_stop_point_dataset(
+    dataset_path: os.PathLike = STOP_POINT_DATASET_NAME,
+) -> Optional[StopPointDataset]:
+    """Load a bulk StopPoint dataset once, sharing it between callers."""
+    return load_stop_point_dataset(dataset_path)
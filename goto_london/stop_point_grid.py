@@ -0,0 +1,76 @@
+# In-memory grid index for fast "which stops are near here?" queries.
+
+import math
+from typing import Generic, TypeVar
+
+
+T = TypeVar("T")
+
+_EARTH_RADIUS_METRES = 6_371_000
+_METRES_PER_DEGREE_LAT = math.radians(1) * _EARTH_RADIUS_METRES
+# Projecting about London's latitude keeps distances within London accurate
+_LONDON_LAT = 51.5
+
+
+def distance_metres(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    """Approximate distance between two points, accurate enough over a few km."""
+    # Equirectangular approximation: much cheaper than haversine, and within a
+    # fraction of a percent at city scales
+    x = math.radians(lon2 - lon1) * math.cos(math.radians((lat1 + lat2) / 2))
+    y = math.radians(lat2 - lat1)
+    return _EARTH_RADIUS_METRES * math.hypot(x, y)
+
+
+class GridIndex(Generic[T]):
+    """Buckets located items into square cells, to answer radius queries.
+
+    Points are projected onto a flat plane about a reference latitude, so a
+    radius query only needs to check the handful of cells the circle overlaps.
+    Cells work best when they're about the size of a typical query radius.
+    """
+
+    def __init__(
+        self, cell_size_metres: float = 500, reference_lat: float = _LONDON_LAT
+    ):
+        self.cell_size_metres = cell_size_metres
+        self._metres_per_degree_lon = _METRES_PER_DEGREE_LAT * math.cos(
+            math.radians(reference_lat)
+        )
+        self._cells: dict[tuple[int, int], list[tuple[float, float, T]]] = {}
+        self._n_items = 0
+
+    def __len__(self):
+        return self._n_items
+
+    def _project(self, lat: float, lon: float) -> tuple[float, float]:
+        return lon * self._metres_per_degree_lon, lat * _METRES_PER_DEGREE_LAT
+
+    def _cell(self, x: float, y: float) -> tuple[int, int]:
+        return math.floor(x / self.cell_size_metres), math.floor(
+            y / self.cell_size_metres
+        )
+
+    def add(self, lat: float, lon: float, item: T):
+        x, y = self._project(lat, lon)
+        self._cells.setdefault(self._cell(x, y), []).append((x, y, item))
+        self._n_items += 1
+
+    def nearby(
+        self, lat: float, lon: float, radius_metres: float
+    ) -> list[tuple[float, T]]:
+        """Return (distance in metres, item) pairs within the radius, nearest first."""
+        x, y = self._project(lat, lon)
+        min_i, min_j = self._cell(x - radius_metres, y - radius_metres)
+        max_i, max_j = self._cell(x + radius_metres, y + radius_metres)
+        max_distance_squared = radius_metres**2
+
+        matches = []
+        for i in range(min_i, max_i + 1):
+            for j in range(min_j, max_j + 1):
+                for item_x, item_y, item in self._cells.get((i, j), ()):
+                    distance_squared = (item_x - x) ** 2 + (item_y - y) ** 2
+                    if distance_squared <= max_distance_squared:
+                        matches.append((math.sqrt(distance_squared), item))
+
+        matches.sort(key=lambda match: match[0])
+        return matches
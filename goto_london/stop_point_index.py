@@ -0,0 +1,162 @@
+# In-memory trigram index for fast fuzzy matching of (normalised) stop names.
+
+from bisect import bisect_left
+from collections import Counter
+import heapq
+import math
+from typing import Callable, Generic, Iterable, Optional, TypeVar
+
+
+T = TypeVar("T")
+
+# Trigrams in more than this share of names (e.g. " st", "ion") say little about
+# a match, but are slow to count over, so candidates don't come from them
+_COMMON_TRIGRAM_SHARE = 0.02
+# ...though counting over a few hundred names is cheap enough, however common
+_MIN_COMMON_POSTINGS = 250
+
+
+def _in_postings(item_idxs: set[int], postings: list[int]) -> set[int]:
+    # Intersecting walks all the postings, so for a handful of items (against a
+    # long list) it's quicker to binary search for each of them
+    if len(item_idxs) * 16 >= len(postings):
+        return item_idxs.intersection(postings)
+    found = set()
+    for item_idx in item_idxs:
+        position = bisect_left(postings, item_idx)
+        if position < len(postings) and postings[position] == item_idx:
+            found.add(item_idx)
+    return found
+
+
+def _trigrams(text: str) -> set[str]:
+    # Pad so that word starts/ends (and short names) still produce trigrams
+    padded = f"  {text} "
+    return {padded[i : i + 3] for i in range(len(padded) - 2)}
+
+
+class TrigramIndex(Generic[T]):
+    """Maps names to items, and answers "which names look like this?" queries.
+
+    Matches are scored on how many of the query's trigrams appear in the name
+    (so "kings cross" fully matches "kings cross st pancras"), with ties broken
+    in favour of names closest in length to the query.
+    """
+
+    def __init__(self, named_items: Iterable[tuple[str, T]] = ()):
+        self._items: list[T] = []
+        self._n_trigrams: list[int] = []
+        # Trigram -> the (ascending) indexes of items with it in their name
+        self._postings: dict[str, list[int]] = {}
+
+        for name, item in named_items:
+            self.add(name, item)
+
+    def __len__(self):
+        return len(self._items)
+
+    def add(self, name: str, item: T):
+        item_idx = len(self._items)
+        self._items.append(item)
+
+        name_trigrams = _trigrams(name)
+        self._n_trigrams.append(len(name_trigrams))
+        for trigram in name_trigrams:
+            self._postings.setdefault(trigram, []).append(item_idx)
+
+    def _dice(self, n_query_trigrams: int, overlap: int, item_idx: int) -> float:
+        # Dice coefficient penalises names with lots of extra trigrams
+        return 2 * overlap / (n_query_trigrams + self._n_trigrams[item_idx])
+
+    def _best(
+        self,
+        scored_matches: list[tuple[float, float, int]],
+        limit: Optional[int],
+        accept: Optional[Callable[[T], bool]],
+    ) -> list[tuple[float, T]]:
+        # Matches are (-score, -dice, item index), so the heap pops the best first,
+        # and we only pull off (and check) as many as we need
+        heapq.heapify(scored_matches)
+        matches = []
+        while scored_matches and (limit is None or len(matches) < limit):
+            negative_score, _, item_idx = heapq.heappop(scored_matches)
+            if accept is None or accept(self._items[item_idx]):
+                matches.append((-negative_score, self._items[item_idx]))
+        return matches
+
+    def _full_matches(self, postings: list[list[int]]) -> set[int]:
+        # Intersecting from the rarest trigram up keeps the sets small
+        full_matches = set(postings[0])
+        for trigram_postings in postings[1:]:
+            if not full_matches:
+                break
+            full_matches = _in_postings(full_matches, trigram_postings)
+        return full_matches
+
+    def _overlaps(self, postings: list[list[int]], min_overlap: int) -> Counter:
+        # A name sharing min_overlap of the query's trigrams must share one of
+        # the rarest (n - min_overlap + 1), so we only count over those. Where
+        # that takes in common trigrams, we drop them (bar the rarest), and only
+        # check the names we've found against them
+        n_counted = len(postings) - min_overlap + 1
+        max_postings = max(
+            _MIN_COMMON_POSTINGS, int(_COMMON_TRIGRAM_SHARE * len(self._items))
+        )
+        while n_counted > 1 and len(postings[n_counted - 1]) > max_postings:
+            n_counted -= 1
+
+        overlaps = Counter()
+        for trigram_postings in postings[:n_counted]:
+            overlaps.update(trigram_postings)
+
+        candidates = set(overlaps)
+        for trigram_postings in postings[n_counted:]:
+            overlaps.update(_in_postings(candidates, trigram_postings))
+        return overlaps
+
+    def search(
+        self,
+        query: str,
+        min_score: float = 0.5,
+        limit: Optional[int] = None,
+        accept: Optional[Callable[[T], bool]] = None,
+    ) -> list[tuple[float, T]]:
+        """Return (score, item) pairs scoring at least min_score, best first.
+
+        Only items that `accept` (if given) are returned, up to `limit` of them.
+        """
+        query_trigrams = _trigrams(query)
+        n_query_trigrams = len(query_trigrams)
+        postings = sorted(
+            (self._postings.get(trigram, []) for trigram in query_trigrams), key=len
+        )
+
+        # Names containing the whole query score highest, and are quick to find,
+        # so may well be all we need
+        if limit is not None:
+            full_matches = self._best(
+                [
+                    (
+                        -1.0,
+                        -self._dice(n_query_trigrams, n_query_trigrams, item_idx),
+                        item_idx,
+                    )
+                    for item_idx in self._full_matches(postings)
+                ],
+                limit,
+                accept,
+            )
+            if len(full_matches) == limit:
+                return full_matches
+
+        min_overlap = max(1, math.ceil(min_score * n_query_trigrams - 1e-9))
+        scored_matches = []
+        for item_idx, overlap in self._overlaps(postings, min_overlap).items():
+            score = overlap / n_query_trigrams
+            if score < min_score:
+                continue
+            scored_matches.append(
+                (-score, -self._dice(n_query_trigrams, overlap, item_idx), item_idx)
+            )
+
+        return self._best(scored_matches, limit, accept)
@@ -0,0 +1,200 @@
+# Push ranking updates to subscribers, refreshing each destination just once.
+
+import queue
+import threading
+from typing import Any, Callable, Iterator, Optional
+
+from .common import LOGGER
+
+
+DEFAULT_REFRESH_SECONDS = 30
+# Each subscriber holds a request thread while connected, so keep enough free
+# for everything else (this is half the server's default threads per worker)
+DEFAULT_MAX_SUBSCRIBERS = 8
+# How often idle subscribers get a comment, so we notice when they disconnect
+DEFAULT_HEARTBEAT_SECONDS = 15
+# Beyond this many unread events, a slow subscriber is sent a fresh snapshot
+_MAX_QUEUED_EVENTS = 8
+
+# An event is its type ("snapshot" or "update") plus its data
+EventType = tuple[str, dict[str, Any]]
+
+
+def diff_results(previous: dict[str, Any], current: dict[str, Any]) -> dict[str, Any]:
+    """Get the top-level fields of a result that have changed."""
+    return {key: value for key, value in current.items() if previous.get(key) != value}
+
+
+class TooManySubscribersException(Exception):
+    pass
+
+
+class DestinationFeed:
+    """Refreshes a destination's result in the background, while it has subscribers.
+
+    Subscribers are sent the full result when they join, and then just the
+    fields that change on each refresh.
+    """
+
+    def __init__(
+        self,
+        key: str,
+        refresh: Callable[[], dict[str, Any]],
+        refresh_seconds: float,
+        on_idle: Callable[["DestinationFeed"], bool],
+    ):
+        self.key = key
+        self.refresh_seconds = refresh_seconds
+        self.latest: Optional[dict[str, Any]] = None
+        self._refresh = refresh
+        self._on_idle = on_idle
+        self._subscribers: set[queue.Queue] = set()
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, name=f"feed-{key}", daemon=True
+        )
+        self._thread.start()
+
+    def __len__(self):
+        return len(self._subscribers)
+
+    def subscribe(self) -> queue.Queue:
+        events = queue.Queue(maxsize=_MAX_QUEUED_EVENTS)
+        with self._lock:
+            self._subscribers.add(events)
+            if self.latest is not None:
+                events.put_nowait(("snapshot", self.latest))
+        return events
+
+    def unsubscribe(self, events: queue.Queue):
+        with self._lock:
+            self._subscribers.discard(events)
+            # Let the refresh loop stop sooner if that was the last subscriber
+            if not self._subscribers:
+                self._wake.set()
+
+    def _deliver(self, events: queue.Queue, event: EventType):
+        try:
+            events.put_nowait(event)
+        except queue.Full:
+            # The subscriber has fallen behind, so updates would no longer
+            # apply cleanly; replace its backlog with the whole result
+            while not events.empty():
+                events.get_nowait()
+            events.put_nowait(("snapshot", self.latest))
+
+    def _refresh_and_broadcast(self):
+        try:
+            result = self._refresh()
+        except Exception as e:
+            LOGGER.warning("Failed to refresh %s, will retry: %s", self.key, e)
+            return
+
+        with self._lock:
+            if self.latest is None:
+                self.latest = result
+                event = ("snapshot", result)
+            else:
+                changes = diff_results(self.latest, result)
+                self.latest = result
+                if not changes:
+                    return
+                event = ("update", changes)
+
+            for events in self._subscribers:
+                self._deliver(events, event)
+
+    def _run(self):
+        while True:
+            self._refresh_and_broadcast()
+
+            self._wake.wait(self.refresh_seconds)
+            self._wake.clear()
+            # Check for subscribers and stop in the same step as the hub
+            # hands out new ones, so no-one subscribes to a stopped feed
+            if self._on_idle(self):
+                return
+
+
+class Subscription:
+    """A subscriber's events, or None for each heartbeat without any.
+
+    Close it once done with, even if it's never been iterated, to unsubscribe.
+    """
+
+    def __init__(
+        self, feed: DestinationFeed, events: queue.Queue, heartbeat_seconds: float
+    ):
+        self._feed = feed
+        self._events = events
+        self._heartbeat_seconds = heartbeat_seconds
+        self._closed = False
+
+    def __iter__(self) -> Iterator[Optional[EventType]]:
+        return self
+
+    def __next__(self) -> Optional[EventType]:
+        if self._closed:
+            raise StopIteration
+        try:
+            return self._events.get(timeout=self._heartbeat_seconds)
+        except queue.Empty:
+            return None
+
+    def close(self):
+        if not self._closed:
+            self._closed = True
+            self._feed.unsubscribe(self._events)
+
+
+class SubscriptionHub:
+    """Owns one DestinationFeed per subscribed destination."""
+
+    def __init__(
+        self,
+        refresh_seconds: float = DEFAULT_REFRESH_SECONDS,
+        heartbeat_seconds: float = DEFAULT_HEARTBEAT_SECONDS,
+        max_subscribers: int = DEFAULT_MAX_SUBSCRIBERS,
+    ):
+        self.refresh_seconds = refresh_seconds
+        self.heartbeat_seconds = heartbeat_seconds
+        self.max_subscribers = max_subscribers
+        self._feeds: dict[str, DestinationFeed] = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._feeds)
+
+    def subscriber_count(self) -> int:
+        with self._lock:
+            return sum(len(feed) for feed in self._feeds.values())
+
+    def _stop_if_idle(self, feed: DestinationFeed) -> bool:
+        with self._lock:
+            if len(feed):
+                return False
+            del self._feeds[feed.key]
+            return True
+
+    def subscribe(
+        self, key: str, refresh: Callable[[], dict[str, Any]]
+    ) -> Subscription:
+        """Subscribe to a destination's events, unless we're at max_subscribers.
+
+        Feeds are shared by key, so `refresh` is only used by the first subscriber.
+        """
+        with self._lock:
+            if sum(len(feed) for feed in self._feeds.values()) >= self.max_subscribers:
+                raise TooManySubscribersException(
+                    f"Already serving {self.max_subscribers} subscribers"
+                )
+
+            feed = self._feeds.get(key)
+            if feed is None:
+                feed = self._feeds[key] = DestinationFeed(
+                    key, refresh, self.refresh_seconds, self._stop_if_idle
+                )
+            events = feed.subscribe()
+
+        return Subscription(feed, events, self.heartbeat_seconds)
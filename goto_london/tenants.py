@@ -0,0 +1,141 @@
+# Per-user (tenant) configs, loaded on demand and sharing one StopPoint store.
+
+from collections import OrderedDict
+from dataclasses import dataclass
+import os
+import re
+import threading
+from typing import Any, Optional
+
+from .common import config_iterator, LOGGER, parse_config, TENANTS_DIR_NAME
+from .stop_point_cacher import CacheException, SharedStopPointStore
+
+
+DEFAULT_MAX_LOADED_TENANTS = 256
+
+# Tenant names become file names, so keep them simple
+_TENANT_NAME_PATTERN = re.compile(r"^[A-Za-z0-9_-]+$")
+
+
+class UnknownTenantException(Exception):
+    def __init__(self, tenant_name: str):
+        self.message = f"No config found for tenant {tenant_name}"
+
+    def __str__(self):
+        return self.message
+
+
+class TenantUnavailableException(Exception):
+    def __init__(self, tenant_name: str, reason: Exception):
+        self.message = f"Couldn't load config for tenant {tenant_name}: {reason}"
+
+    def __str__(self):
+        return self.message
+
+
+@dataclass
+class Tenant:
+    name: str
+    config: dict[str, Any]
+    stop_points: dict[str, Any]
+    # When its config file was last modified, as of loading it
+    config_mtime: float
+
+
+class TenantRegistry:
+    """Loads tenant configs from `<tenants_dir>/<tenant>.yaml` as they're needed.
+
+    Only the most recently used `max_loaded` tenants are kept in memory, and a
+    tenant is re-read once its config file changes. All tenants resolve their
+    StopPoints through the same SharedStopPointStore.
+    """
+
+    def __init__(
+        self,
+        tenants_dir: os.PathLike = TENANTS_DIR_NAME,
+        max_loaded: int = DEFAULT_MAX_LOADED_TENANTS,
+        stop_point_store: Optional[SharedStopPointStore] = None,
+    ):
+        self.tenants_dir = tenants_dir
+        self.max_loaded = max_loaded
+        self.stop_point_store = (
+            SharedStopPointStore() if stop_point_store is None else stop_point_store
+        )
+        self._tenants: OrderedDict[str, Tenant] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._tenants)
+
+    def _config_path(self, tenant_name: str) -> str:
+        return os.path.join(self.tenants_dir, f"{tenant_name}.yaml")
+
+    def _load(self, tenant_name: str) -> Tenant:
+        import requests as rq
+
+        if not _TENANT_NAME_PATTERN.match(tenant_name):
+            raise UnknownTenantException(tenant_name)
+
+        try:
+            # Taken before reading, so an edit made meanwhile is picked up later
+            config_mtime = os.stat(self._config_path(tenant_name)).st_mtime
+            with open(self._config_path(tenant_name), "r") as f:
+                config = parse_config(f.read())
+        except FileNotFoundError:
+            raise UnknownTenantException(tenant_name)
+
+        # Unpacking every option up front also validates the config
+        list(config_iterator(config))
+
+        try:
+            stop_points = self.stop_point_store.stop_points_for_config(config)
+        except (CacheException, rq.exceptions.RequestException) as e:
+            raise TenantUnavailableException(tenant_name, e)
+
+        LOGGER.info("Loaded config for tenant %s", tenant_name)
+        return Tenant(
+            name=tenant_name,
+            config=config,
+            stop_points=stop_points,
+            config_mtime=config_mtime,
+        )
+
+    def _is_current(self, tenant: Tenant) -> bool:
+        try:
+            return (
+                os.stat(self._config_path(tenant.name)).st_mtime == tenant.config_mtime
+            )
+        except FileNotFoundError:
+            return False
+
+    def get(self, tenant_name: str) -> Tenant:
+        with self._lock:
+            tenant = self._tenants.get(tenant_name)
+            if tenant is not None:
+                self._tenants.move_to_end(tenant_name)
+
+        if tenant is not None:
+            if self._is_current(tenant):
+                return tenant
+            # Its config has been edited (or removed) since we loaded it
+            LOGGER.info("Config for tenant %s changed, reloading", tenant_name)
+            self.evict(tenant_name)
+
+        # Load outside the lock, so a slow load doesn't hold up other tenants
+        tenant = self._load(tenant_name)
+
+        with self._lock:
+            self._tenants[tenant_name] = tenant
+            self._tenants.move_to_end(tenant_name)
+            while len(self._tenants) > self.max_loaded:
+                self._tenants.popitem(last=False)
+
+        return tenant
+
+    def evict(self, tenant_name: str):
+        """Drop a tenant, so that its config is re-read on next use."""
+        with self._lock:
+            self._tenants.pop(tenant_name, None)
+
+
+TENANTS = TenantRegistry()
@@ -1,41 +1,284 @@
-from typing import Any, Optional
+from collections import deque, namedtuple
+from concurrent.futures import as_completed, Future, ThreadPoolExecutor, wait
+from concurrent.futures import TimeoutError as FutureTimeoutError
+import threading
+import time
+from typing import Any, Iterable, Optional
+from urllib.parse import urlencode
 
 import arrow
 from dotenv import dotenv_values
 import requests as rq
+from requests.adapters import HTTPAdapter
 
 from .common import (
+    Deadline,
+    DeadlineExceededException,
     ENV_FILE_NAME,
     ENV_TFL_APP_ID,
     ENV_TFL_APP_KEY,
     LOGGER,
     TflModalitiesType,
 )
+from .live_cache import ARRIVALS_CACHE
+from .prediction_accuracy import PREDICTION_ACCURACY
+from .recording import RECORDER
+from .vehicle_timeline import VEHICLE_TIMELINES
+
+
+_SESSION_POOL_SIZE = 16
+_SESSION: Optional[rq.Session] = None
+
+# Upper bound on comma-separated ids per batched query, to keep URLs sensible
+_MAX_IDS_PER_QUERY = 20
+
+# Upstream calls never wait longer than this, deadline or not
+_DEFAULT_TIMEOUT_SECONDS = 10
+# Don't hedge until we've seen enough calls to know what "slow" looks like
+_MIN_LATENCY_SAMPLES_TO_HEDGE = 20
+_LATENCY_WINDOW_SIZE = 200
+_HEDGE_AT_PERCENTILE = 0.95
+# Twice the default request threads per worker, so each can hedge a call
+DEFAULT_HEDGE_POOL_SIZE = 32
+
+LineStopPointLookup = namedtuple(
+    "LineStopPointLookup", ["line", "stop_point_id", "direction"]
+)
+
+
+def get_session() -> rq.Session:
+    """Get this process' pooled HTTP session, creating it if needed."""
+    global _SESSION
+
+    if _SESSION is None:
+        _SESSION = rq.Session()
+        _SESSION.mount(
+            "https://",
+            HTTPAdapter(pool_connections=1, pool_maxsize=_SESSION_POOL_SIZE),
+        )
+    return _SESSION
+
+
+def reset_session():
+    """Drop the pooled HTTP session, e.g. so forked processes don't share sockets."""
+    global _SESSION
+
+    if _SESSION is not None:
+        _SESSION.close()
+    _SESSION = None
+
+
+class _LatencyTracker:
+    """Rolling window of recent upstream latencies, per kind of endpoint."""
+
+    def __init__(self, window_size: int):
+        self._latencies: dict[str, deque[float]] = {}
+        self._window_size = window_size
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def endpoint_kind(endpoint: str) -> str:
+        # e.g. Line/{ids}/Arrivals/{stop} -> Line/Arrivals
+        parts = endpoint.split("/")
+        return "/".join(parts[0:1] + parts[2:3])
+
+    def record(self, endpoint: str, latency_seconds: float):
+        kind = self.endpoint_kind(endpoint)
+        with self._lock:
+            self._latencies.setdefault(kind, deque(maxlen=self._window_size)).append(
+                latency_seconds
+            )
+
+    def percentile(self, endpoint: str, percentile: float) -> Optional[float]:
+        with self._lock:
+            latencies = sorted(self._latencies.get(self.endpoint_kind(endpoint), ()))
+
+        if len(latencies) < _MIN_LATENCY_SAMPLES_TO_HEDGE:
+            return None
+        return latencies[min(len(latencies) - 1, int(len(latencies) * percentile))]
+
+
+LATENCIES = _LatencyTracker(_LATENCY_WINDOW_SIZE)
+
+
+class _HedgePool:
+    """Threads to make hedged calls on, which never queue calls up.
+
+    Were calls left waiting on busy threads, that wait would count towards when
+    they're hedged, so we'd hedge (and queue) more just as we're overloaded.
+    Instead, once every thread is busy, callers go without hedging.
+    """
+
+    def __init__(self, max_workers: int):
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="tfl-hedge"
+        )
+        self._free_threads = threading.BoundedSemaphore(max_workers)
+
+    def try_submit(self, fn, *args) -> Optional[Future]:
+        """Run fn on a free thread, or return None if there aren't any."""
+        if not self._free_threads.acquire(blocking=False):
+            return None
+
+        try:
+            future = self._executor.submit(fn, *args)
+        except BaseException:
+            self._free_threads.release()
+            raise
+        future.add_done_callback(lambda _: self._free_threads.release())
+        return future
+
+
+_HEDGE_POOL = _HedgePool(DEFAULT_HEDGE_POOL_SIZE)
+
+
+def reset_hedging(pool_size: int = DEFAULT_HEDGE_POOL_SIZE):
+    """Start a fresh hedging pool and latency window, e.g. in a forked process.
+
+    The pool's threads don't survive a fork, and the parent's latencies needn't
+    describe ours.
+    """
+    global _HEDGE_POOL, LATENCIES
+
+    _HEDGE_POOL = _HedgePool(pool_size)
+    LATENCIES = _LatencyTracker(_LATENCY_WINDOW_SIZE)
+
+
+def _first_successful(futures: list[Future], timeout: float) -> rq.Response:
+    """Return the result of whichever future succeeds first."""
+    error = None
+    try:
+        for future in as_completed(futures, timeout=timeout):
+            try:
+                return future.result()
+            except rq.exceptions.RequestException as e:
+                error = e
+    except FutureTimeoutError:
+        raise rq.exceptions.Timeout("Timed out waiting on hedged requests")
+
+    raise error
 
 
 class TflApi:
-    def __init__(self):
+    def __init__(self, deadline: Optional[Deadline] = None):
         self.url_base = "https://api.tfl.gov.uk/"
         self.app_id, self.app_key = self._get_api_creds()
+        # Number of upstream calls made by this client, for reporting
+        self.call_count = 0
+        # Every call made by this client must complete before the deadline
+        self.deadline = deadline
 
     @staticmethod
     def _get_api_creds() -> (str, str):
         env = dotenv_values(ENV_FILE_NAME)
         return env[ENV_TFL_APP_ID], env[ENV_TFL_APP_KEY]
 
-    def _query(
-        self, endpoint: str, params: Optional[dict[str, Any]] = None
-    ) -> rq.Response:
-        response = rq.get(
+    def _timeout(self) -> float:
+        if self.deadline is None:
+            return _DEFAULT_TIMEOUT_SECONDS
+        return min(self.deadline.remaining(), _DEFAULT_TIMEOUT_SECONDS)
+
+    def _get(self, endpoint: str, params: Optional[dict[str, Any]]) -> rq.Response:
+        self.call_count += 1
+        return get_session().get(
             self.url_base + endpoint,
             params={"app_id": self.app_id, "app_key": self.app_key} | (params or {}),
+            timeout=self._timeout(),
         )
+
+    def _get_hedged(
+        self, endpoint: str, params: Optional[dict[str, Any]]
+    ) -> rq.Response:
+        """GET an endpoint, sending a duplicate request if the first is slow.
+
+        Once a call has taken longer than the p95 latency for its kind of endpoint
+        we hedge with a second, identical call, and go with whichever replies first.
+        Calls aren't hedged while the hedging pool is fully busy.
+        """
+        hedge_after = LATENCIES.percentile(endpoint, _HEDGE_AT_PERCENTILE)
+        if hedge_after is None or hedge_after >= self._timeout():
+            return self._get(endpoint, params)
+
+        primary = _HEDGE_POOL.try_submit(self._get, endpoint, params)
+        if primary is None:
+            return self._get(endpoint, params)
+        done, _ = wait([primary], timeout=hedge_after)
+        if done:
+            return primary.result()
+
+        hedge = _HEDGE_POOL.try_submit(self._get, endpoint, params)
+        if hedge is None:
+            return _first_successful([primary], timeout=self._timeout())
+        LOGGER.debug("Hedging slow TflApi call @ %s", endpoint)
+        return _first_successful([primary, hedge], timeout=self._timeout())
+
+    def _query(
+        self, endpoint: str, params: Optional[dict[str, Any]] = None
+    ) -> rq.Response:
+        if self.deadline is not None and self.deadline.expired():
+            raise DeadlineExceededException(f"No time left to query {endpoint}")
+
+        start = time.monotonic()
+        try:
+            response = self._get_hedged(endpoint, params)
+        except rq.exceptions.Timeout:
+            if self.deadline is not None and self.deadline.expired():
+                raise DeadlineExceededException(f"Ran out of time querying {endpoint}")
+            raise
+        latency_seconds = time.monotonic() - start
+        LATENCIES.record(endpoint, latency_seconds)
+        if RECORDER is not None:
+            RECORDER.record(
+                endpoint, params, response.status_code, response.text, latency_seconds
+            )
+
         LOGGER.debug("TflApi call @ %s", response.url)
         if not response.ok:
             response.raise_for_status()
         else:
             return response
 
+    @staticmethod
+    def _is_arrivals_endpoint(endpoint: str) -> bool:
+        return (
+            endpoint.lower().endswith("/arrivals") or "/arrivals/" in endpoint.lower()
+        )
+
+    @staticmethod
+    def _live_cache_key(endpoint: str, params: Optional[dict[str, Any]] = None) -> str:
+        return endpoint + "?" + urlencode(sorted((params or {}).items()))
+
+    def _query_live(
+        self, endpoint: str, params: Optional[dict[str, Any]] = None
+    ) -> Any:
+        """Query a live endpoint, re-using a recent response if we have one."""
+        cache_key = self._live_cache_key(endpoint, params)
+
+        cached_response = ARRIVALS_CACHE.get(cache_key)
+        if cached_response is not None:
+            return cached_response
+
+        # Only one caller (across all workers, for shared caches) refreshes a key
+        # at a time; the rest wait and re-use its response
+        with ARRIVALS_CACHE.single_flight(
+            cache_key,
+            None if self.deadline is None else self.deadline.remaining(),
+        ):
+            cached_response = ARRIVALS_CACHE.get(cache_key)
+            if cached_response is not None:
+                return cached_response
+
+            response = self._query(endpoint, params).json()
+            ARRIVALS_CACHE.set(cache_key, response)
+            if self._is_arrivals_endpoint(endpoint):
+                # Vehicle arrivals list every stop a vehicle has left to make,
+                # whereas (e.g.) Line arrivals only cover a single stop
+                VEHICLE_TIMELINES.add_predictions(
+                    response, complete=endpoint.startswith("Vehicle/")
+                )
+                PREDICTION_ACCURACY.submit(response)
+            return response
+
     def search_stop_points(
         self, name: str, modes: list[TflModalitiesType]
     ) -> dict[str, Any]:
@@ -52,6 +295,13 @@ class TflApi:
         search_response = self._query(f"StopPoint/{stop_point_id}")
         return search_response.json()
 
+    def get_stop_points_by_mode(
+        self, modes: list[TflModalitiesType], page: Optional[int] = None
+    ) -> dict[str, Any]:
+        params = {"page": page} if page else None
+        search_response = self._query(f"StopPoint/Mode/{','.join(modes)}", params)
+        return search_response.json()
+
     def get_direction_between_stop_points(
         self, from_stop_point: str, to_stop_point: str
     ) -> str:
@@ -60,17 +310,152 @@ class TflApi:
         )
         return search_response.json()
 
+    @staticmethod
+    def _next_vehicles_query(
+        line: str, stop_point_id: str, direction: Optional[str] = None
+    ) -> tuple[str, Optional[dict[str, Any]]]:
+        params = {"direction": direction} if direction else None
+        return f"Line/{line}/Arrivals/{stop_point_id}", params
+
     def get_next_vehicles_for_line_stop_point(
         self, line: str, stop_point_id: str, direction: str = None
     ) -> list[dict[str, Any]]:
+        return self._query_live(
+            *self._next_vehicles_query(line, stop_point_id, direction)
+        )
 
-        params = {"direction": direction} if direction else None
-        search_response = self._query(f"Line/{line}/Arrivals/{stop_point_id}", params)
-        return search_response.json()
+    def _fetch_next_vehicles_for_lines(
+        self, lines: set[str], stop_point_id: str, direction: Optional[str]
+    ) -> dict[LineStopPointLookup, list[dict[str, Any]]]:
+        if len(lines) == 1:
+            line = next(iter(lines))
+            return {
+                LineStopPointLookup(
+                    line, stop_point_id, direction
+                ): self.get_next_vehicles_for_line_stop_point(
+                    line, stop_point_id, direction
+                )
+            }
+
+        batched_response = self._query_live(
+            *self._next_vehicles_query(
+                ",".join(sorted(lines)), stop_point_id, direction
+            )
+        )
+
+        next_vehicles = {}
+        for line in lines:
+            line_vehicles = sorted(
+                (
+                    next_vehicle
+                    for next_vehicle in batched_response
+                    if next_vehicle["lineName"] == line
+                ),
+                key=lambda next_vehicle: next_vehicle["expectedArrival"],
+            )
+            # Cache per line too, so that single-line lookups benefit
+            ARRIVALS_CACHE.set(
+                self._live_cache_key(
+                    *self._next_vehicles_query(line, stop_point_id, direction)
+                ),
+                line_vehicles,
+            )
+            next_vehicles[
+                LineStopPointLookup(line, stop_point_id, direction)
+            ] = line_vehicles
+
+        return next_vehicles
+
+    def get_next_vehicles_for_line_stop_points(
+        self, lookups: Iterable[LineStopPointLookup]
+    ) -> dict[LineStopPointLookup, list[dict[str, Any]]]:
+        """Batched get_next_vehicles_for_line_stop_point, using as few calls as we can.
+
+        TFL accepts comma-separated lines, so lookups sharing a stop and direction
+        are fetched together and split back out per line (in order of arrival).
+        If we run past our deadline, lookups we didn't get to are left out.
+        """
+        next_vehicles: dict[LineStopPointLookup, list[dict[str, Any]]] = {}
+        lines_to_fetch: dict[tuple[str, Optional[str]], set[str]] = {}
+
+        for lookup in set(lookups):
+            cached_response = ARRIVALS_CACHE.get(
+                self._live_cache_key(*self._next_vehicles_query(*lookup))
+            )
+            if cached_response is not None:
+                next_vehicles[lookup] = cached_response
+            else:
+                lines_to_fetch.setdefault(
+                    (lookup.stop_point_id, lookup.direction), set()
+                ).add(lookup.line)
+
+        for (stop_point_id, direction), lines in lines_to_fetch.items():
+            try:
+                next_vehicles |= self._fetch_next_vehicles_for_lines(
+                    lines, stop_point_id, direction
+                )
+            except DeadlineExceededException as e:
+                LOGGER.warning("Giving up on remaining next vehicles: %s", e)
+                break
+
+        return next_vehicles
 
     def get_vehicle_arrivals(self, vehicle_id: str) -> list[dict[str, Any]]:
-        search_response = self._query(f"Vehicle/{vehicle_id}/arrivals")
-        return search_response.json()
+        return self._query_live(f"Vehicle/{vehicle_id}/arrivals")
+
+    def _fetch_vehicles_arrivals(
+        self, vehicle_ids: list[str]
+    ) -> dict[str, list[dict[str, Any]]]:
+        if len(vehicle_ids) == 1:
+            return {vehicle_ids[0]: self.get_vehicle_arrivals(vehicle_ids[0])}
+
+        batched_response = self._query_live(f"Vehicle/{','.join(vehicle_ids)}/arrivals")
+
+        vehicles_arrivals = {}
+        for vehicle_id in vehicle_ids:
+            vehicle_arrivals = [
+                vehicle_arrival
+                for vehicle_arrival in batched_response
+                if vehicle_arrival["vehicleId"] == vehicle_id
+            ]
+            ARRIVALS_CACHE.set(
+                self._live_cache_key(f"Vehicle/{vehicle_id}/arrivals"),
+                vehicle_arrivals,
+            )
+            vehicles_arrivals[vehicle_id] = vehicle_arrivals
+
+        return vehicles_arrivals
+
+    def get_vehicles_arrivals(
+        self, vehicle_ids: Iterable[str]
+    ) -> dict[str, list[dict[str, Any]]]:
+        """Batched get_vehicle_arrivals, fetching several vehicles per call.
+
+        If we run past our deadline, vehicles we didn't get to are left out.
+        """
+        vehicles_arrivals: dict[str, list[dict[str, Any]]] = {}
+        vehicle_ids_to_fetch = []
+
+        # De-duplicate while preserving order
+        for vehicle_id in dict.fromkeys(vehicle_ids):
+            cached_response = ARRIVALS_CACHE.get(
+                self._live_cache_key(f"Vehicle/{vehicle_id}/arrivals")
+            )
+            if cached_response is not None:
+                vehicles_arrivals[vehicle_id] = cached_response
+            else:
+                vehicle_ids_to_fetch.append(vehicle_id)
+
+        for i in range(0, len(vehicle_ids_to_fetch), _MAX_IDS_PER_QUERY):
+            try:
+                vehicles_arrivals |= self._fetch_vehicles_arrivals(
+                    vehicle_ids_to_fetch[i : i + _MAX_IDS_PER_QUERY]
+                )
+            except DeadlineExceededException as e:
+                LOGGER.warning("Giving up on remaining vehicle arrivals: %s", e)
+                break
+
+        return vehicles_arrivals
 
     @staticmethod
     def filter_stop_points_for_modality_and_line(
@@ -0,0 +1,140 @@
+# Index of where each vehicle is predicted to stop next, and when.
+
+from collections import OrderedDict
+from dataclasses import dataclass, field
+import threading
+import time
+from typing import Any, Iterable, Optional
+
+from .live_cache import ARRIVALS_CACHE_MAX_ENTRIES, ARRIVALS_CACHE_TTL_SECONDS
+
+
+@dataclass
+class _VehicleTimeline:
+    # naptan id -> (when the prediction expires, the prediction)
+    stops: dict[str, tuple[float, dict[str, Any]]] = field(default_factory=dict)
+    # Until when we know every stop the vehicle has left to make
+    complete_until: float = 0.0
+
+
+def _shift_timeline(timeline: _VehicleTimeline, seconds: float) -> _VehicleTimeline:
+    return _VehicleTimeline(
+        {
+            stop_point_id: (expires_at + seconds, prediction)
+            for stop_point_id, (expires_at, prediction) in timeline.stops.items()
+        },
+        timeline.complete_until + seconds,
+    )
+
+
+class VehicleTimelineIndex:
+    """Maps (vehicle id, line) to the stops it'll arrive at, and when.
+
+    Filled from any arrivals payload passing through, so it knows about a
+    vehicle whether we've seen its full list of arrivals or just its arrival at
+    a single stop. Predictions expire after a TTL, as TFL revises them.
+    """
+
+    def __init__(self, ttl_seconds: float, max_vehicles: int):
+        self.ttl_seconds = ttl_seconds
+        self.max_vehicles = max_vehicles
+        self._timelines: OrderedDict[tuple[str, str], _VehicleTimeline] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._timelines)
+
+    def add_predictions(self, predictions: Iterable[dict[str, Any]], complete: bool):
+        """Index arrival predictions.
+
+        These can come from e.g. Line/.../Arrivals or Vehicle/.../arrivals. Set
+        `complete` where the predictions cover every stop each vehicle has left
+        to make (as with Vehicle/.../arrivals).
+        """
+        expires_at = time.monotonic() + self.ttl_seconds
+
+        with self._lock:
+            for prediction in predictions:
+                key = (prediction.get("vehicleId"), prediction.get("lineName"))
+                if None in key or prediction.get("naptanId") is None:
+                    continue
+
+                timeline = self._timelines.get(key)
+                if timeline is None:
+                    timeline = self._timelines[key] = _VehicleTimeline()
+                self._timelines.move_to_end(key)
+
+                timeline.stops[prediction["naptanId"]] = (expires_at, prediction)
+                if complete:
+                    timeline.complete_until = expires_at
+
+            # Evict the least recently updated vehicles once we're over capacity
+            while len(self._timelines) > self.max_vehicles:
+                self._timelines.popitem(last=False)
+
+    def lookup(
+        self, vehicle_id: str, line: str, stop_point_id: str
+    ) -> tuple[bool, Optional[dict[str, Any]]]:
+        """Find a vehicle's predicted arrival at a stop.
+
+        Returns whether we know the answer, and if so the prediction (or None
+        where we know the vehicle won't be stopping there).
+        """
+        now = time.monotonic()
+
+        with self._lock:
+            timeline = self._timelines.get((vehicle_id, line))
+            if timeline is None:
+                return False, None
+
+            stop = timeline.stops.get(stop_point_id)
+            if stop is not None and stop[0] >= now:
+                return True, stop[1]
+
+            return timeline.complete_until >= now, None
+
+    def clear(self):
+        with self._lock:
+            self._timelines.clear()
+
+    def export_timelines(self) -> list[tuple[tuple[str, str], _VehicleTimeline]]:
+        """Get a copy of every timeline, with expiry times since the epoch."""
+        # Monotonic times are meaningless to other processes, so convert
+        to_wall_clock = time.time() - time.monotonic()
+        with self._lock:
+            return [
+                (key, _shift_timeline(timeline, to_wall_clock))
+                for key, timeline in self._timelines.items()
+            ]
+
+    def import_timelines(
+        self, timelines: Iterable[tuple[tuple[str, str], _VehicleTimeline]]
+    ):
+        """Merge in timelines from export_timelines, bar expired predictions."""
+        to_monotonic = time.monotonic() - time.time()
+        with self._lock:
+            now = time.monotonic()
+            for key, imported_timeline in timelines:
+                imported_timeline = _shift_timeline(imported_timeline, to_monotonic)
+                timeline = self._timelines.setdefault(key, _VehicleTimeline())
+
+                for stop_point_id, stop in imported_timeline.stops.items():
+                    current_stop = timeline.stops.get(stop_point_id)
+                    if stop[0] >= now and (
+                        current_stop is None or current_stop[0] < stop[0]
+                    ):
+                        timeline.stops[stop_point_id] = stop
+                timeline.complete_until = max(
+                    timeline.complete_until, imported_timeline.complete_until
+                )
+
+                if not timeline.stops and timeline.complete_until < now:
+                    del self._timelines[key]
+
+            while len(self._timelines) > self.max_vehicles:
+                self._timelines.popitem(last=False)
+
+
+VEHICLE_TIMELINES = VehicleTimelineIndex(
+    ARRIVALS_CACHE_TTL_SECONDS, ARRIVALS_CACHE_MAX_ENTRIES
+)
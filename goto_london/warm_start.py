@@ -0,0 +1,154 @@
+# Save live state on shutdown, and restore what's still fresh on startup.
+
+from dataclasses import dataclass
+import glob
+import os
+import pickle
+import tempfile
+import time
+from typing import Any, Optional
+
+from .common import ENV, ENV_WARM_START_PATH, LOGGER
+from .live_cache import ARRIVALS_CACHE
+from .prediction_accuracy import (
+    DEFAULT_WINDOW_SECONDS,
+    PREDICTION_ACCURACY,
+    TrackerStateType,
+)
+from .vehicle_timeline import VEHICLE_TIMELINES
+
+
+# Bump whenever the shape of WarmStartSnapshot (or its keys) changes, to invalidate
+# old snapshots
+_WARM_START_VERSION = 2
+# Prediction accuracy is the longest lived state, so beyond its window a snapshot
+# has nothing left to restore
+_MAX_SNAPSHOT_AGE_SECONDS = DEFAULT_WINDOW_SECONDS
+_MAX_KEPT_SNAPSHOTS = 64
+
+
+@dataclass
+class WarmStartSnapshot:
+    """A process' live state, with every expiry time given since the epoch."""
+
+    version: int
+    saved_at: float
+    arrivals: list[tuple[str, float, Any]]
+    vehicle_timelines: list[tuple[tuple[str, str], Any]]
+    prediction_accuracy: TrackerStateType
+    # The last page rendered for each destination
+    stale_responses: list[tuple[str, float, Any]]
+
+
+def get_warm_start_path() -> Optional[str]:
+    return ENV.get(ENV_WARM_START_PATH) or None
+
+
+def _snapshot_paths(path: os.PathLike) -> list[str]:
+    # Each process saves its own snapshot, suffixed with its pid
+    return [
+        snapshot_path
+        for snapshot_path in glob.glob(f"{glob.escape(str(path))}.*")
+        if snapshot_path.rsplit(".", 1)[1].isdigit()
+    ]
+
+
+def save_snapshot(path: os.PathLike):
+    """Save this process' live state, alongside any other processes' snapshots."""
+    # Deferred, as the app imports (and is slower to import than) this module
+    from .app import _STALE_RESPONSES
+
+    start = time.monotonic()
+    snapshot = WarmStartSnapshot(
+        version=_WARM_START_VERSION,
+        saved_at=time.time(),
+        arrivals=ARRIVALS_CACHE.export_entries(),
+        vehicle_timelines=VEHICLE_TIMELINES.export_timelines(),
+        prediction_accuracy=PREDICTION_ACCURACY.export_state(),
+        stale_responses=_STALE_RESPONSES.export_entries(),
+    )
+
+    # Swap into place so that we never load half a file
+    snapshot_dir = os.path.dirname(os.path.abspath(path))
+    with tempfile.NamedTemporaryFile(
+        "wb", dir=snapshot_dir, prefix=".snapshot.", suffix=".tmp", delete=False
+    ) as f:
+        pickle.dump(snapshot, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(f.name, f"{path}.{os.getpid()}")
+
+    LOGGER.info(
+        "Saved warm start snapshot (%d arrivals, %d vehicles) in %.3fs",
+        len(snapshot.arrivals),
+        len(snapshot.vehicle_timelines),
+        time.monotonic() - start,
+    )
+
+
+def load_snapshots(path: os.PathLike) -> list[WarmStartSnapshot]:
+    """Load (and remove) every process' snapshot, newest first.
+
+    Remove them so that they're only ever restored from once; processes save
+    fresh snapshots when they exit.
+    """
+    snapshots = []
+    for snapshot_path in _snapshot_paths(path):
+        try:
+            with open(snapshot_path, "rb") as f:
+                snapshot = pickle.load(f)
+            os.remove(snapshot_path)
+        except FileNotFoundError:
+            # e.g. another process loaded it first
+            continue
+        except Exception as e:
+            # Snapshots from older code can fail to unpickle in all sorts of ways
+            # (e.g. ImportError or TypeError), and are of no use to us anyway
+            LOGGER.warning("Ignoring unreadable snapshot %s: %s", snapshot_path, e)
+            try:
+                os.remove(snapshot_path)
+            except OSError:
+                pass
+            continue
+
+        if getattr(snapshot, "version", None) == _WARM_START_VERSION:
+            snapshots.append(snapshot)
+
+    snapshots.sort(key=lambda snapshot: snapshot.saved_at, reverse=True)
+    return snapshots
+
+
+def merge_snapshots(
+    *snapshot_lists: list[WarmStartSnapshot],
+) -> list[WarmStartSnapshot]:
+    """Combine lists of snapshots, newest first, bar those too old to be of use."""
+    oldest_saved_at = time.time() - _MAX_SNAPSHOT_AGE_SECONDS
+    snapshots = [
+        snapshot
+        for snapshots in snapshot_lists
+        for snapshot in snapshots
+        if snapshot.saved_at >= oldest_saved_at
+    ]
+    snapshots.sort(key=lambda snapshot: snapshot.saved_at, reverse=True)
+    return snapshots[:_MAX_KEPT_SNAPSHOTS]
+
+
+def restore_snapshots(snapshots: list[WarmStartSnapshot]):
+    """Restore live state from snapshots, bar what's expired since they were saved.
+
+    Cached entries and vehicle predictions are merged, keeping whichever expires
+    last. Otherwise, where snapshots overlap, the first one restored from wins.
+    """
+    from .app import _STALE_RESPONSES
+
+    for snapshot in snapshots:
+        ARRIVALS_CACHE.import_entries(snapshot.arrivals)
+        VEHICLE_TIMELINES.import_timelines(snapshot.vehicle_timelines)
+        PREDICTION_ACCURACY.import_state(snapshot.prediction_accuracy)
+        _STALE_RESPONSES.import_entries(snapshot.stale_responses)
+
+    if snapshots:
+        LOGGER.info(
+            "Restored warm start state from %d snapshots (%d arrivals, %d vehicles)",
+            len(snapshots),
+            len(ARRIVALS_CACHE),
+            len(VEHICLE_TIMELINES),
+        )
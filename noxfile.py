@@ -36,3 +36,17 @@ def black(session):
     args = session.posargs or locations
     install_with_constraints(session, "black")
     session.run("black", *args)
+
+
+@nox.session(python=["3.9"])
+def startup(session):
+    """Benchmark config loading and process startup time."""
+    session.run("poetry", "install", "--no-dev", external=True)
+    session.run("python", "-m", "goto_london.compiled_config", *session.posargs)
+
+
+@nox.session(python=["3.9"])
+def replay(session):
+    """Benchmark ranking against recorded TFL responses (pass the recording dir)."""
+    session.run("poetry", "install", "--no-dev", external=True)
+    session.run("python", "-m", "goto_london.replay", *session.posargs)
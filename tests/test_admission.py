@@ -0,0 +1,71 @@
+import threading
+
+import pytest
+
+from goto_london.admission import (
+    admission_controller_from_config,
+    AdmissionController,
+    AdmissionRejectedException,
+)
+
+
+def test_admits_up_to_max_in_flight():
+    controller = AdmissionController(
+        max_in_flight=2, max_queued=0, queue_timeout_seconds=0
+    )
+
+    with controller.admit(), controller.admit():
+        assert controller.metrics()["in_flight"] == 2
+
+        with pytest.raises(AdmissionRejectedException):
+            with controller.admit():
+                pass
+
+    metrics = controller.metrics()
+    assert metrics["in_flight"] == 0
+    assert metrics["admitted"] == 2
+    assert metrics["rejected_queue_full"] == 1
+
+
+def test_queued_request_times_out():
+    controller = AdmissionController(
+        max_in_flight=1, max_queued=1, queue_timeout_seconds=0.01
+    )
+
+    with controller.admit():
+        with pytest.raises(AdmissionRejectedException):
+            with controller.admit():
+                pass
+
+    metrics = controller.metrics()
+    assert metrics["rejected_timed_out"] == 1
+    assert metrics["queued"] == 0
+
+
+def test_queued_request_admitted_once_slot_frees():
+    controller = AdmissionController(
+        max_in_flight=1, max_queued=1, queue_timeout_seconds=5
+    )
+    release = threading.Event()
+
+    def hold_slot():
+        with controller.admit():
+            release.wait()
+
+    holder = threading.Thread(target=hold_slot)
+    holder.start()
+    while controller.metrics()["in_flight"] == 0:
+        pass
+
+    threading.Timer(0.05, release.set).start()
+    with controller.admit():
+        assert controller.metrics()["in_flight"] == 1
+    holder.join()
+
+    assert controller.metrics()["admitted"] == 2
+
+
+def test_admission_controller_from_config():
+    controller = admission_controller_from_config({"max_in_flight": 3})
+    assert controller.max_in_flight == 3
+    assert admission_controller_from_config(None).max_queued > 0
@@ -1,11 +1,16 @@
 import arrow
 
-from goto_london.app import _string_for_option
+from goto_london.admission import AdmissionController
+from goto_london.app import _string_for_option, app
 from goto_london.destination_ranker import (
     CalculatedDestinationModalityOption,
     ModalityOption,
     RankedDestinationOptions,
 )
+from goto_london.live_cache import TtlCache
+from goto_london.stop_point_dataset import DatasetStopPoint, StopPointDataset
+from goto_london.subscriptions import SubscriptionHub
+from goto_london.tenants import TenantUnavailableException, UnknownTenantException
 
 
 def test_string_for_option_walking(mocker):
@@ -83,3 +88,224 @@ def test_string_for_option_tube_bus(mocker):
         "// (walk to stop 5m) --> (wait for vehicle A1 @ Departing Stop for 5m)"
         " --> (arrive @ Destination Stop after 10m) --> (walk to destination 10m)"
     )
+
+    # Planning to leave later, there's less of a wait and the trip's shorter
+    assert (
+        _string_for_option(bus_option, leave_at=now.shift(minutes=3))
+        == "The BUS || Arriving @ Destination Stop by 12:30 (in 27 mins) "
+        "// (walk to stop 5m) --> (wait for vehicle A1 @ Departing Stop for 2m)"
+        " --> (arrive @ Destination Stop after 10m) --> (walk to destination 10m)"
+    )
+
+
+def test_search_stops(mocker):
+    dataset = StopPointDataset(
+        [
+            DatasetStopPoint(
+                "940GZZLUKSX",
+                "King's Cross St. Pancras Underground Station",
+                ("tube",),
+                ("Northern", "Victoria"),
+                None,
+                None,
+                51.53,
+                -0.12,
+            )
+        ]
+    )
+    mocker.patch("goto_london.app._get_stop_point_dataset", return_value=dataset)
+
+    response = app.test_client().get("/stops?q=kings+cross&mode=tube")
+    assert response.status_code == 200
+    assert [match["id"] for match in response.json] == ["940GZZLUKSX"]
+
+    response = app.test_client().get("/stops?q=kings+cross&mode=bus")
+    assert response.json == []
+
+    # Limits are kept within bounds, rather than 0 (or less) meaning unlimited
+    fuzzy_search = mocker.spy(dataset, "fuzzy_search")
+    app.test_client().get("/stops?q=kings+cross&limit=0")
+    app.test_client().get("/stops?q=kings+cross&limit=100000")
+    assert [call.kwargs["limit"] for call in fuzzy_search.call_args_list] == [1, 100]
+
+
+def test_health_and_readiness(mocker):
+    client = app.test_client()
+    assert client.get("/healthz").status_code == 200
+
+    mocker.patch("goto_london.app.stop_points_cache_is_warm", return_value=True)
+    response = client.get("/readyz")
+    assert response.status_code == 200
+    assert response.json["ready"]
+
+    mocker.patch("goto_london.app.stop_points_cache_is_warm", return_value=False)
+    assert client.get("/readyz").status_code == 503
+
+
+def test_overloaded_destination_serves_stale_or_503(mocker):
+    controller = AdmissionController(
+        max_in_flight=1, max_queued=0, queue_timeout_seconds=0
+    )
+    mocker.patch("goto_london.app._get_admission_controller", return_value=controller)
+    mocker.patch(
+        "goto_london.app._destination_options_context",
+        return_value={"best_option": "The BUS", "other_options": []},
+    )
+    mocker.patch("goto_london.app._STALE_RESPONSES", TtlCache(60, 10))
+    client = app.test_client()
+
+    with controller.admit():
+        response = client.get("/goto/kgx")
+        assert response.status_code == 503
+        assert "Retry-After" in response.headers
+
+    response = client.get("/goto/kgx")
+    assert b"The BUS" in response.data
+    assert b"Too busy" not in response.data
+
+    with controller.admit():
+        response = client.get("/goto/kgx")
+        assert response.status_code == 200
+        assert b"The BUS" in response.data
+        # The page itself says it's out of date
+        assert b"Too busy to check live times" in response.data
+        assert "Warning" in response.headers
+
+    metrics = client.get("/metrics").json
+    assert metrics["admission"]["rejected_queue_full"] == 2
+    assert metrics["stale_responses"] == 1
+
+
+def test_stale_pages_are_not_shared_between_routes(mocker):
+    controller = AdmissionController(
+        max_in_flight=1, max_queued=0, queue_timeout_seconds=0
+    )
+    mocker.patch("goto_london.app._get_admission_controller", return_value=controller)
+    mocker.patch("goto_london.app.TENANTS.get")
+    mocker.patch(
+        "goto_london.app._destination_options_context",
+        return_value={"best_option": "Alice's BUS", "other_options": []},
+    )
+    mocker.patch("goto_london.app._STALE_RESPONSES", TtlCache(60, 10))
+    client = app.test_client()
+
+    # Tenant alice's "horizon" destination isn't the departure horizon for "alice"
+    assert client.get("/u/alice/goto/horizon").status_code == 200
+    with controller.admit():
+        assert client.get("/goto/alice/horizon").status_code == 503
+
+
+def test_unknown_tenant_not_found(mocker):
+    mocker.patch(
+        "goto_london.app.TENANTS.get",
+        side_effect=UnknownTenantException("nobody"),
+    )
+
+    assert app.test_client().get("/u/nobody/goto/kgx").status_code == 404
+
+
+def test_tenant_loading_is_admission_controlled(mocker):
+    controller = AdmissionController(
+        max_in_flight=1, max_queued=0, queue_timeout_seconds=0
+    )
+    mocker.patch("goto_london.app._get_admission_controller", return_value=controller)
+    mock_get_tenant = mocker.patch("goto_london.app.TENANTS.get")
+
+    with controller.admit():
+        assert app.test_client().get("/u/someone/goto/kgx").status_code == 503
+    mock_get_tenant.assert_not_called()
+
+
+def test_subscribe_streams_server_sent_events(mocker):
+    mocker.patch(
+        "goto_london.app._get_subscription_hub",
+        return_value=SubscriptionHub(refresh_seconds=10),
+    )
+    mocker.patch(
+        "goto_london.app._get_admission_controller",
+        return_value=AdmissionController(),
+    )
+    mocker.patch(
+        "goto_london.app._destination_options_context",
+        return_value={"best_option": "The BUS", "other_options": []},
+    )
+    mocker.patch(
+        "goto_london.app.get_loaded_config", return_value={"destinations": {"kgx": {}}}
+    )
+
+    response = app.test_client().get(
+        "/goto/kgx/subscribe",
+        buffered=False,
+        multithread=True,
+    )
+    assert response.mimetype == "text/event-stream"
+
+    first_event = next(response.response)
+    assert first_event.startswith(b"event: snapshot\n")
+    assert b'"best_option": "The BUS"' in first_event
+    response.close()
+
+
+def test_subscribe_refused_without_subscribing(mocker):
+    hub = SubscriptionHub(refresh_seconds=10)
+    mocker.patch("goto_london.app._get_subscription_hub", return_value=hub)
+    mocker.patch(
+        "goto_london.app.get_loaded_config", return_value={"destinations": {"kgx": {}}}
+    )
+    mock_subscribe = mocker.spy(hub, "subscribe")
+    client = app.test_client()
+
+    # Unknown destination
+    response = client.get("/goto/nowhere/subscribe", multithread=True)
+    assert response.status_code == 404
+
+    # Single-threaded worker
+    response = client.get("/goto/kgx/subscribe", multithread=False)
+    assert response.status_code == 503
+    assert b"threaded" in response.data
+
+    mock_subscribe.assert_not_called()
+
+
+def test_unavailable_tenant(mocker):
+    mocker.patch(
+        "goto_london.app._get_admission_controller",
+        return_value=AdmissionController(),
+    )
+    mocker.patch(
+        "goto_london.app.TENANTS.get",
+        side_effect=TenantUnavailableException("someone", Exception("TFL is down")),
+    )
+
+    response = app.test_client().get("/u/someone/goto/kgx")
+    assert response.status_code == 503
+    assert "Retry-After" in response.headers
+
+
+def test_subscribers_capped(mocker):
+    hub = SubscriptionHub(refresh_seconds=10, max_subscribers=1)
+    mocker.patch("goto_london.app._get_subscription_hub", return_value=hub)
+    mocker.patch(
+        "goto_london.app._get_admission_controller",
+        return_value=AdmissionController(),
+    )
+    mocker.patch(
+        "goto_london.app._destination_options_context",
+        return_value={"best_option": "The BUS", "other_options": []},
+    )
+    mocker.patch(
+        "goto_london.app.get_loaded_config", return_value={"destinations": {"kgx": {}}}
+    )
+    client = app.test_client()
+
+    first = client.get("/goto/kgx/subscribe", buffered=False, multithread=True)
+    assert first.status_code == 200
+
+    refused = client.get("/goto/kgx/subscribe", buffered=False, multithread=True)
+    assert refused.status_code == 503
+    assert "Retry-After" in refused.headers
+
+    # Once the first subscriber's gone, there's room again
+    first.close()
+    assert hub.subscriber_count() == 0
+    client.get("/goto/kgx/subscribe", buffered=False, multithread=True).close()
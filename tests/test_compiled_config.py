@@ -0,0 +1,42 @@
+import shutil
+
+from goto_london.compiled_config import load_compiled_config, save_compiled_config
+
+
+def test_compiled_config_reused_until_yaml_changes(tmp_path, mocker):
+    config_path = tmp_path / "config.yaml"
+    compiled_path = tmp_path / "config.compiled"
+    shutil.copy("tests/fake_config.yaml", config_path)
+
+    compiled_config = load_compiled_config(config_path, compiled_path)
+    assert compiled_config.config["walk_time_bonus"] == 3
+    assert len(compiled_config.modality_options) == 3
+
+    # Once resolved, StopPoints are saved alongside the config
+    compiled_config.stop_points = {"bus": {}}
+    save_compiled_config(compiled_config, compiled_path)
+
+    # Unchanged YAML is loaded from the snapshot, without being parsed
+    mock_parse = mocker.patch("goto_london.compiled_config.parse_config")
+    assert load_compiled_config(config_path, compiled_path) == compiled_config
+    mock_parse.assert_not_called()
+    mocker.stopall()
+
+    with open(config_path, "a") as f:
+        f.write("\nrequest_budget_seconds: 2\n")
+
+    recompiled_config = load_compiled_config(config_path, compiled_path)
+    assert recompiled_config.config["request_budget_seconds"] == 2
+    assert recompiled_config.stop_points is None
+
+
+def test_unloadable_compiled_config_is_recompiled(tmp_path):
+    config_path = tmp_path / "config.yaml"
+    compiled_path = tmp_path / "config.compiled"
+    shutil.copy("tests/fake_config.yaml", config_path)
+    # e.g. pickled by code that's since moved
+    compiled_path.write_bytes(b"cgoto_london.no_such_module\nCompiledConfig\n.")
+
+    compiled_config = load_compiled_config(config_path, compiled_path)
+
+    assert compiled_config.config["walk_time_bonus"] == 3
@@ -0,0 +1,290 @@
+import arrow
+import pytest
+import yaml
+
+from goto_london.common import Deadline
+from goto_london.destination_ranker import (
+    get_departure_offsets,
+    plan_departures_for_destination,
+    rank_options_for_destination,
+    rank_options_for_destination_within_deadline,
+)
+from goto_london.live_cache import TtlCache
+from goto_london.prediction_accuracy import PredictionAccuracyTracker
+from goto_london.stop_point_cacher import StopPointsInfo
+from goto_london.stop_point_dataset import DatasetStopPoint, StopPointDataset
+from goto_london.tfl_api import TflApi
+from goto_london.vehicle_timeline import VehicleTimelineIndex
+
+
+_STOP_POINTS_CACHE = {
+    "bus": {"73053 - 76007 - 390": StopPointsInfo("B1", "B2", "390", "outbound")},
+    "tube": {
+        "Kentish Town - Kings Cross - Northern": StopPointsInfo(
+            "T1", "T2", "Northern", "inbound"
+        )
+    },
+}
+
+
+def _prediction(line, vehicle_id, naptan_id, minutes_away):
+    return {
+        "lineName": line,
+        "vehicleId": vehicle_id,
+        "naptanId": naptan_id,
+        "expectedArrival": arrow.utcnow().shift(minutes=minutes_away).isoformat(),
+    }
+
+
+def _fake_responses():
+    return {
+        "Line/390/Arrivals/B1": [
+            # Too soon to make it to the stop
+            _prediction("390", "BUS1", "B1", 1),
+            _prediction("390", "BUS2", "B1", 5),
+        ],
+        "Line/Northern/Arrivals/T1": [_prediction("Northern", "TUBE1", "T1", 12)],
+        "Vehicle/BUS2,TUBE1/arrivals": [
+            _prediction("390", "BUS2", "B2", 20),
+            _prediction("Northern", "TUBE1", "T2", 18),
+        ],
+        "Vehicle/BUS2/arrivals": [_prediction("390", "BUS2", "B2", 20)],
+    }
+
+
+def _mock_config_and_api(mocker, responses=None):
+    with open("tests/fake_config.yaml", "r") as file:
+        test_config = yaml.safe_load(file)
+    mocker.patch("goto_london.destination_ranker.CONFIG", test_config)
+    mocker.patch("goto_london.destination_ranker.STOP_POINTS_CACHE", _STOP_POINTS_CACHE)
+    mocker.patch("goto_london.tfl_api.ARRIVALS_CACHE", TtlCache(10, 10))
+    vehicle_timelines = VehicleTimelineIndex(10, 10)
+    mocker.patch("goto_london.tfl_api.VEHICLE_TIMELINES", vehicle_timelines)
+    mocker.patch("goto_london.destination_ranker.VEHICLE_TIMELINES", vehicle_timelines)
+    prediction_accuracy = PredictionAccuracyTracker()
+    mocker.patch("goto_london.tfl_api.PREDICTION_ACCURACY", prediction_accuracy)
+    mocker.patch(
+        "goto_london.destination_ranker.PREDICTION_ACCURACY", prediction_accuracy
+    )
+
+    responses = responses or _fake_responses()
+    return mocker.patch.object(
+        TflApi,
+        "_get_hedged",
+        side_effect=lambda endpoint, params=None: mocker.Mock(
+            **{"json.return_value": responses[endpoint]}
+        ),
+    )
+
+
+def test_rank_options_for_destination(mocker):
+    mock_query = _mock_config_and_api(mocker)
+
+    ranked_options = rank_options_for_destination("kgx")
+
+    # bus: 20 + 5 walk, walk: 30 - 3 bonus, tube: 18 + 5 walk + 5 penalty
+    assert [option.modality for option in ranked_options] == ["bus", "walk", "tube"]
+    assert ranked_options[0].details.vehicle_id == "BUS2"
+    # One call per origin stop, plus one for all candidate vehicles
+    assert mock_query.call_count == 3
+
+
+def test_rank_options_marks_modalities_missed_by_deadline(mocker):
+    mock_query = _mock_config_and_api(mocker)
+
+    ranked_options, missing_options = rank_options_for_destination_within_deadline(
+        "kgx", Deadline(0)
+    )
+
+    # Walking doesn't need TFL, so is the only option we have time for
+    assert [option.modality for option in ranked_options] == ["walk"]
+    assert sorted(option.modality for option in missing_options) == ["bus", "tube"]
+    mock_query.assert_not_called()
+
+
+def test_rank_options_with_explicit_config(mocker):
+    _mock_config_and_api(mocker)
+    with open("tests/fake_config.yaml", "r") as file:
+        tenant_config = yaml.safe_load(file)
+    tenant_config["walk_time_bonus"] = 10
+
+    ranked_options, _ = rank_options_for_destination_within_deadline(
+        "kgx", config=tenant_config, stop_points_cache=_STOP_POINTS_CACHE
+    )
+
+    # walk: 30 - 10 bonus now beats the bus
+    assert [option.modality for option in ranked_options] == ["walk", "bus", "tube"]
+
+
+def test_rank_options_discovers_nearby_stops(mocker):
+    mock_query = _mock_config_and_api(mocker)
+    config = {
+        "walk_time_bonus": 0,
+        "bus_time_bonus": 0,
+        "destinations": {
+            "office": {
+                "nearby": {
+                    "origin": [51.5500, -0.1400],
+                    "destination": [51.5300, -0.1230],
+                    "max_walking_time": 5,
+                }
+            }
+        },
+    }
+    dataset = StopPointDataset(
+        [
+            DatasetStopPoint(
+                "B1", "Origin Stop", ("bus",), ("390",), None, None, 51.5501, -0.1401
+            ),
+            DatasetStopPoint(
+                "B2", "Office Stop", ("bus",), ("390",), None, None, 51.5301, -0.1231
+            ),
+        ]
+    )
+    mocker.patch(
+        "goto_london.destination_ranker.get_stop_point_dataset", return_value=dataset
+    )
+
+    ranked_options, _ = rank_options_for_destination_within_deadline(
+        "office", config=config, stop_points_cache={}
+    )
+
+    assert [option.modality for option in ranked_options] == ["bus", "walk"]
+    assert ranked_options[0].details.modality_option.from_stop == "Origin Stop"
+    assert ranked_options[0].details.vehicle_id == "BUS2"
+    assert mock_query.call_count == 2
+
+
+def test_plan_departures_for_destination(mocker):
+    mock_query = _mock_config_and_api(
+        mocker,
+        {
+            "Line/390/Arrivals/B1": [
+                _prediction("390", "BUS2", "B1", 5),
+                _prediction("390", "BUS3", "B1", 15),
+            ],
+            "Line/Northern/Arrivals/T1": [_prediction("Northern", "TUBE1", "T1", 12)],
+            "Vehicle/BUS2,BUS3,TUBE1/arrivals": [
+                _prediction("390", "BUS2", "B2", 20),
+                _prediction("390", "BUS3", "B2", 30),
+                _prediction("Northern", "TUBE1", "T2", 18),
+            ],
+        },
+    )
+
+    departures, missing_options = plan_departures_for_destination("kgx", [0, 5])
+
+    assert [departure.offset_minutes for departure in departures] == [0, 5]
+    assert [option.modality for option in departures[0].ranked_options] == [
+        "bus",
+        "walk",
+        "tube",
+    ]
+    # Leaving later we miss BUS2 and the tube, but can still catch BUS3
+    assert [option.modality for option in departures[1].ranked_options] == [
+        "walk",
+        "bus",
+    ]
+    assert departures[1].ranked_options[1].details.vehicle_id == "BUS3"
+    assert missing_options == []
+    # Every departure is planned from the same set of calls
+    assert mock_query.call_count == 3
+
+
+def test_rank_options_only_checks_candidate_vehicles_as_needed(mocker):
+    mock_query = _mock_config_and_api(
+        mocker,
+        {
+            "Line/390/Arrivals/B1": [
+                _prediction("390", f"BUS{i}", "B1", 5 + i) for i in range(2, 8)
+            ],
+            "Line/Northern/Arrivals/T1": [_prediction("Northern", "TUBE1", "T1", 12)],
+            # The first two buses terminate before our stop
+            "Vehicle/BUS2,BUS3,TUBE1/arrivals": [
+                _prediction("Northern", "TUBE1", "T2", 18)
+            ],
+            "Vehicle/BUS4,BUS5/arrivals": [_prediction("390", "BUS4", "B2", 25)],
+        },
+    )
+
+    ranked_options = rank_options_for_destination("kgx")
+
+    assert ranked_options[-1].details.vehicle_id == "BUS4"
+    # BUS6 and BUS7 never needed checking
+    assert mock_query.call_count == 4
+
+
+def test_rank_options_reuses_known_vehicle_timelines(mocker):
+    mock_query = _mock_config_and_api(mocker)
+    # e.g. from another destination's arrivals at our destination stops
+    destination_predictions = _fake_responses()["Vehicle/BUS2,TUBE1/arrivals"]
+    vehicle_timelines = VehicleTimelineIndex(10, 10)
+    vehicle_timelines.add_predictions(destination_predictions, complete=False)
+    mocker.patch("goto_london.tfl_api.VEHICLE_TIMELINES", vehicle_timelines)
+    mocker.patch("goto_london.destination_ranker.VEHICLE_TIMELINES", vehicle_timelines)
+
+    ranked_options = rank_options_for_destination("kgx")
+
+    assert [option.modality for option in ranked_options] == ["bus", "walk", "tube"]
+    # Only the origin stops needed querying
+    assert mock_query.call_count == 2
+
+
+def test_rank_options_allows_for_late_arrivals(mocker):
+    _mock_config_and_api(mocker)
+    # The 390 has been getting to B2 five minutes later than predicted
+    prediction_accuracy = PredictionAccuracyTracker()
+    predicted_at = arrow.utcnow().shift(hours=-1)
+    for i in range(20):
+        predicted_arrival = predicted_at.shift(minutes=10)
+        prediction = {"vehicleId": f"OLD{i}", "lineName": "390", "naptanId": "B2"}
+        prediction_accuracy.observe(
+            [
+                prediction
+                | {
+                    "expectedArrival": predicted_arrival.isoformat(),
+                    "timestamp": predicted_at.isoformat(),
+                }
+            ],
+            now=predicted_at.timestamp(),
+        )
+        prediction_accuracy.observe(
+            [
+                prediction
+                | {
+                    "expectedArrival": predicted_arrival.shift(minutes=5).isoformat(),
+                    "timestamp": predicted_arrival.shift(minutes=4).isoformat(),
+                }
+            ],
+            now=predicted_arrival.shift(minutes=4).timestamp(),
+        )
+    prediction_accuracy.observe([])
+    mocker.patch(
+        "goto_london.destination_ranker.PREDICTION_ACCURACY", prediction_accuracy
+    )
+    with open("tests/fake_config.yaml", "r") as file:
+        config = yaml.safe_load(file)
+
+    ranked_options, _ = rank_options_for_destination_within_deadline(
+        "kgx", config=config, stop_points_cache=_STOP_POINTS_CACHE
+    )
+    assert [option.modality for option in ranked_options] == ["bus", "walk", "tube"]
+
+    config["prediction_margin"] = {"quantile": 0.9}
+    ranked_options, _ = rank_options_for_destination_within_deadline(
+        "kgx", config=config, stop_points_cache=_STOP_POINTS_CACHE
+    )
+    # bus: 20 + 5 walk + 5 late now loses to walk: 30 - 3, tube: 18 + 5 + 5
+    assert [option.modality for option in ranked_options] == ["walk", "tube", "bus"]
+    assert ranked_options[2].details.arrival_margin_seconds == 300
+
+
+def test_get_departure_offsets():
+    assert get_departure_offsets({}) == [0, 5, 10, 15, 20, 25, 30]
+    assert get_departure_offsets(
+        {"departure_horizon": {"window_minutes": 10, "step_minutes": 4}}
+    ) == [0, 4, 8]
+
+    for horizon_config in ({"step_minutes": 0}, {"window_minutes": -5}):
+        with pytest.raises(ValueError):
+            get_departure_offsets({"departure_horizon": horizon_config})
@@ -0,0 +1,98 @@
+import threading
+import time
+
+from goto_london.live_cache import SqliteTtlCache, TtlCache
+
+
+def test_ttl_cache_expires_entries(mocker):
+    mock_time = mocker.patch("goto_london.live_cache.time.monotonic", return_value=0)
+    cache = TtlCache(ttl_seconds=10, max_entries=10)
+
+    cache.set("a", [1])
+    assert cache.get("a") == [1]
+
+    mock_time.return_value = 11
+    assert cache.get("a") is None
+    assert len(cache) == 0
+
+
+def test_ttl_cache_evicts_oldest_entries():
+    cache = TtlCache(ttl_seconds=10, max_entries=2)
+
+    for key in ("a", "b", "c"):
+        cache.set(key, key)
+
+    assert cache.get("a") is None
+    assert cache.get("b") == "b"
+    assert cache.get("c") == "c"
+
+
+def test_sqlite_cache_shares_entries_between_instances(tmp_path, mocker):
+    mock_time = mocker.patch("goto_london.live_cache.time.time", return_value=0)
+    cache_path = tmp_path / "live.sqlite"
+    cache = SqliteTtlCache(cache_path, ttl_seconds=10, max_entries=10)
+    other_cache = SqliteTtlCache(cache_path, ttl_seconds=10, max_entries=10)
+
+    cache.set("a", [{"vehicleId": "A1"}])
+    assert other_cache.get("a") == [{"vehicleId": "A1"}]
+    assert len(other_cache) == 1
+
+    mock_time.return_value = 11
+    assert other_cache.get("a") is None
+
+
+def test_sqlite_cache_single_flight(tmp_path):
+    cache_path = tmp_path / "live.sqlite"
+    cache = SqliteTtlCache(cache_path, ttl_seconds=10, max_entries=10)
+    other_cache = SqliteTtlCache(cache_path, ttl_seconds=10, max_entries=10)
+
+    with cache.single_flight("a"):
+        # Someone else holds the lease, so we can't take it...
+        assert not other_cache._try_acquire("a")
+        cache.set("a", "refreshed")
+        # ...but waiters are let through once the key has been refreshed
+        with other_cache.single_flight("a"):
+            assert other_cache.get("a") == "refreshed"
+
+    # Lease released on exit
+    assert other_cache._try_acquire("a")
+
+
+def test_sqlite_cache_single_flight_waits_within_deadline(tmp_path):
+    cache_path = tmp_path / "live.sqlite"
+    cache = SqliteTtlCache(cache_path, ttl_seconds=10, max_entries=10)
+    other_cache = SqliteTtlCache(cache_path, ttl_seconds=10, max_entries=10)
+
+    with cache.single_flight("a"):
+        start = time.monotonic()
+        # The holder never refreshes the key, but we've only 0.1s to spare
+        with other_cache.single_flight("a", max_wait_seconds=0.1):
+            assert time.monotonic() - start < 1
+
+
+def test_ttl_cache_single_flight_waits_within_deadline():
+    cache = TtlCache(ttl_seconds=10, max_entries=10)
+    holding = threading.Event()
+    release = threading.Event()
+
+    def hold(key):
+        with cache.single_flight(key):
+            holding.set()
+            release.wait(5)
+
+    holder = threading.Thread(target=hold, args=("a",))
+    holder.start()
+    assert holding.wait(5)
+
+    start = time.monotonic()
+    # Other keys don't wait on it at all
+    with cache.single_flight("b"):
+        pass
+    # The holder's taking its time, but we've only 0.1s to spare
+    with cache.single_flight("a", max_wait_seconds=0.1):
+        assert time.monotonic() - start < 1
+
+    release.set()
+    holder.join(5)
+    # Locks are dropped once nobody's refreshing their key
+    assert cache._flight_locks == {}
@@ -0,0 +1,66 @@
+import io
+import json
+import logging
+import sys
+
+import pytest
+
+from goto_london.log import (
+    configure_logging,
+    HOT_PATH_LOGGER_NAME,
+    LOGGER_NAME,
+    stop_logging,
+)
+
+
+@pytest.fixture
+def log_stream():
+    stream = io.StringIO()
+    yield stream
+    configure_logging(stream=sys.stdout)
+
+
+def test_json_logging_with_levels(log_stream):
+    configure_logging({"json": True, "levels": {LOGGER_NAME: "WARNING"}}, log_stream)
+
+    logger = logging.getLogger(LOGGER_NAME)
+    logger.info("Not logged")
+    logger.warning("Logged %d", 1)
+    stop_logging()
+
+    log_entries = [json.loads(line) for line in log_stream.getvalue().splitlines()]
+    assert len(log_entries) == 1
+    assert log_entries[0]["level"] == "WARNING"
+    assert log_entries[0]["message"] == "Logged 1"
+
+
+def test_hot_path_logging_is_sampled(log_stream):
+    configure_logging({"hot_path_sample_rate": 0}, log_stream)
+
+    logging.getLogger(HOT_PATH_LOGGER_NAME).info("Sampled out")
+    logging.getLogger(LOGGER_NAME).info("Not sampled")
+    stop_logging()
+
+    assert log_stream.getvalue() == f"INFO:{LOGGER_NAME}:Not sampled\n"
+
+
+def test_exceptions_are_logged_with_tracebacks(log_stream):
+    configure_logging({"json": True}, log_stream)
+
+    try:
+        raise ValueError("Boom")
+    except ValueError:
+        logging.getLogger(LOGGER_NAME).exception("Failed")
+    stop_logging()
+
+    log_entry = json.loads(log_stream.getvalue())
+    assert log_entry["message"] == "Failed"
+    assert "ValueError: Boom" in log_entry["exception"]
+
+
+def test_levels_dropped_from_config_are_reset(log_stream):
+    configure_logging({"levels": {HOT_PATH_LOGGER_NAME: "ERROR"}}, log_stream)
+    assert logging.getLogger(HOT_PATH_LOGGER_NAME).level == logging.ERROR
+
+    configure_logging({}, log_stream)
+    assert logging.getLogger(HOT_PATH_LOGGER_NAME).level == logging.NOTSET
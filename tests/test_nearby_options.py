@@ -0,0 +1,79 @@
+from goto_london.nearby_options import discover_modality_options, walking_minutes
+from goto_london.stop_point_dataset import DatasetStopPoint, StopPointDataset
+
+
+def _stop_point(stop_id, lat, lon, modes=("bus",), lines=("390",)):
+    return DatasetStopPoint(stop_id, stop_id, modes, lines, None, None, lat, lon)
+
+
+ORIGIN = (51.5500, -0.1400)
+DESTINATION = (51.5300, -0.1230)
+
+
+def test_walking_minutes():
+    assert walking_minutes(0) == 0
+    assert walking_minutes(800) == 13
+
+
+def test_discover_modality_options():
+    dataset = StopPointDataset(
+        [
+            # Either side of the road near the origin
+            _stop_point("ORIGIN_N", 51.5502, -0.1401),
+            _stop_point("ORIGIN_S", 51.5498, -0.1401),
+            # Too far to walk from the origin
+            _stop_point("FAR", 51.5600, -0.1400),
+            _stop_point("DESTINATION", 51.5301, -0.1231),
+            # Only serves the origin end
+            _stop_point("ORIGIN_TUBE", 51.5505, -0.1405, ("tube",), ("Northern",)),
+        ]
+    )
+
+    options = discover_modality_options(dataset, ORIGIN, DESTINATION, 5)
+
+    walk_option, walk_stop_points = options[0]
+    assert walk_option.modality == "walk"
+    assert walk_stop_points is None
+    assert walk_option.time_from == walking_minutes(2_515)
+
+    assert sorted(
+        (stop_points.from_stop_id, stop_points.to_stop_id, option.line)
+        for option, stop_points in options[1:]
+    ) == [("ORIGIN_N", "DESTINATION", "390"), ("ORIGIN_S", "DESTINATION", "390")]
+    assert all(option.time_from == 1 for option, _ in options[1:])
+
+
+def test_discover_modality_options_without_walk():
+    options = discover_modality_options(
+        StopPointDataset([]), ORIGIN, DESTINATION, include_walk=False
+    )
+    assert options == []
+
+
+def test_discover_modality_options_capped_and_deduped():
+    dataset = StopPointDataset(
+        [
+            # Listed twice for one line, and served by many others
+            _stop_point(
+                "ORIGIN", 51.5502, -0.1401, lines=("390", "390", *map(str, range(30)))
+            ),
+            _stop_point(
+                "DESTINATION", 51.5301, -0.1231, lines=("390", *map(str, range(30)))
+            ),
+            # A little further away, so walking takes longer
+            _stop_point("ORIGIN_FAR", 51.5520, -0.1401, lines=("390",)),
+        ]
+    )
+
+    options = discover_modality_options(
+        dataset, ORIGIN, DESTINATION, include_walk=False, max_options=5
+    )
+
+    assert len(options) == 5
+    assert (
+        len(
+            {(option.line, stop_points.from_stop_id) for option, stop_points in options}
+        )
+        == 5
+    )
+    assert all(stop_points.from_stop_id == "ORIGIN" for _, stop_points in options)
@@ -0,0 +1,87 @@
+import arrow
+
+from goto_london.prediction_accuracy import (
+    PredictionAccuracyTracker,
+    RollingErrorHistogram,
+)
+
+
+def _prediction(vehicle_id, line, naptan_id, arrives_at, predicted_at):
+    return {
+        "vehicleId": vehicle_id,
+        "lineName": line,
+        "naptanId": naptan_id,
+        "expectedArrival": arrow.get(arrives_at).isoformat(),
+        "timestamp": arrow.get(predicted_at).isoformat(),
+    }
+
+
+def _observe_late_arrivals(tracker, n_vehicles, late_seconds, start=1_000_000):
+    arrived_at = start + 600 + late_seconds
+    for i in range(n_vehicles):
+        # First predicted to arrive in 10 mins, but seen arriving later
+        tracker.observe(
+            [_prediction(f"V{i}", "390", "S1", start + 600, start)], now=start
+        )
+        tracker.observe(
+            [_prediction(f"V{i}", "390", "S1", arrived_at, arrived_at - 30)],
+            now=arrived_at - 30,
+        )
+    # Once they're past due, the arrivals get recorded
+    tracker.observe([], now=arrived_at + 600)
+
+
+def test_histogram_quantiles():
+    histogram = RollingErrorHistogram(window_seconds=600)
+    for error_seconds in range(-60, 241, 30):
+        histogram.add(error_seconds, now=0)
+
+    assert histogram.quantile(0.5, now=0) == (11, 90)
+    assert histogram.quantile(0.05, now=0) == (11, -60)
+    # Errors are clamped to the largest bucket
+    histogram.add(10_000, now=0)
+    assert histogram.quantile(1, now=0) == (12, 600)
+
+
+def test_histogram_forgets_old_errors():
+    histogram = RollingErrorHistogram(window_seconds=600)
+    histogram.add(30, now=0)
+    histogram.add(60, now=500)
+
+    assert histogram.quantile(0.5, now=500)[0] == 2
+    assert histogram.quantile(0.5, now=700) == (1, 60)
+    assert histogram.quantile(0.5, now=2_000) == (0, None)
+
+
+def test_margins_learnt_from_late_arrivals():
+    tracker = PredictionAccuracyTracker()
+    _observe_late_arrivals(tracker, n_vehicles=20, late_seconds=180)
+
+    margins = tracker.margins("390", "S1", quantile=0.9, now=1_002_000)
+    assert margins.late_seconds == 180
+    assert margins.early_seconds == 0
+    # Nothing's known about other stops, nor with too few samples
+    assert tracker.margins("390", "S2", now=1_002_000).late_seconds == 0
+    assert tracker.margins("390", "S1", min_samples=50, now=1_002_000).late_seconds == 0
+
+
+def test_arrivals_not_seen_shortly_beforehand_are_ignored():
+    tracker = PredictionAccuracyTracker()
+    tracker.observe(
+        [_prediction("V1", "390", "S1", 1_000_600, 1_000_000)], now=1_000_000
+    )
+    tracker.observe([], now=1_001_000)
+
+    assert len(tracker) == 0
+
+
+def test_tracked_state_is_bounded():
+    tracker = PredictionAccuracyTracker(max_tracked_arrivals=5, max_tracked_stops=2)
+    tracker.observe(
+        [_prediction(f"V{i}", "390", f"S{i}", 1_000_030, 1_000_000) for i in range(10)],
+        now=1_000_000,
+    )
+    assert len(tracker._arrivals) == 5
+
+    tracker.observe([], now=1_001_000)
+    assert len(tracker) == 2
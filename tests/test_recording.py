@@ -0,0 +1,98 @@
+import json
+import threading
+
+import arrow
+import requests as rq
+
+from goto_london.recording import (
+    _MAX_QUEUED_CHUNKS,
+    read_recording,
+    RecordedResponse,
+    ResponseRecorder,
+)
+from goto_london.replay import ReplayAdapter
+
+
+def test_recorded_responses_read_back_in_order(tmp_path):
+    recorder = ResponseRecorder(tmp_path, chunk_size=2)
+    for i in range(5):
+        recorder.record(f"StopPoint/S{i}/Arrivals", None, 200, f"[{i}]", 0.1)
+    # Two full chunks are written in the background, the last one on flush
+    recorder._queue.join()
+    assert len((tmp_path / f"{recorder._pid}.idx").read_text().splitlines()) == 2
+    recorder.flush()
+
+    recorded_responses = list(read_recording(tmp_path))
+    assert [response.body for response in recorded_responses] == [
+        f"[{i}]" for i in range(5)
+    ]
+    assert recorded_responses[0].endpoint == "StopPoint/S0/Arrivals"
+
+
+def test_full_chunks_dropped_rather_than_blocking(tmp_path, mocker):
+    recorder = ResponseRecorder(tmp_path, chunk_size=1)
+    finish_writing = threading.Event()
+    mocker.patch.object(
+        recorder, "_write", side_effect=lambda _: finish_writing.wait(5)
+    )
+
+    for i in range(_MAX_QUEUED_CHUNKS + 2):
+        recorder.record("Line/390/Arrivals", None, 200, f"[{i}]", 0.1)
+    # One chunk being written and a full queue behind it, so the last is dropped
+    assert recorder.dropped_chunks >= 1
+
+    finish_writing.set()
+    recorder.flush()
+
+
+def test_reading_a_time_window(tmp_path):
+    recorder = ResponseRecorder(tmp_path, chunk_size=2)
+    for i in range(4):
+        recorder.record("Line/390/Arrivals", None, 200, f"[{i}]", 0.1)
+    recorder.flush()
+
+    timestamps = [response.timestamp for response in read_recording(tmp_path)]
+    windowed = list(read_recording(tmp_path, timestamps[1], timestamps[2]))
+
+    assert [response.timestamp for response in windowed] == timestamps[1:3]
+    assert list(read_recording(tmp_path, end_timestamp=timestamps[0] - 1)) == []
+
+
+def test_replay_shifts_timestamps_to_now():
+    recorded_at = arrow.utcnow().shift(hours=-1)
+    body = json.dumps([{"expectedArrival": recorded_at.shift(minutes=5).isoformat()}])
+    session = rq.Session()
+    session.mount(
+        "https://",
+        ReplayAdapter(
+            [
+                RecordedResponse(
+                    recorded_at.timestamp(),
+                    "StopPoint/S1/Arrivals",
+                    {"direction": "inbound"},
+                    200,
+                    body,
+                    0.5,
+                )
+            ],
+            simulate_latency=False,
+        ),
+    )
+
+    response = session.get(
+        "https://api.tfl.gov.uk/StopPoint/S1/Arrivals",
+        params={"app_key": "secret", "direction": "inbound"},
+    )
+
+    assert response.status_code == 200
+    expected_arrival = arrow.get(response.json()[0]["expectedArrival"])
+    assert 4 < (expected_arrival - arrow.utcnow()).total_seconds() / 60 <= 5
+
+
+def test_replay_misses_are_not_found():
+    adapter = ReplayAdapter([], simulate_latency=False)
+    session = rq.Session()
+    session.mount("https://", adapter)
+
+    assert session.get("https://api.tfl.gov.uk/Line/390/Arrivals").status_code == 404
+    assert adapter.miss_count == 1
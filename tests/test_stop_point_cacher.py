@@ -3,11 +3,15 @@ import yaml
 
 from goto_london.stop_point_cacher import (
     _build_unique_stop_line_pairs,
+    _get_tfl_stop_points,
     _load_cache,
+    _warm_up_stop_line_pairs,
     _write_cache,
     CacheException,
+    CacheWarmUpException,
     config_iterator,
     StopLinePair,
+    StopPointNotFoundException,
     StopPointsInfo,
     TflModalitiesType,
 )
@@ -38,6 +42,8 @@ def test_write_cache_to_disk_succeeds(tmp_path):
     test_cache_path = tmp_path / "test_stop_points.cache"
 
     _write_cache(fake_cache, fake_cache_hash, test_cache_path)
+    # Cache should be swapped into place, leaving no temporary files behind
+    assert list(tmp_path.iterdir()) == [test_cache_path]
 
     cache = _load_cache(fake_cache_hash, test_cache_path)
     assert cache == fake_cache
@@ -49,3 +55,40 @@ def test_write_cache_to_disk_succeeds(tmp_path):
     # And check we raise if file not found
     with pytest.raises(FileNotFoundError):
         _load_cache(fake_cache_hash, tmp_path / "bad_cache_path.cache")
+
+
+def test_warm_up_collects_all_failures(mocker):
+    mocker.patch("goto_london.tfl_api.TflApi")
+
+    def fake_get_stop_points_info(modality, stop_line_pair, api, dataset=None):
+        if stop_line_pair.line == "bad":
+            raise StopPointNotFoundException(
+                stop_line_pair.from_stop, modality, stop_line_pair.line
+            )
+        return StopPointsInfo("A", "B", stop_line_pair.line, "inbound")
+
+    mocker.patch(
+        "goto_london.stop_point_cacher._get_stop_points_info_for_pair",
+        side_effect=fake_get_stop_points_info,
+    )
+
+    unique_stops = {
+        "bus": {StopLinePair("1", "2", "bad"), StopLinePair("1", "2", "390")},
+        "tube": {StopLinePair("KNT", "KGX", "bad")},
+        "walk": {StopLinePair(None, None, None)},
+    }
+
+    warm_up_results = _warm_up_stop_line_pairs(unique_stops, max_workers=2)
+    # Walking options aren't resolved against TFL
+    assert len(warm_up_results) == 3
+    assert sum(1 for result in warm_up_results if result.error) == 2
+
+    with pytest.raises(CacheWarmUpException) as e:
+        _get_tfl_stop_points(unique_stops)
+    assert len(e.value.failures) == 2
+
+    unique_stops["bus"].remove(StopLinePair("1", "2", "bad"))
+    unique_stops.pop("tube")
+    assert _get_tfl_stop_points(unique_stops) == {
+        "bus": {"1 - 2 - 390": StopPointsInfo("A", "B", "390", "inbound")}
+    }
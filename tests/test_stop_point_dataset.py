@@ -0,0 +1,179 @@
+import json
+
+from goto_london.stop_point_cacher import _get_stop_points_info_for_pair, StopLinePair
+from goto_london.stop_point_dataset import (
+    DatasetStopPoint,
+    load_naptan_csv,
+    load_stop_point_dataset,
+    normalise_stop_name,
+    StopPointDataset,
+)
+from goto_london.tfl_api import TflApi
+
+
+_TFL_STOP_POINTS = {
+    "stopPoints": [
+        {
+            "naptanId": "HUBKTN",
+            "commonName": "Kentish Town",
+            "modes": ["bus", "national-rail", "tube"],
+            "lines": [],
+            "lat": 51.55,
+            "lon": -0.14,
+            "children": [
+                {
+                    "naptanId": "940GZZLUKSH",
+                    "commonName": "Kentish Town Underground Station",
+                    "modes": ["tube"],
+                    "lines": [{"id": "northern", "name": "Northern"}],
+                    "lat": 51.55,
+                    "lon": -0.14,
+                }
+            ],
+        },
+        {
+            "naptanId": "940GZZLUKSX",
+            "commonName": "King's Cross St. Pancras Underground Station",
+            "modes": ["tube"],
+            "lines": [
+                {"id": "northern", "name": "Northern"},
+                {"id": "victoria", "name": "Victoria"},
+            ],
+            "lat": 51.53,
+            "lon": -0.12,
+        },
+        {
+            "naptanId": "490008660N",
+            "commonName": "Kentish Town Station",
+            "modes": ["bus"],
+            "lines": [{"id": "390", "name": "390"}],
+            "smsCode": "73053",
+            "lat": 51.55,
+            "lon": -0.14,
+        },
+    ]
+}
+
+
+def _write_tfl_dataset(tmp_path):
+    dataset_path = tmp_path / "tfl_stop_points.json"
+    with open(dataset_path, "w") as f:
+        json.dump(_TFL_STOP_POINTS, f)
+    return dataset_path
+
+
+def test_normalise_stop_name():
+    assert normalise_stop_name("King's Cross St. Pancras Underground Station") == (
+        "kings cross st pancras"
+    )
+    assert normalise_stop_name("Elephant & Castle") == "elephant and castle"
+
+
+def test_load_tfl_dataset_and_find_stop_points(tmp_path):
+    dataset = load_stop_point_dataset(_write_tfl_dataset(tmp_path))
+    assert len(dataset) == 4
+
+    # Hub-level matches resolve to the modality-specific child
+    assert dataset.find_stop_point_id("Kentish Town", "tube", "Northern") == (
+        "940GZZLUKSH"
+    )
+    assert dataset.find_stop_point_id(
+        "King's Cross St Pancras", "tube", "Victoria"
+    ) == ("940GZZLUKSX")
+    # Bus stops are found by their stop code
+    assert dataset.find_stop_point_id("73053", "bus", "390") == "490008660N"
+    # Wrong line, or an unknown stop, aren't found
+    assert dataset.find_stop_point_id("73053", "bus", "214") is None
+    assert dataset.find_stop_point_id("Nowhere", "tube", "Northern") is None
+
+
+def test_load_stop_point_dataset_missing_returns_none(tmp_path):
+    assert load_stop_point_dataset(tmp_path / "missing.json") is None
+
+
+def test_load_naptan_csv(tmp_path):
+    dataset_path = tmp_path / "Stops.csv"
+    dataset_path.write_text(
+        "ATCOCode,NaptanCode,CommonName,StopType,Latitude,Longitude\n"
+        "490008660N,73053,Kentish Town Station,BCT,51.55,-0.14\n"
+        "940GZZLUKSH,,Kentish Town,MET,51.55,-0.14\n"
+        "9100KNTSHTN,,Kentish Town Rail Station,RLY,51.55,-0.14\n"
+    )
+
+    dataset = load_naptan_csv(dataset_path)
+    assert len(dataset) == 2
+    # NaPTAN has no line info, so we can't rule out stops based on line
+    assert dataset.find_stop_point_id("73053", "bus", "214") == "490008660N"
+    assert dataset.find_stop_point_id("Kentish Town", "tube", "Northern") == (
+        "940GZZLUKSH"
+    )
+
+
+def test_stop_points_resolved_from_dataset_without_search(mocker):
+    dataset = StopPointDataset([])
+    mocker.patch.object(
+        dataset, "find_stop_point_id", side_effect=["940GZZLUKSH", None]
+    )
+    api = mocker.create_autospec(TflApi, instance=True)
+    api.filter_stop_points_for_modality_and_line.side_effect = (
+        TflApi.filter_stop_points_for_modality_and_line
+    )
+    api.search_stop_points.return_value = {
+        "matches": [{"id": "HUBKGX", "modes": ["tube"]}]
+    }
+    api.get_stop_point_detail.return_value = {
+        "children": [
+            {"id": "940GZZLUKSX", "modes": ["tube"], "lines": [{"name": "Northern"}]}
+        ]
+    }
+    api.get_direction_between_stop_points.return_value = "inbound"
+
+    stop_points_info = _get_stop_points_info_for_pair(
+        "tube", StopLinePair("Kentish Town", "Kings Cross", "Northern"), api, dataset
+    )
+
+    assert list(stop_points_info) == [
+        "940GZZLUKSH",
+        "940GZZLUKSX",
+        "Northern",
+        "inbound",
+    ]
+    # Only the stop missing from our dataset hits the search API
+    api.search_stop_points.assert_called_once_with("Kings Cross", ["tube"])
+
+
+def test_fuzzy_search_and_fuzzy_stop_point_resolution(tmp_path):
+    dataset = load_stop_point_dataset(_write_tfl_dataset(tmp_path))
+
+    matches = dataset.fuzzy_search("Kings Cross", modality="tube", line="Northern")
+    assert [stop_point.id for _, stop_point in matches] == ["940GZZLUKSX"]
+    assert dataset.fuzzy_search("Kings Cross", modality="bus") == []
+
+    # Lines filter on their own, too
+    matches = dataset.fuzzy_search("Kentish Town", line="390")
+    assert "490008660N" in [stop_point.id for _, stop_point in matches]
+    assert "940GZZLUKSH" not in [stop_point.id for _, stop_point in matches]
+    matches = dataset.fuzzy_search("Kentish Town", line="Northern")
+    assert "490008660N" not in [stop_point.id for _, stop_point in matches]
+
+    # Close-enough names resolve without hitting the API
+    assert dataset.find_stop_point_id("Kings Cross", "tube", "Northern") == (
+        "940GZZLUKSX"
+    )
+
+
+def test_ambiguous_fuzzy_matches_are_not_resolved():
+    dataset = StopPointDataset(
+        [
+            DatasetStopPoint(
+                stop_point_id, name, ("tube",), ("Northern",), None, None, None, None
+            )
+            for stop_point_id, name in (
+                ("940GZZLUKSX", "King's Cross St. Pancras"),
+                ("910GKGXTHM", "King's Cross Thameslink"),
+            )
+        ]
+    )
+
+    # Both contain the search term, so we'd be guessing which was meant
+    assert dataset.find_stop_point_id("Kings Cross", "tube", "Northern") is None
@@ -0,0 +1,37 @@
+import random
+
+from goto_london.stop_point_grid import distance_metres, GridIndex
+
+
+def test_distance_metres():
+    # Kings Cross to Kentish Town is roughly 2.4km as the crow flies
+    assert 2_300 < distance_metres(51.5308, -0.1238, 51.5503, -0.1406) < 2_600
+
+
+def test_nearby_matches_brute_force():
+    rng = random.Random(0)
+    points = [
+        (51.5 + rng.uniform(-0.05, 0.05), -0.1 + rng.uniform(-0.05, 0.05))
+        for _ in range(2_000)
+    ]
+    index = GridIndex(cell_size_metres=300)
+    for point_id, (lat, lon) in enumerate(points):
+        index.add(lat, lon, point_id)
+
+    matches = index.nearby(51.5, -0.1, 750)
+
+    distances = {
+        point_id: distance_metres(51.5, -0.1, lat, lon)
+        for point_id, (lat, lon) in enumerate(points)
+    }
+    matched_ids = {point_id for _, point_id in matches}
+    # Leave a little slack for the index using a slightly different projection
+    assert all(distances[point_id] <= 751 for point_id in matched_ids)
+    assert all(
+        point_id in matched_ids
+        for point_id, distance in distances.items()
+        if distance <= 749
+    )
+    assert [distance for distance, _ in matches] == sorted(
+        distance for distance, _ in matches
+    )
@@ -0,0 +1,39 @@
+from goto_london.stop_point_index import TrigramIndex
+
+
+def test_trigram_index_ranks_closest_names_first():
+    index = TrigramIndex(
+        [
+            ("kings cross st pancras", "KSX"),
+            ("kings cross", "KGX"),
+            ("kentish town", "KTN"),
+        ]
+    )
+
+    matches = index.search("kings cross")
+    # Both King's Cross names fully contain the query; the shorter name wins
+    assert [item for _, item in matches] == ["KGX", "KSX"]
+    assert matches[0][0] == 1.0
+
+
+def test_trigram_index_tolerates_typos_and_filters_on_score():
+    index = TrigramIndex([("kentish town", "KTN"), ("bankside", "BSD")])
+
+    assert [item for _, item in index.search("kentsh town")] == ["KTN"]
+    assert index.search("bank", min_score=0.85) == []
+
+
+def test_trigram_index_limits_to_best_accepted_matches():
+    index = TrigramIndex(
+        [(f"{road} street", road) for road in ["high", "church", "mill", "park"]]
+        + [("high street kensington", "HSK"), ("highbury", "HBY")]
+    )
+
+    matches = index.search("high street", limit=2)
+    assert [item for _, item in matches] == ["high", "HSK"]
+
+    # Too few names contain the whole query, so partial matches make up the rest
+    matches = index.search("high street", limit=3, accept=lambda item: item != "high")
+    assert [item for _, item in matches][:1] == ["HSK"]
+    assert len(matches) == 3
+    assert all(score < 1.0 for score, _ in matches[1:])
@@ -0,0 +1,80 @@
+import threading
+import time
+
+import pytest
+
+from goto_london.subscriptions import (
+    diff_results,
+    SubscriptionHub,
+    TooManySubscribersException,
+)
+
+
+def test_diff_results():
+    assert diff_results({"a": 1, "b": [1]}, {"a": 1, "b": [2]}) == {"b": [2]}
+    assert diff_results({"a": 1}, {"a": 1}) == {}
+
+
+def _wait_for(condition, timeout=2):
+    give_up_at = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < give_up_at
+        time.sleep(0.005)
+
+
+def test_subscribers_share_one_refresh_loop():
+    hub = SubscriptionHub(refresh_seconds=0.05, heartbeat_seconds=1)
+    refreshes = []
+    results = iter(
+        [{"best": "bus", "others": []}] * 2 + [{"best": "tube", "others": []}]
+    )
+    result_lock = threading.Lock()
+
+    def refresh():
+        with result_lock:
+            refreshes.append(1)
+            return next(results, {"best": "tube", "others": []})
+
+    first = hub.subscribe("kgx", refresh)
+    assert next(first) == ("snapshot", {"best": "bus", "others": []})
+
+    second = hub.subscribe("kgx", refresh)
+    assert next(second) == ("snapshot", {"best": "bus", "others": []})
+    assert len(hub) == 1
+    assert hub.subscriber_count() == 2
+
+    # Only what changed is sent, and unchanged refreshes send nothing
+    assert next(first) == ("update", {"best": "tube"})
+    assert next(second) == ("update", {"best": "tube"})
+
+    first.close()
+    second.close()
+    _wait_for(lambda: len(hub) == 0)
+
+    refresh_count = len(refreshes)
+    time.sleep(0.1)
+    assert len(refreshes) == refresh_count
+
+
+def test_heartbeat_when_nothing_changes():
+    hub = SubscriptionHub(refresh_seconds=10, heartbeat_seconds=0.01)
+    events = hub.subscribe("kgx", lambda: {"best": "bus"})
+
+    assert next(events) == ("snapshot", {"best": "bus"})
+    assert next(events) is None
+    events.close()
+
+
+def test_subscribers_capped():
+    hub = SubscriptionHub(refresh_seconds=10, max_subscribers=2)
+    first = hub.subscribe("kgx", lambda: {"best": "bus"})
+    second = hub.subscribe("eus", lambda: {"best": "tube"})
+
+    with pytest.raises(TooManySubscribersException):
+        hub.subscribe("kgx", lambda: {"best": "bus"})
+
+    # Closing frees the slot, even without ever reading an event
+    second.close()
+    hub.subscribe("kgx", lambda: {"best": "bus"}).close()
+    first.close()
+    _wait_for(lambda: len(hub) == 0)
@@ -0,0 +1,150 @@
+from dataclasses import replace
+import os
+import shutil
+import threading
+
+import pytest
+
+from goto_london.stop_point_cacher import (
+    SharedStopPointStore,
+    StopLinePairWarmUpResult,
+    StopPointsInfo,
+)
+from goto_london.tenants import (
+    TenantRegistry,
+    TenantUnavailableException,
+    UnknownTenantException,
+)
+
+
+def _fake_warm_up(modality, stop_line_pair, dataset=None):
+    return StopLinePairWarmUpResult(
+        modality=modality,
+        stop_line_pair=stop_line_pair,
+        stop_points_info=StopPointsInfo(
+            stop_line_pair.from_stop,
+            stop_line_pair.to_stop,
+            stop_line_pair.line,
+            "inbound",
+        ),
+        error=None,
+        duration_seconds=0.0,
+        api_calls=1,
+    )
+
+
+@pytest.fixture
+def registry(tmp_path, mocker):
+    tenants_dir = tmp_path / "tenants"
+    tenants_dir.mkdir()
+    for tenant_name in ("alice", "bob", "carol"):
+        shutil.copy("tests/fake_config.yaml", tenants_dir / f"{tenant_name}.yaml")
+
+    mocker.patch(
+        "goto_london.stop_point_cacher._load_dataset_for_config", return_value=None
+    )
+    # One call per (bus and tube) StopLinePair; walking isn't resolved
+    resolve = mocker.patch(
+        "goto_london.stop_point_cacher._warm_up_stop_line_pair",
+        side_effect=_fake_warm_up,
+    )
+    store = SharedStopPointStore(cache_path=tmp_path / "shared.cache")
+
+    return TenantRegistry(tenants_dir, max_loaded=2, stop_point_store=store), resolve
+
+
+def test_tenants_share_stop_points(registry):
+    registry, resolve = registry
+
+    alice = registry.get("alice")
+    bob = registry.get("bob")
+
+    # Both tenants take the same routes, so they're only resolved once
+    assert resolve.call_count == 2
+    assert alice.stop_points["bus"] is bob.stop_points["bus"]
+
+    # The store is persisted, so a fresh one needn't resolve anything
+    fresh_store = SharedStopPointStore(cache_path=registry.stop_point_store.cache_path)
+    fresh_store.stop_points_for_config(alice.config)
+    assert resolve.call_count == 2
+
+
+def test_least_recently_used_tenants_evicted(registry):
+    registry, _ = registry
+
+    alice = registry.get("alice")
+    registry.get("bob")
+    assert registry.get("alice") is alice
+
+    registry.get("carol")
+    assert len(registry) == 2
+    # Bob was least recently used, so Alice survives
+    assert registry.get("alice") is alice
+
+
+def test_unknown_tenant(registry):
+    registry, _ = registry
+
+    with pytest.raises(UnknownTenantException):
+        registry.get("dave")
+    with pytest.raises(UnknownTenantException):
+        registry.get("../alice")
+
+
+def test_concurrent_loads_resolve_once_outside_lock(registry):
+    registry, resolve = registry
+    store = registry.stop_point_store
+    resolving = threading.Event()
+    finish_resolving = threading.Event()
+
+    def slow_resolve(*args, **kwargs):
+        # Other configs' loads mustn't be held up by this one
+        assert not store._lock.locked()
+        resolving.set()
+        finish_resolving.wait(5)
+        return _fake_warm_up(*args, **kwargs)
+
+    resolve.side_effect = slow_resolve
+    tenants = {}
+
+    def load(tenant_name):
+        tenants[tenant_name] = registry.get(tenant_name)
+
+    threads = [threading.Thread(target=load, args=(name,)) for name in ("alice", "bob")]
+    threads[0].start()
+    assert resolving.wait(5)
+    threads[1].start()
+    finish_resolving.set()
+    for thread in threads:
+        thread.join(5)
+
+    assert resolve.call_count == 2
+    assert tenants["alice"].stop_points["bus"] is tenants["bob"].stop_points["bus"]
+
+
+def test_failed_load_can_be_retried(registry):
+    registry, resolve = registry
+    resolve.side_effect = lambda *args, **kwargs: replace(
+        _fake_warm_up(*args, **kwargs), stop_points_info=None, error=Exception("Down")
+    )
+
+    with pytest.raises(TenantUnavailableException):
+        registry.get("alice")
+
+    resolve.side_effect = _fake_warm_up
+    assert registry.get("alice").stop_points["bus"]
+
+
+def test_edited_tenant_reloaded(registry):
+    registry, _ = registry
+
+    alice = registry.get("alice")
+    assert registry.get("alice") is alice
+
+    config_path = os.path.join(registry.tenants_dir, "alice.yaml")
+    os.utime(config_path, (alice.config_mtime + 10, alice.config_mtime + 10))
+    assert registry.get("alice") is not alice
+
+    os.remove(config_path)
+    with pytest.raises(UnknownTenantException):
+        registry.get("alice")
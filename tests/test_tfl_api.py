@@ -1,4 +1,16 @@
-from goto_london.tfl_api import TflApi
+from concurrent.futures import ThreadPoolExecutor
+import time
+
+import pytest
+
+from goto_london.common import Deadline, DeadlineExceededException
+from goto_london.live_cache import TtlCache
+from goto_london.tfl_api import (
+    _HedgePool,
+    _LatencyTracker,
+    LineStopPointLookup,
+    TflApi,
+)
 
 
 def test_filter_results_for_line_and_modality_modality_and_line_succeeds():
@@ -85,3 +97,128 @@ class TestFilterVehicleArrivals:
             self.vehicle_arrivals, stop_point_id="B1"
         )
         assert filtered_arrival == self.vehicle_3
+
+
+def test_live_queries_reuse_cached_responses(mocker):
+    mocker.patch("goto_london.tfl_api.ARRIVALS_CACHE", TtlCache(10, 10))
+    mock_get = mocker.patch("goto_london.tfl_api.get_session").return_value.get
+    mock_get.return_value.json.return_value = [{"vehicleId": "A1"}]
+
+    api = TflApi()
+    for _ in range(2):
+        assert api.get_next_vehicles_for_line_stop_point("390", "B1", "inbound") == [
+            {"vehicleId": "A1"}
+        ]
+
+    assert api.call_count == 1
+
+
+class TestBatchedArrivals:
+    predictions = [
+        {"lineName": "390", "vehicleId": "V2", "expectedArrival": "2020-01-01T12:10Z"},
+        {"lineName": "214", "vehicleId": "V3", "expectedArrival": "2020-01-01T12:05Z"},
+        {"lineName": "390", "vehicleId": "V1", "expectedArrival": "2020-01-01T12:01Z"},
+    ]
+
+    def _mock_query(self, mocker, response):
+        mocker.patch("goto_london.tfl_api.ARRIVALS_CACHE", TtlCache(10, 10))
+        mock_query = mocker.patch.object(TflApi, "_query")
+        mock_query.return_value.json.return_value = response
+        return mock_query
+
+    def test_lines_at_a_stop_are_fetched_together(self, mocker):
+        mock_query = self._mock_query(mocker, self.predictions)
+        api = TflApi()
+
+        next_vehicles = api.get_next_vehicles_for_line_stop_points(
+            [
+                LineStopPointLookup("390", "B1", "inbound"),
+                LineStopPointLookup("214", "B1", "inbound"),
+            ]
+        )
+
+        mock_query.assert_called_once_with(
+            "Line/214,390/Arrivals/B1", {"direction": "inbound"}
+        )
+        # Split back out per line, in order of arrival
+        assert [
+            v["vehicleId"]
+            for v in next_vehicles[LineStopPointLookup("390", "B1", "inbound")]
+        ] == ["V1", "V2"]
+        assert [
+            v["vehicleId"]
+            for v in next_vehicles[LineStopPointLookup("214", "B1", "inbound")]
+        ] == ["V3"]
+
+        # Single-line lookups are now answered from cache
+        api.get_next_vehicles_for_line_stop_point("214", "B1", "inbound")
+        assert mock_query.call_count == 1
+
+    def test_vehicle_arrivals_are_fetched_together(self, mocker):
+        mock_query = self._mock_query(mocker, self.predictions)
+        api = TflApi()
+
+        vehicles_arrivals = api.get_vehicles_arrivals(["V1", "V2", "V1", "V4"])
+
+        mock_query.assert_called_once_with("Vehicle/V1,V2,V4/arrivals", None)
+        assert vehicles_arrivals["V2"] == [self.predictions[0]]
+        assert vehicles_arrivals["V4"] == []
+
+
+class TestDeadlines:
+    def test_expired_deadline_raises_before_querying(self, mocker):
+        mock_get = mocker.patch.object(TflApi, "_get")
+
+        with pytest.raises(DeadlineExceededException):
+            TflApi(deadline=Deadline(0)).get_vehicle_arrivals("V1")
+        mock_get.assert_not_called()
+
+    def test_slow_calls_are_hedged(self, mocker):
+        latencies = _LatencyTracker(window_size=100)
+        for _ in range(20):
+            latencies.record("Vehicle/V1/arrivals", 0.01)
+        mocker.patch("goto_london.tfl_api.LATENCIES", latencies)
+
+        def fake_get(endpoint, params):
+            # First call hangs, the hedged duplicate returns promptly
+            if mock_get.call_count == 1:
+                time.sleep(0.5)
+                return "slow"
+            return "fast"
+
+        mock_get = mocker.patch.object(TflApi, "_get", side_effect=fake_get)
+
+        api = TflApi(deadline=Deadline(5))
+        assert api._get_hedged("Vehicle/V2/arrivals", None) == "fast"
+        assert mock_get.call_count == 2
+
+    def test_calls_not_hedged_while_pool_busy(self, mocker):
+        latencies = _LatencyTracker(window_size=100)
+        for _ in range(20):
+            latencies.record("Vehicle/V1/arrivals", 0.01)
+        mocker.patch("goto_london.tfl_api.LATENCIES", latencies)
+        mocker.patch("goto_london.tfl_api._HEDGE_POOL", _HedgePool(max_workers=2))
+
+        def slow_get(endpoint, params):
+            time.sleep(0.2)
+            return "ok"
+
+        mock_get = mocker.patch.object(TflApi, "_get", side_effect=slow_get)
+        n_calls = 8
+
+        start = time.monotonic()
+        with ThreadPoolExecutor(max_workers=n_calls) as executor:
+            responses = list(
+                executor.map(
+                    lambda _: TflApi(deadline=Deadline(5))._get_hedged(
+                        "Vehicle/V2/arrivals", None
+                    ),
+                    range(n_calls),
+                )
+            )
+
+        assert responses == ["ok"] * n_calls
+        # Calls beyond the pool's two threads went ahead unhedged, rather than
+        # queueing behind each other (and hedging all the more for it)
+        assert time.monotonic() - start < 0.5
+        assert mock_get.call_count <= n_calls + 2
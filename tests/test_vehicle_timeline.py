@@ -0,0 +1,50 @@
+from goto_london.vehicle_timeline import VehicleTimelineIndex
+
+
+def _prediction(vehicle_id, line, naptan_id):
+    return {
+        "vehicleId": vehicle_id,
+        "lineName": line,
+        "naptanId": naptan_id,
+        "expectedArrival": "2022-01-01T12:00:00Z",
+    }
+
+
+def test_stop_level_predictions_only_answer_for_their_stop():
+    index = VehicleTimelineIndex(ttl_seconds=10, max_vehicles=10)
+    index.add_predictions([_prediction("V1", "390", "S1")], complete=False)
+
+    assert index.lookup("V1", "390", "S1") == (True, _prediction("V1", "390", "S1"))
+    # We can't tell whether V1 stops at S2, nor anything about V1 on other lines
+    assert index.lookup("V1", "390", "S2") == (False, None)
+    assert index.lookup("V1", "Northern", "S1") == (False, None)
+
+
+def test_complete_timelines_rule_stops_out():
+    index = VehicleTimelineIndex(ttl_seconds=10, max_vehicles=10)
+    index.add_predictions(
+        [_prediction("V1", "390", "S1"), _prediction("V1", "390", "S2")],
+        complete=True,
+    )
+
+    assert index.lookup("V1", "390", "S2")[1]["naptanId"] == "S2"
+    assert index.lookup("V1", "390", "S3") == (True, None)
+
+
+def test_predictions_expire():
+    index = VehicleTimelineIndex(ttl_seconds=-1, max_vehicles=10)
+    index.add_predictions([_prediction("V1", "390", "S1")], complete=True)
+
+    assert index.lookup("V1", "390", "S1") == (False, None)
+
+
+def test_least_recently_updated_vehicles_evicted():
+    index = VehicleTimelineIndex(ttl_seconds=10, max_vehicles=2)
+    index.add_predictions([_prediction("V1", "390", "S1")], complete=False)
+    index.add_predictions([_prediction("V2", "390", "S1")], complete=False)
+    index.add_predictions([_prediction("V1", "390", "S2")], complete=False)
+    index.add_predictions([_prediction("V3", "390", "S1")], complete=False)
+
+    assert len(index) == 2
+    assert index.lookup("V2", "390", "S1") == (False, None)
+    assert index.lookup("V1", "390", "S1")[0]
@@ -0,0 +1,124 @@
+import os
+import pickle
+import time
+
+from goto_london.live_cache import TtlCache
+from goto_london.prediction_accuracy import (
+    PredictionAccuracyTracker,
+    RollingErrorHistogram,
+)
+from goto_london.vehicle_timeline import VehicleTimelineIndex
+from goto_london.warm_start import (
+    _WARM_START_VERSION,
+    load_snapshots,
+    merge_snapshots,
+    restore_snapshots,
+    save_snapshot,
+    WarmStartSnapshot,
+)
+
+
+def _mock_live_state(mocker):
+    live_state = {
+        "ARRIVALS_CACHE": TtlCache(60, 10),
+        "VEHICLE_TIMELINES": VehicleTimelineIndex(60, 10),
+        "PREDICTION_ACCURACY": PredictionAccuracyTracker(),
+    }
+    for name, value in live_state.items():
+        mocker.patch(f"goto_london.warm_start.{name}", value)
+    live_state["_STALE_RESPONSES"] = TtlCache(60, 10)
+    mocker.patch("goto_london.app._STALE_RESPONSES", live_state["_STALE_RESPONSES"])
+    return live_state
+
+
+def test_snapshot_round_trip(mocker, tmp_path):
+    live_state = _mock_live_state(mocker)
+    live_state["ARRIVALS_CACHE"].set("Line/390/Arrivals/B1?", [{"vehicleId": "V1"}])
+    live_state["VEHICLE_TIMELINES"].add_predictions(
+        [{"vehicleId": "V1", "lineName": "390", "naptanId": "B2"}], complete=True
+    )
+    live_state["_STALE_RESPONSES"].set("kgx", "<html>kgx</html>")
+    save_snapshot(tmp_path / "goto.snapshot")
+
+    # As if we'd restarted
+    live_state = _mock_live_state(mocker)
+    snapshots = load_snapshots(tmp_path / "goto.snapshot")
+    restore_snapshots(snapshots)
+
+    assert len(snapshots) == 1
+    assert live_state["ARRIVALS_CACHE"].get("Line/390/Arrivals/B1?") == [
+        {"vehicleId": "V1"}
+    ]
+    assert live_state["VEHICLE_TIMELINES"].lookup("V1", "390", "B2")[0]
+    assert live_state["VEHICLE_TIMELINES"].lookup("V1", "390", "B3") == (True, None)
+    assert live_state["_STALE_RESPONSES"].get("kgx") == "<html>kgx</html>"
+    # Snapshots are only restored from once
+    assert os.listdir(tmp_path) == []
+
+
+def test_expired_entries_are_not_restored():
+    cache = TtlCache(60, 10)
+    cache.set("fresh", 1)
+    cache.set("stale", 2)
+    entries = [
+        (key, expires_at - 61 if key == "stale" else expires_at, value)
+        for key, expires_at, value in cache.export_entries()
+    ]
+
+    restored_cache = TtlCache(60, 10)
+    restored_cache.import_entries(entries)
+
+    assert restored_cache.get("fresh") == 1
+    assert len(restored_cache) == 1
+
+
+def test_newer_entries_win_when_restoring():
+    cache = TtlCache(60, 10)
+    now = time.time()
+    cache.import_entries([("key", now + 30, "newer"), ("key", now + 10, "older")])
+
+    assert cache.get("key") == "newer"
+
+
+def test_unreadable_snapshots_are_skipped(tmp_path):
+    (tmp_path / "goto.snapshot.123").write_bytes(b"not a pickle")
+    # As if pickled by a version of the code with a module we no longer have
+    (tmp_path / "goto.snapshot.456").write_bytes(b"cgoto_london.gone\nSnapshot\n.")
+    (tmp_path / "goto.snapshot.tmp").write_bytes(b"not ours")
+
+    assert load_snapshots(tmp_path / "goto.snapshot") == []
+    assert os.listdir(tmp_path) == ["goto.snapshot.tmp"]
+
+
+def test_newest_prediction_accuracy_wins(mocker, tmp_path):
+    live_state = _mock_live_state(mocker)
+    now = time.time()
+    for pid, saved_at, late_seconds in ((1, now - 60, 0), (2, now - 30, 120)):
+        tracker = PredictionAccuracyTracker()
+        for _ in range(20):
+            tracker._errors.setdefault(("390", "B1"), RollingErrorHistogram()).add(
+                late_seconds, now
+            )
+        with open(tmp_path / f"goto.snapshot.{pid}", "wb") as f:
+            pickle.dump(
+                WarmStartSnapshot(
+                    _WARM_START_VERSION, saved_at, [], [], tracker.export_state(), []
+                ),
+                f,
+            )
+
+    restore_snapshots(load_snapshots(tmp_path / "goto.snapshot"))
+
+    margins = live_state["PREDICTION_ACCURACY"].margins("390", "B1", now=now)
+    assert margins.late_seconds == 120
+
+
+def test_merged_snapshots_newest_first_bar_old_ones():
+    now = time.time()
+    older, newer, too_old = [
+        WarmStartSnapshot(_WARM_START_VERSION, saved_at, [], [], ({}, {}), [])
+        for saved_at in (now - 60, now - 30, now - 2 * 60 * 60)
+    ]
+
+    assert merge_snapshots([newer], [older, too_old]) == [newer, older]
+    assert merge_snapshots([], []) == []